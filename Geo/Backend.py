@@ -0,0 +1,174 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+#
+# The interface between the matching engine (Queryier, Free_Text, UK, US) and the store holding the
+# geographic data. Every read the engine makes goes through one of the methods below, so that the
+# store can be swapped (see PG_Backend and Snapshot) without touching the matcher.
+#
+# Each method takes 'db', the connection handed to the engine by the server. Backends which don't
+# use a database (i.e. whose 'uses_db' is False) are passed None.
+#
+# Places are returned as (place_id, osm_id, name, country_id, parent_id, population, location)
+# tuples and postcodes as (postcode_id, osm_id, country_id, main, sup, location) tuples. Locations
+# are GeoJSON strings: the whole area if 'show_area' is True, otherwise the centroid.
+#
+
+# Passed as the 'sup' of find_postcodes to match postcodes whatever their supplementary part.
+ANY = "*any*"
+
+
+class Backend:
+    uses_db = True
+
+
+    #
+    # Called when the server reloads (see Queryier.reload), before anything else is read.
+    #
+
+    def refresh(self, db):
+        pass
+
+
+    #
+    # Returns a Ref_Tables.
+    #
+
+    def load_ref_tables(self, db):
+        raise NotImplementedError()
+
+
+    #
+    # Returns an iterable of (place_id, name, country_id) for every name of every place.
+    #
+
+    def iter_place_names(self, db):
+        raise NotImplementedError()
+
+
+    #
+    # Returns a dict mapping each of 'hashes' to a list of the places with a name whose hash it is,
+    # in the country 'country_id' (or in any country if it is None). Each place is listed at most
+    # once per distinct name.
+    #
+
+    def find_places(self, db, hashes, country_id, show_area):
+        raise NotImplementedError()
+
+
+    #
+    # Returns a dict mapping each of 'place_ids' to a (osm_id, country_id, parent_id, population,
+    # location) tuple.
+    #
+
+    def place_details(self, db, place_ids, show_area):
+        raise NotImplementedError()
+
+
+    #
+    # Returns (parent_id, country_id, admin_level) for 'place_id'.
+    #
+
+    def place_parent(self, db, place_id):
+        raise NotImplementedError()
+
+
+    #
+    # Returns a name of 'place_id' in one of 'lang_ids' if it has one, or else any of its names.
+    #
+
+    def place_name(self, db, place_id, lang_ids):
+        raise NotImplementedError()
+
+
+    #
+    # Returns a list of the postcodes whose main part is 'main' (case insensitively) in one of
+    # 'country_ids' (or in any country if it is None). If 'sup' is ANY the supplementary part is
+    # ignored; if it is None, only postcodes without one match; otherwise it must equal 'sup' (case
+    # insensitively).
+    #
+
+    def find_postcodes(self, db, main, country_ids, sup, show_area):
+        raise NotImplementedError()
+
+
+    #
+    # Returns the parent place ID (or None) of 'postcode_id'.
+    #
+
+    def postcode_parent(self, db, postcode_id):
+        raise NotImplementedError()
+
+
+    #
+    # Returns a dict mapping each of 'place_ids' to a tuple of the IDs of its ancestors (its parent,
+    # its parent's parent, and so on).
+    #
+
+    def place_ancestries(self, db, place_ids):
+        ancestries = {}
+        for place_id in place_ids:
+            ancestors = []
+            parent_id = self.place_parent(db, place_id)[0]
+            while parent_id is not None:
+                ancestors.append(parent_id)
+                parent_id = self.place_parent(db, parent_id)[0]
+            ancestries[place_id] = tuple(ancestors)
+
+        return ancestries
+
+
+    #
+    # Returns a dict mapping each of 'place_ids' to a list of (place_id, country_id, admin_level,
+    # name) tuples for the place itself followed by each of its ancestors in turn, where 'name' is
+    # chosen as by place_name. This is everything needed to name and pretty print the places.
+    #
+
+    def place_chains(self, db, place_ids, lang_ids):
+        chains = {}
+        for place_id in place_ids:
+            chains[place_id] = chain = []
+            sub_place_id = place_id
+            while sub_place_id is not None:
+                parent_id, country_id, admin_level = self.place_parent(db, sub_place_id)
+                chain.append((sub_place_id, country_id, admin_level, self.place_name(db, sub_place_id, lang_ids)))
+                sub_place_id = parent_id
+
+        return chains
+
+
+    #
+    # Returns a dict mapping each of 'postcode_ids' to its parent place ID (or None).
+    #
+
+    def postcode_parents(self, db, postcode_ids):
+        return dict([(postcode_id, self.postcode_parent(db, postcode_id)) for postcode_id in postcode_ids])
+
+
+    #
+    # Returns a dict mapping each of 'place_ids' to a (name, pp, ancestors) tuple giving its name
+    # (chosen as by place_name), its pretty printed name (see Queryier.pp_place_id) in the first of
+    # 'lang_ids' it has one in, and a tuple of its ancestors' IDs; or None if the backend doesn't
+    # store pretty printed names, in which case they are built from place_chains.
+    #
+
+    def place_pps(self, db, place_ids, lang_ids):
+        return None
@@ -0,0 +1,254 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import collections, os, struct, sys, threading
+from .import Results
+
+
+#
+# Captures the geo queries answered by a server, so that real traffic can later be replayed (see
+# tests/replay.py) against another server, cache configuration or a freshly started node.
+#
+# Answering a query only appends a tuple to an in-memory queue, which a background thread encodes
+# and writes out every FLUSH_INTERVAL seconds. If the writer falls more than 'max_pending' records
+# behind, further records are dropped (and counted) rather than slowing queries down.
+#
+# The log is written to 'path' until that exceeds 'max_bytes', at which point it is rotated, in the
+# manner of logrotate: 'path' becomes 'path.1', 'path.1' becomes 'path.2' and so on, keeping at most
+# 'files' files. Each file consists of MAGIC followed by records, each of which is:
+#
+#   _RECORD   : The arrival time (seconds since the epoch, as a double), the time taken to answer
+#               the query (in microseconds), the ID of the connection it arrived on (unique within
+#               a file's process), its flags (see below) and the number of languages.
+#   Strings   : The country (empty if none), each language and the query string, each as a 16 bit
+#               length followed by that many bytes of UTF-8.
+#
+# The low bits of the flags are FIND_ALL, ALLOW_DANGLING and SHOW_AREA; bits 4 and 5 give the
+# response format, as an index into Results.FORMATS. All integers are little-endian.
+#
+
+MAGIC = b"FETECAP\x01"
+
+FIND_ALL = 1
+ALLOW_DANGLING = 2
+SHOW_AREA = 4
+_FORMAT_SHIFT = 4
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_FILES = 4
+DEFAULT_MAX_PENDING = 100000
+FLUSH_INTERVAL = 1.0
+
+_RECORD = struct.Struct("<dIIBB")
+_STR_LEN = struct.Struct("<H")
+_MAX_STR_LEN = 2 ** 16 - 1
+_MAX_LATENCY_US = 2 ** 32 - 1
+
+
+class Capture_Error(Exception):
+    pass
+
+
+class Capture_Log:
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, files=DEFAULT_FILES, max_pending=DEFAULT_MAX_PENDING):
+        self.path = path
+        self._max_bytes = max_bytes
+        self._files = files
+        self._max_pending = max_pending
+
+        self._pending = collections.deque()
+        self.dropped = 0
+        self._f = None
+        self._closing = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+
+    #
+    # Record that the geo query 'qs' (with the languages 'langs', the country 'country' or None, and
+    # the flags from mk_flags) arrived on connection 'conn_id' at 'arrival' (as given by time.time())
+    # and took 'latency' seconds to answer.
+    #
+
+    def record(self, arrival, latency, conn_id, qs, langs, country, flags):
+        if len(self._pending) >= self._max_pending:
+            self.dropped += 1
+            return
+
+        self._pending.append((arrival, latency, conn_id, qs, langs, country, flags))
+
+
+    #
+    # Write out any pending records and stop the writer.
+    #
+
+    def close(self):
+        self._closing.set()
+        self._writer.join()
+
+
+    def _write_loop(self):
+        while True:
+            closing = self._closing.wait(FLUSH_INTERVAL)
+            try:
+                self._write_pending()
+            except OSError as e:
+                # Losing some of the capture is better than stopping the server.
+                sys.stderr.write("Warning: Can't write to the capture log '{0}': {1}.\n".format(self.path, e))
+                self._close_file()
+            if closing:
+                break
+        self._close_file()
+
+
+    def _write_pending(self):
+        if len(self._pending) == 0:
+            return
+
+        if self._f is None:
+            self._f = open(self.path, "ab")
+            if self._f.tell() == 0:
+                self._f.write(MAGIC)
+
+        while True:
+            try:
+                rec = self._pending.popleft()
+            except IndexError:
+                break
+
+            buf = encode(*rec)
+            if buf is None:
+                self.dropped += 1
+                continue
+            self._f.write(buf)
+
+        self._f.flush()
+        if self._f.tell() >= self._max_bytes:
+            self._rotate()
+
+
+    def _rotate(self):
+        self._close_file()
+        if self._files > 1:
+            for i in range(self._files - 2, 0, -1):
+                old = "{0}.{1}".format(self.path, i)
+                if os.path.exists(old):
+                    os.replace(old, "{0}.{1}".format(self.path, i + 1))
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+
+    def _close_file(self):
+        if self._f is not None:
+            try:
+                self._f.close()
+            except OSError:
+                pass
+            self._f = None
+
+
+#
+# Returns the capture flags for a query's options.
+#
+
+def mk_flags(find_all, allow_dangling, show_area, fmt):
+    flags = Results.FORMATS.index(fmt) << _FORMAT_SHIFT
+    if find_all:
+        flags |= FIND_ALL
+    if allow_dangling:
+        flags |= ALLOW_DANGLING
+    if show_area:
+        flags |= SHOW_AREA
+
+    return flags
+
+
+#
+# Returns the response format recorded in 'flags'.
+#
+
+def flags_format(flags):
+    return Results.FORMATS[(flags >> _FORMAT_SHIFT) & 3]
+
+
+#
+# Returns a record encoded as bytes, or None if one of its strings is too long to be stored.
+#
+
+def encode(arrival, latency, conn_id, qs, langs, country, flags):
+    strs = [(country or "").encode("utf-8")] + [lang.encode("utf-8") for lang in langs] + [qs.encode("utf-8")]
+    if len(langs) > 255 or max([len(s) for s in strs]) > _MAX_STR_LEN:
+        return None
+
+    parts = [_RECORD.pack(arrival, min(int(latency * 1000000), _MAX_LATENCY_US), conn_id & 0xFFFFFFFF, flags,
+                          len(langs))]
+    for s in strs:
+        parts.append(_STR_LEN.pack(len(s)))
+        parts.append(s)
+
+    return b"".join(parts)
+
+
+#
+# Yields each record in the capture file 'path' as an (arrival, latency, conn_id, qs, langs,
+# country, flags) tuple, with the latency in seconds, the langs a list and the country None if the
+# query had none. A truncated final record (e.g. one being written) is ignored.
+#
+
+def read(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if not data.startswith(MAGIC):
+        raise Capture_Error("'{0}' is not a capture log.".format(path))
+
+    off = len(MAGIC)
+    while off + _RECORD.size <= len(data):
+        arrival, latency_us, conn_id, flags, n_langs = _RECORD.unpack_from(data, off)
+        off += _RECORD.size
+        strs = []
+        for _ in range(n_langs + 2):
+            if off + _STR_LEN.size > len(data):
+                return
+            n, = _STR_LEN.unpack_from(data, off)
+            off += _STR_LEN.size
+            if off + n > len(data):
+                return
+            strs.append(data[off:off + n].decode("utf-8"))
+            off += n
+
+        yield arrival, latency_us / 1000000.0, conn_id, strs[-1], strs[1:-1], strs[0] or None, flags
+
+
+#
+# Returns the 'n' geo queries occurring most often in the capture logs 'paths', most frequent first,
+# as (qs, langs, country, flags) tuples. Queries differing only in their response format count as
+# one, and the format is left out of their flags.
+#
+
+def top_queries(paths, n):
+    counts = collections.Counter()
+    for path in paths:
+        for _, _, _, qs, langs, country, flags in read(path):
+            counts[(qs, tuple(langs), country, flags & (FIND_ALL | ALLOW_DANGLING | SHOW_AREA))] += 1
+
+    return [(qs, list(langs), country, flags) for (qs, langs, country, flags), _ in counts.most_common(n)]
@@ -0,0 +1,437 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import collections, json, socket
+import xml.sax.saxutils as saxutils
+
+from .import Results, Stream_Reader
+
+
+#
+# The client side of the fetegeos protocol. A Client wraps a single connection to fetegeos; with
+# keep_alive=True, any number of queries can be sent down that connection, otherwise the server
+# closes the connection after answering the first query. All responses on a connection are
+# requested in the format 'format' (see Geo.Results).
+#
+# Whatever the format, responses are decoded to the same Python values: a list of results is a list
+# of dicts of the form {"place": {"id": ..., "name": ..., ...}, "dangling": ...} (or "postcode"
+# instead of "place"). Error responses raise Query_Error.
+#
+# Query strings, countries and languages are arbitrary text, which is escaped when queries are made.
+#
+# A geo query sent with trace=True is answered with a trace of the SQL statements the server executed
+# for it (see Results.encode_response), which is put in the Client's 'trace' attribute when the
+# response is read; 'trace' is None after reading any other response.
+#
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8263
+
+# When pipelining, the maximum number of queries which are sent before we wait for a response. This
+# stops both sides from blocking on full socket buffers.
+DEFAULT_WINDOW = 32
+
+_SOCK_BUF = 65536
+
+
+class Query_Error(Exception):
+    pass
+
+
+def mk_geo_query(qs, langs, country=None, find_all=False, allow_dangling=False, show_area=False,
+                 keep_alive=False, id=None, format=Results.DEFAULT_FORMAT, trace=False):
+    if country is not None:
+        country_txt = "<country>{0}</country>".format(saxutils.escape(country))
+    else:
+        country_txt = ""
+
+    if trace:
+        trace_txt = " trace='true'"
+    else:
+        trace_txt = ""
+
+    return bytes(("<geoquery version='1'{id}{format} find_all='{find_all}' allow_dangling='{allow_dangling}' "
+                  "show_area='{show_area}'{keep_alive}{trace}>"
+                  "{langs}{country}"
+                  "<qs>{qs}</qs>"
+                  "</geoquery>"
+        ).format(id=_id_attr(id), format=_format_attr(format), find_all=_bool_txt(find_all), allow_dangling=_bool_txt(allow_dangling),
+                 show_area=_bool_txt(show_area), keep_alive=_keep_alive_attr(keep_alive), trace=trace_txt,
+                 langs=_langs_txt(langs), country=country_txt, qs=saxutils.escape(qs)), 'UTF-8')
+
+
+def mk_batch_query(qss, langs, country=None, find_all=False, allow_dangling=False, show_area=False,
+                   keep_alive=False, id=None, format=Results.DEFAULT_FORMAT):
+    if country is not None:
+        country_txt = "<country>{0}</country>".format(saxutils.escape(country))
+    else:
+        country_txt = ""
+
+    return bytes(("<batchquery version='1'{id}{format} find_all='{find_all}' allow_dangling='{allow_dangling}' "
+                  "show_area='{show_area}'{keep_alive}>"
+                  "{langs}{country}"
+                  "{qss}"
+                  "</batchquery>"
+        ).format(id=_id_attr(id), format=_format_attr(format), find_all=_bool_txt(find_all), allow_dangling=_bool_txt(allow_dangling),
+                 show_area=_bool_txt(show_area), keep_alive=_keep_alive_attr(keep_alive),
+                 langs=_langs_txt(langs), country=country_txt,
+                 qss="".join(["<qs>{0}</qs>".format(saxutils.escape(qs)) for qs in qss])), 'UTF-8')
+
+
+def mk_country_query(qs, langs, keep_alive=False, id=None, format=Results.DEFAULT_FORMAT):
+    return bytes(("<countryquery version='1'{id}{format}{keep_alive}>"
+                  "{langs}"
+                  "<qs>{qs}</qs>"
+                  "</countryquery>"
+        ).format(id=_id_attr(id), format=_format_attr(format), keep_alive=_keep_alive_attr(keep_alive),
+                 langs=_langs_txt(langs), qs=saxutils.escape(qs)), 'UTF-8')
+
+
+def mk_stats_query(keep_alive=False, id=None, format=Results.DEFAULT_FORMAT):
+    return bytes("<statsquery version='1'{id}{format}{keep_alive}/>".format(id=_id_attr(id),
+                 format=_format_attr(format), keep_alive=_keep_alive_attr(keep_alive)), 'UTF-8')
+
+
+#
+# Decode 'msg', a single complete response in the format 'format', as Client.read does, returning a
+# (kind, id, value) triple. Any trace is discarded.
+#
+
+def decode(msg, format=Results.DEFAULT_FORMAT):
+    if format == "xml":
+        docs = Stream_Reader.Stream_Reader().feed(msg)
+        assert len(docs) == 1
+        elem = docs[0][1]
+        trace = elem.find("trace")
+        if trace is not None:
+            elem.remove(trace)
+        return _decode_xml(elem)
+    elif format == "json":
+        return _decode_json(json.loads(str(msg, 'UTF-8')))
+    else:
+        bin_kind, n = Results.BIN_HEADER.unpack_from(msg)
+        response, trace = _decode_bin(bin_kind, msg[Results.BIN_HEADER.size:Results.BIN_HEADER.size + n])
+        return response
+
+
+#
+# Returns the lines fetegeoc prints for the 'i'th geo query result 'result' (as decoded by a
+# Client): "Match #<i + 1>" followed by the result's fields, indented.
+#
+
+def match_lines(i, result):
+    if "place" in result:
+        fields = result["place"]
+    else:
+        fields = result["postcode"]
+
+    lines = ["Match #{0}".format(i + 1)]
+    for tag, v in fields.items():
+        if v is not None:
+            lines.append("  " + field_line(tag, v))
+    lines.append("  " + field_line("dangling", result["dangling"]))
+
+    return lines
+
+
+def field_line(tag, v):
+    if v is not None and v != "":
+        return "{0}: {1}".format(Results.TAG_LONG_NAMES[tag], v)
+    else:
+        return "{0}:".format(Results.TAG_LONG_NAMES[tag])
+
+
+class Client:
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, keep_alive=False, format=Results.DEFAULT_FORMAT,
+                 max_size=None):
+        assert format in Results.FORMATS
+        self.keep_alive = keep_alive
+        self.format = format
+        self._sock = socket.create_connection((host, port))
+        self._reader = Stream_Reader.Stream_Reader(max_size)
+        self._events = collections.deque()
+        self._buf = bytearray() # Unparsed input for the json and bin formats.
+        self.trace = None
+
+
+    def close(self):
+        self._sock.close()
+
+
+    def send(self, msg):
+        self._sock.sendall(msg)
+
+
+    def _recv(self):
+        s = self._sock.recv(_SOCK_BUF)
+        if len(s) == 0:
+            raise EOFError("Connection closed by server.")
+
+        return s
+
+
+    def _next_event(self):
+        while len(self._events) == 0:
+            self._events.extend(self._reader.feed(self._recv()))
+
+        return self._events.popleft()
+
+
+    #
+    # Read the next complete response, returning a (kind, id, value) triple. 'kind' is the type of
+    # response (e.g. "results" or "error"), and 'value' the decoded response.
+    #
+
+    def read(self):
+        self.trace = None
+        if self.format == "xml":
+            while True:
+                kind, elem = self._next_event()
+                if kind == Stream_Reader.DOC:
+                    trace = elem.find("trace")
+                    if trace is not None:
+                        self.trace = Results.decode_xml_trace(trace)
+                        elem.remove(trace)
+                    return _decode_xml(elem)
+
+        try:
+            if self.format == "json":
+                return self._read_json()
+            else:
+                return self._read_bin()
+        except EOFError:
+            return self._trailing_error()
+
+
+    def _read_json(self):
+        while True:
+            i = self._buf.find(b"\n")
+            if i != -1:
+                break
+            self._buf.extend(self._recv())
+        d = json.loads(str(self._buf[:i], 'UTF-8'))
+        del self._buf[:i + 1]
+        self.trace = d.get("trace")
+        return _decode_json(d)
+
+
+    def _read_bin(self):
+        while len(self._buf) < Results.BIN_HEADER.size:
+            self._buf.extend(self._recv())
+        bin_kind, n = Results.BIN_HEADER.unpack_from(self._buf)
+        while len(self._buf) < Results.BIN_HEADER.size + n:
+            self._buf.extend(self._recv())
+        payload = bytes(self._buf[Results.BIN_HEADER.size:Results.BIN_HEADER.size + n])
+        del self._buf[:Results.BIN_HEADER.size + n]
+        response, self.trace = _decode_bin(bin_kind, payload)
+        return response
+
+
+    #
+    # Returns the XML error left unread when the server closed the connection, as a response. The
+    # server sends errors in XML if, e.g., the first message on a connection is malformed, since it
+    # can't then know which format the client wants.
+    #
+
+    def _trailing_error(self):
+        try:
+            docs = Stream_Reader.Stream_Reader().feed(bytes(self._buf))
+        except Stream_Reader.Stream_Error:
+            docs = []
+        if len(docs) != 1 or docs[0][1].tag != "error":
+            raise EOFError("Connection closed by server.")
+
+        del self._buf[:]
+        return _decode_xml(docs[0][1])
+
+
+    #
+    # Read the next response, raising Query_Error if it is an error, and returning its value
+    # otherwise.
+    #
+
+    def _read_value(self):
+        kind, q_id, v = self.read()
+        if kind == "error":
+            raise Query_Error(v)
+
+        return v
+
+
+    def geo(self, qs, langs, **kw):
+        self.send(mk_geo_query(qs, langs, keep_alive=self.keep_alive, format=self.format, **kw))
+        return self._read_value()
+
+
+    #
+    # As geo, but yields each result as soon as it has been received, without waiting for (or, in the
+    # XML format, holding in memory) the complete response.
+    #
+
+    def geo_stream(self, qs, langs, **kw):
+        if self.format != "xml":
+            for r in self.geo(qs, langs, **kw):
+                yield r
+            return
+
+        self.send(mk_geo_query(qs, langs, keep_alive=self.keep_alive, **kw))
+
+        self.trace = None
+        self._reader.stream_items = True
+        try:
+            while True:
+                kind, elem = self._next_event()
+                if kind == Stream_Reader.ITEM:
+                    if elem.tag == "trace":
+                        self.trace = Results.decode_xml_trace(elem)
+                        continue
+                    yield Results.decode_xml_result(elem)
+                else:
+                    if elem.tag == "error":
+                        raise Query_Error(elem.text)
+                    break
+        finally:
+            self._reader.stream_items = False
+
+
+    #
+    # Look up all the query strings in 'qss' in a single batch query, returning a list of results
+    # per query string.
+    #
+
+    def batch(self, qss, langs, **kw):
+        self.send(mk_batch_query(qss, langs, keep_alive=self.keep_alive, format=self.format, **kw))
+        return self._read_value()
+
+
+    #
+    # Returns the name of the country 'qs' (an ISO code) or None if there is no such country.
+    #
+
+    def country(self, qs, langs):
+        self.send(mk_country_query(qs, langs, keep_alive=self.keep_alive, format=self.format))
+        return self._read_value()
+
+
+    #
+    # Returns the server's statistics, as a dict mapping each of Results.STATS_SECTIONS to a dict
+    # mapping names (e.g. of caches) to dicts of counters.
+    #
+
+    def stats(self):
+        self.send(mk_stats_query(keep_alive=self.keep_alive, format=self.format))
+        return self._read_value()
+
+
+    #
+    # Send every query string in 'qss' down this connection, without waiting for each response
+    # before sending the next query. Yields (qs, results) pairs in the same order as 'qss'; if a
+    # query fails, 'results' is a Query_Error instance.
+    #
+
+    def geo_many(self, qss, langs, window=DEFAULT_WINDOW, **kw):
+        assert self.keep_alive
+        in_flight = collections.deque()
+        for qs in qss:
+            if len(in_flight) == window:
+                yield in_flight.popleft(), self._read_value_or_error()
+            self.send(mk_geo_query(qs, langs, keep_alive=True, format=self.format, **kw))
+            in_flight.append(qs)
+
+        while len(in_flight) > 0:
+            yield in_flight.popleft(), self._read_value_or_error()
+
+
+    def _read_value_or_error(self):
+        try:
+            return self._read_value()
+        except Query_Error as e:
+            return e
+
+
+_BIN_KINDS = {Results.BIN_RESULTS: "results", Results.BIN_BATCH_RESULTS: "batchresults",
+              Results.BIN_ERROR: "error", Results.BIN_COUNTRY: "country", Results.BIN_STATS: "stats",
+              Results.BIN_TRACED_RESULTS: "results"}
+
+
+def _decode_xml(elem):
+    q_id = elem.get("id")
+    if elem.tag == "error":
+        return "error", q_id, elem.text
+    elif elem.tag == "results":
+        return "results", q_id, [Results.decode_xml_result(e) for e in elem]
+    elif elem.tag == "batchresults":
+        return "batchresults", q_id, [[Results.decode_xml_result(e) for e in results] for results in elem]
+    elif elem.tag == "stats":
+        return "stats", q_id, Results.decode_xml_stats(elem)
+    else:
+        assert elem.tag == "result"
+        if len(elem) == 0:
+            return "country", q_id, None
+        return "country", q_id, elem.findtext("country/name")
+
+
+def _decode_json(d):
+    for kind in ("results", "batchresults", "error", "country", "stats"):
+        if kind in d:
+            if kind == "country" and d[kind] is not None:
+                return kind, d["id"], d[kind]["name"]
+            return kind, d["id"], d[kind]
+    assert False
+
+
+#
+# Returns a ((kind, id, value), trace) pair for the bin response 'payload' of the kind 'bin_kind'.
+#
+
+def _decode_bin(bin_kind, payload):
+    q_id, v = Results.decode_bin(bin_kind, payload)
+    trace = None
+    if bin_kind == Results.BIN_TRACED_RESULTS:
+        v, trace = v
+
+    return (_BIN_KINDS[bin_kind], q_id or None, v), trace
+
+
+def _bool_txt(b):
+    return str(b).lower()
+
+
+def _id_attr(id):
+    if id is None:
+        return ""
+    return " id={0}".format(saxutils.quoteattr(str(id)))
+
+
+def _format_attr(format):
+    if format == Results.DEFAULT_FORMAT:
+        return ""
+    return " format='{0}'".format(format)
+
+
+def _keep_alive_attr(keep_alive):
+    if keep_alive:
+        return " keep_alive='true'"
+    return ""
+
+
+def _langs_txt(langs):
+    return "".join(["<lang>{0}</lang>".format(saxutils.escape(x)) for x in langs])
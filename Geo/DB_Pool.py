@@ -0,0 +1,177 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import contextlib, threading, time
+
+
+#
+# A pool of database connections. Connections are opened up front (up to 'min_size') or on demand
+# (up to 'max_size') and then handed out to one user at a time, so that the cost of connecting is
+# paid once rather than on every request, and so that concurrent requests never share a
+# connection. 'connect' is a function which returns a new DB API connection.
+#
+# A connection which has been idle for more than 'check_interval' seconds, or whose last user hit
+# an error, is checked with a trivial query before being handed out again; if that fails, it is
+# replaced with a fresh connection.
+#
+
+DEFAULT_MIN_SIZE = 1
+DEFAULT_MAX_SIZE = 8
+DEFAULT_CHECK_INTERVAL = 30
+
+
+class Pool_Error(Exception):
+    pass
+
+
+class DB_Pool:
+    def __init__(self, connect, min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        assert 0 <= min_size <= max_size and max_size > 0
+        self._connect = connect
+        self._max_size = max_size
+        self._check_interval = check_interval
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0 # The number of open connections, whether idle or in use.
+
+        for _ in range(min_size):
+            self._idle.append(Pooled_Connection(self._connect()))
+            self._size += 1
+
+
+    def acquire(self, timeout=None):
+        with self._cond:
+            while len(self._idle) == 0 and self._size >= self._max_size:
+                if not self._cond.wait(timeout):
+                    raise Pool_Error("Timed out waiting for a database connection.")
+
+            if len(self._idle) > 0:
+                conn = self._idle.pop()
+            else:
+                # Reserve a slot for a new connection; we connect outside the lock.
+                conn = None
+                self._size += 1
+
+        if conn is None:
+            try:
+                return Pooled_Connection(self._connect())
+            except:
+                self._discard()
+                raise
+
+        if conn.suspect or time.time() - conn.last_used > self._check_interval:
+            if not conn.check():
+                conn.close()
+                try:
+                    conn = Pooled_Connection(self._connect())
+                except:
+                    self._discard()
+                    raise
+
+        return conn
+
+
+    def release(self, conn):
+        try:
+            # End whatever transaction the last user implicitly started so that the connection
+            # isn't left idle in a transaction.
+            conn.rollback()
+        except Exception:
+            conn.suspect = True
+
+        conn.last_used = time.time()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except:
+            conn.suspect = True
+            raise
+        finally:
+            self.release(conn)
+
+
+    def close(self):
+        with self._cond:
+            for conn in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+
+    def _discard(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+
+#
+# A connection handed out by DB_Pool. This can be used anywhere a normal DB API connection is
+# expected. 'prepared' records per-connection state (e.g. which statements have been prepared on
+# the server) which is lost when the underlying connection is replaced.
+#
+
+class Pooled_Connection:
+    def __init__(self, db):
+        self.db = db
+        self.prepared = {}
+        self.last_used = time.time()
+        self.suspect = False
+
+
+    def cursor(self, *args):
+        return self.db.cursor(*args)
+
+
+    def commit(self):
+        self.db.commit()
+
+
+    def rollback(self):
+        self.db.rollback()
+
+
+    def close(self):
+        try:
+            self.db.close()
+        except Exception:
+            pass
+
+
+    def check(self):
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT 1")
+            c.fetchone()
+            self.db.rollback()
+        except Exception:
+            return False
+
+        self.suspect = False
+        return True
@@ -19,7 +19,7 @@
 # IN THE SOFTWARE.
 
 import re, hashlib
-from .import Results, UK, US
+from .import Backend, Metrics, Results, UK, US
 
 
 _RE_IRRELEVANT_CHARS = re.compile("[,\\n\\r\\t;()]")
@@ -38,11 +38,13 @@ class Free_Text:
         self.qs = _cleanup(qs)
         self.split, self.split_indices = _split(self.qs)
         self.host_country_id = host_country_id
-        self.country_type_id = self.queryier.get_type_id(self.db, "country")
+        # The time spent in each phase of matching is charged to the current request.
+        self._timer = Metrics.current()
 
         results_cache_key = (tuple(lang_ids), find_all, allow_dangling, show_area, self.qs, host_country_id)
-        if queryier.results_cache.has_key(results_cache_key):
-            return queryier.results_cache[results_cache_key]
+        results = queryier.results_cache.get(results_cache_key)
+        if results is not None:
+            return results
 
         # _matches is a list of lists storing all the matched places (and postcodes etc.) at a given
         # point in the split. self._longest_match is a convenience integer which records the longest
@@ -60,6 +62,17 @@ class Free_Text:
         self._matched_places = set()
         self._matched_postcodes = set() # Analagous to _matched_places.
 
+        # Every span of words that _iter_places could look up is fetched from the database in bulk,
+        # the first time each country is searched in, so that matching then runs from the place
+        # cache. _prefetched records the countries (with None for "any country") already fetched.
+        self._span_hashes = _span_hashes(self.split)
+        self._prefetched = set()
+
+        # Results are named and pretty printed only once matching has finished, and then only those
+        # which survive, all in one go (see _resolve). _pending maps each result still to be resolved
+        # to None (for places) or a (pp, suffix) pair (for postcodes; see postcode_result).
+        self._pending = {}
+
         # The basic idea of the search is to start from the right hand side of the string and try and
         # match first the country, then any postcodes and places. Note that postcodes and places can
         # come in any order.
@@ -68,11 +81,11 @@ class Free_Text:
         # right-hand most word as a candidate match. This copes with the fact that many countries /
         # administrative units have spaces in them.
 
-        for country_id, i in self._iter_country():
+        for country_id, i in Metrics.timed(self._timer, "country", self._iter_country()):
             if i == -1:
                 continue
 
-            for parent_places, postcode, j in self._iter_places(i, country_id):
+            for parent_places, postcode, j in Metrics.timed(self._timer, "places", self._iter_places(i, country_id)):
                 if postcode is not None and j + 1 <= self._longest_match:
                     done_key = (postcode.id, j)
                     if done_key in self._matched_postcodes:
@@ -94,6 +107,7 @@ class Free_Text:
         # OK, we've now done all the matching, so we can select the best matches and turn them into
         # full results.
 
+        self._timer.enter("rank")
         results = self._matches[self._longest_match]
 
         if self.host_country_id is not None and not self.find_all:
@@ -107,6 +121,10 @@ class Free_Text:
                 else:
                     i += 1
 
+        self._timer.enter("pp")
+        self._resolve(results)
+        self._timer.leave()
+
         # Sort the results into alphabetical order.
         results.sort(key=lambda x: x.pp)
 
@@ -173,6 +191,7 @@ class Free_Text:
             dangling = ""
 
         final_results = [Results.Result(m, dangling) for m in results]
+        self._timer.leave()
 
         queryier.results_cache[results_cache_key] = final_results
 
@@ -188,8 +207,6 @@ class Free_Text:
 
             yield self.host_country_id, len(self.split) - 1
 
-        c = self.db.cursor()
-
         # Then see if the user has specified an ISO 2 code of a country name.
 
         if len(self.split[-1]) == 2:
@@ -199,28 +216,17 @@ class Free_Text:
                 # reasonably be expected to specify "UK" so we hack that in.
                 iso2_cnd = "gb"
 
-            c.execute("SELECT country_id FROM country WHERE iso3166_2=%(iso2)s", dict(iso2=iso2_cnd.upper()))
-            if c.rowcount > 0:
-                assert c.rowcount == 1
-                country_id = c.fetchone()[0]
+            country_id = self.queryier.ref.get_country_id(iso2_cnd)
+            if country_id is not None:
                 yield country_id, len(self.split) - 2
 
 
         # Finally try and match a full country name. Note that we're agnostic over the language used to
         # specify the country name.
 
-        c.execute("""SELECT place.country_id, place_name.name
-                FROM place, place_name
-                WHERE place_name.place_id=place.place_id
-                AND place.type_id=%(type_id)s
-                AND place_name.name_hash=%(name_lwdh)s""",
-                  dict(type_id=self.country_type_id, name_lwdh=_hash_wd(self.split[-1])))
-        cols_map = self.queryier.mk_cols_map(c)
-
         done = set()
-        for cnd in c.fetchall():
-            new_i = _match_end_split(self.split, len(self.split) - 1, cnd[cols_map["name"]])
-            country_id = cnd[cols_map["country_id"]]
+        for country_id, name in self.queryier.ref.get_country_names_by_hash(_hash_wd(self.split[-1])):
+            new_i = _match_end_split(self.split, len(self.split) - 1, name)
             done_key = (country_id, new_i)
             if done_key in done:
                 continue
@@ -234,29 +240,24 @@ class Free_Text:
 
 
     def _iter_places(self, i, country_id, parent_places=[], postcode=None):
-        c = self.db.cursor()
-
-        if country_id is not None:
-            country_sstr = " AND place.country_id = %(country_id)s"
+        if self.queryier.place_trie is not None:
+            trie_places = self._trie_places(i, country_id)
         else:
-            country_sstr = ""
+            trie_places = None
+            if country_id not in self._prefetched:
+                self._prefetched.add(country_id)
+                prefetch_places(self.queryier, self.db, self._span_hashes, self.show_area, country_id)
 
         for j in range(0, i + 1):
-            sub_hash = _hash_list(self.split[j:i + 1])
-            print("Sub_hash " + str(self.split[j:i + 1]) + ": " + sub_hash)
-            cache_key = (country_id, sub_hash, self.show_area)
-            if self.queryier.place_cache.has_key(cache_key):
-                places = self.queryier.place_cache[cache_key]
+            if trie_places is not None:
+                places = trie_places.get(j, [])
             else:
-                c.execute(("SELECT DISTINCT ON (place.place_id, place_name.name) "
-                           "place.place_id, place.osm_id, place_name.name, place.country_id, place.parent_id, place.population, "
-                           + self.location_printer("place.location") + " as location "
-                                                                       "FROM place, place_name "
-                                                                       "WHERE place_name.name_hash=%(name_hash)s "
-                                                                       "AND place.place_id=place_name.place_id"
-                              ) + country_sstr, dict(name_hash=sub_hash, country_id=country_id))
-                places = c.fetchall()
-                self.queryier.place_cache[cache_key] = places
+                places = self._hashed_places(i, j, country_id)
+
+            if len(parent_places) > 0:
+                # Look up the ancestors of every candidate at once, rather than one by one in
+                # _find_parent.
+                self.queryier.prefetch_ancestors(self, [place[0] for place in places])
 
             for place_id, osm_id, name, sub_country_id, parent_id, population, location in places:
                 # Don't get caught out by e.g. a capital city having the same name as a state.
@@ -303,16 +304,15 @@ class Free_Text:
                         continue
                     self._matched_places.add(done_key)
 
-                    local_name = self.queryier.name_place_id(self, place_id)
-
-                    pp = self.queryier.pp_place_id(self, place_id)
+                    match = Results.RPlace(place_id, osm_id, None, location, sub_country_id, parent_id,
+                                           population, None)
+                    self._pending[match] = None
 
                     self._longest_match = new_i + 1
-                    self._matches[new_i + 1].append(Results.RPlace(place_id, osm_id, local_name, location,
-                                                                   sub_country_id, parent_id, population, pp))
+                    self._matches[new_i + 1].append(match)
 
             if postcode is None:
-                for sub_postcode, k in self._iter_postcode(i, country_id):
+                for sub_postcode, k in Metrics.timed(self._timer, "postcodes", self._iter_postcode(i, country_id)):
                     assert k < i
                     if k == -1:
                         done_key = (sub_postcode.id, k)
@@ -335,30 +335,92 @@ class Free_Text:
                             yield sub_places, sub_sub_postcode, k
 
 
+    #
+    # Return the places (as (place_id, osm_id, name, country_id, parent_id, population, location)
+    # tuples) whose name is split[j:i + 1], by looking up the hash of the span.
+    #
+
+    def _hashed_places(self, i, j, country_id):
+        sub_hash = _hash_list(self.split[j:i + 1])
+
+        def find():
+            if country_id is not None:
+                all_places = self.queryier.place_cache.get((None, sub_hash, self.show_area))
+                if all_places is not None:
+                    # We already know every place with this name, irrespective of country (e.g.
+                    # because of a batch prefetch), so there's no need to go to the database.
+                    return [p for p in all_places if p[3] == country_id]
+
+            return self.queryier.backend.find_places(self.db, [sub_hash], country_id, self.show_area)[sub_hash]
+
+        return self.queryier.place_cache.get_or_compute((country_id, sub_hash, self.show_area), find)
+
+
+    #
+    # As _hashed_places, but for every j at once using the place trie: returns a dict mapping j to a
+    # list of places. Only the details of the matching places come from the database.
+    #
+
+    def _trie_places(self, i, country_id):
+        matches = self.queryier.place_trie.match_end(self.split, i, country_id)
+        details = self.queryier.place_details(self, set([place_id for j, place_ids in matches for place_id in place_ids]))
+
+        trie_places = {}
+        for j, place_ids in matches:
+            name = " ".join(self.split[j:i + 1])
+            trie_places[j] = [(place_id, details[place_id][0], name) + details[place_id][1:]
+                              for place_id in place_ids if place_id in details]
+
+        return trie_places
+
+
     #
     # Return True if 'find_id' is a parent of 'place_id'.
     #
 
     def _find_parent(self, find_id, place_id):
-        cache_key = (find_id, place_id)
-        if self.queryier.parent_cache.has_key(cache_key):
-            return self.queryier.parent_cache[cache_key]
-
-        c = self.db.cursor()
-
-        c.execute("SELECT parent_id FROM place WHERE place_id=%(place_id)s", dict(place_id=place_id))
-        assert c.rowcount == 1
-        parent_id = c.fetchone()[0]
-        if parent_id is None:
-            self.queryier.parent_cache[cache_key] = False
-            return False
-        elif parent_id == find_id:
-            self.queryier.parent_cache[cache_key] = True
-            return True
-        else:
-            r = self._find_parent(find_id, parent_id)
-            self.queryier.parent_cache[cache_key] = r
-            return r
+        return find_id in self.queryier.place_ancestors(self, place_id)
+
+
+    #
+    # Return a postcode result whose pretty printed name will be 'pp' followed by that of the
+    # postcode's parent place (if it has one) and then 'suffix' (if it isn't None).
+    #
+
+    def postcode_result(self, postcode_id, osm_id, country_id, location, pp, suffix=None):
+        match = Results.RPost_Code(postcode_id, osm_id, country_id, location, None)
+        self._pending[match] = (pp, suffix)
+
+        return match
+
+
+    #
+    # Name and pretty print those of 'results' which haven't been already. The parents of postcodes
+    # and then the names and ancestors of all the places involved are each looked up in one go, so
+    # this costs the same number of round trips however many results there are.
+    #
+
+    def _resolve(self, results):
+        results = [r for r in results if r in self._pending]
+        postcode_ids = [r.id for r in results if isinstance(r, Results.RPost_Code)]
+        postcode_parents = self.queryier.postcode_parent_ids(self, postcode_ids)
+        place_ids = [r.id for r in results if isinstance(r, Results.RPlace)]
+        place_ids.extend([parent_id for parent_id in postcode_parents.values() if parent_id is not None])
+        self.queryier.resolve_places(self, place_ids)
+
+        for r in results:
+            if isinstance(r, Results.RPlace):
+                r.name = self.queryier.name_place_id(self, r.id)
+                r.pp = self.queryier.pp_place_id(self, r.id)
+            else:
+                pp, suffix = self._pending[r]
+                parent_id = postcode_parents.get(r.id)
+                if parent_id is not None:
+                    pp = "{0}, {1}".format(pp, self.queryier.pp_place_id(self, parent_id))
+                if suffix is not None:
+                    pp = "{0}, {1}".format(pp, suffix)
+                r.pp = pp
+            del self._pending[r]
 
 
     def _iter_postcode(self, i, country_id):
@@ -373,39 +435,20 @@ class Free_Text:
             for sub_postcode, j in US.postcode_match(self, i):
                 yield sub_postcode, j
 
-        c = self.db.cursor()
-
         if country_id is not None:
-            country_sstr = " AND country_id=%(country_id)s"
+            country_ids = [country_id]
         else:
-            country_sstr = ""
-
-        c.execute(("SELECT country_id, main, postcode_id, osm_id, "
-                   + self.location_printer("location") + " as location "
-                                                         "FROM postcode "
-                                                         "WHERE lower(main)=%(main)s "
-                      ) + country_sstr,
-                  dict(main=self.split[i], country_id=country_id))
+            country_ids = None
 
-        cols_map = self.queryier.mk_cols_map(c)
-        for cnd in c.fetchall():
-            fetched_country_id = cnd[cols_map["country_id"]]
-            fetched_postcode_id = cnd[cols_map["postcode_id"]]
-            pp = cnd[cols_map["main"]]
+        postcodes = self.queryier.backend.find_postcodes(self.db, self.split[i], country_ids, Backend.ANY,
+                                                         self.show_area)
+        for fetched_postcode_id, osm_id, fetched_country_id, pp, sup, location in postcodes:
 
             if fetched_country_id in [uk_id, us_id]:
                 # We search for UK/US postcodes elsewhere.
                 continue
 
-            # Search for a parent place
-            c.execute("SELECT parent_id FROM postcode WHERE postcode_id=%(id)s", dict(id=fetched_postcode_id))
-            parent_id = c.fetchone()[0]
-
-            if parent_id is not None:
-                pp = "{0}, {1}".format(pp, self.queryier.pp_place_id(self, parent_id))
-
-            match = Results.RPost_Code(fetched_postcode_id, cnd[cols_map["osm_id"]], fetched_country_id,
-                                       cnd[cols_map["location"]], pp)
+            match = self.postcode_result(fetched_postcode_id, osm_id, fetched_country_id, location, pp)
             yield match, i - 1
 
         if country_id is not None and country_id != uk_id:
@@ -417,11 +460,51 @@ class Free_Text:
                 yield sub_postcode, j
 
 
-    def location_printer(self, location):
-        if self.show_area:
-            return "ST_AsGeoJSON({0})".format(location)
-        else:
-            return "ST_AsGeoJSON(ST_Centroid({0}))".format(location)
+#
+# Return the hashes of every contiguous span of words in the query string 'qs'. These are all the
+# name hashes that _iter_places might look up for 'qs'.
+#
+
+def span_hashes(qs):
+    split, split_indices = _split(_cleanup(qs))
+
+    return _span_hashes(split)
+
+
+#
+# Return the hash under which the place name 'name' is looked up.
+#
+
+def name_hash(name):
+    split, split_indices = _split(_cleanup(name))
+
+    return _hash_list(split)
+
+
+def _span_hashes(split):
+    hashes = set()
+    for i in range(len(split)):
+        for j in range(i + 1):
+            hashes.add(_hash_list(split[j:i + 1]))
+
+    return hashes
+
+
+#
+# Look up every place whose name hash is in 'hashes' in the country 'country_id' (or in any country
+# if 'country_id' is None), using as few queries as possible, and put the results in the place cache.
+# Hashes which are already cached, for the country or for any country, aren't looked up again.
+#
+
+def prefetch_places(queryier, db, hashes, show_area, country_id=None):
+    todo = [h for h in hashes if not queryier.place_cache.has_key((country_id, h, show_area))
+            and not queryier.place_cache.has_key((None, h, show_area))]
+    if len(todo) == 0:
+        return
+
+    places = queryier.backend.find_places(db, todo, country_id, show_area)
+    for h in todo:
+        queryier.place_cache[(country_id, h, show_area)] = places[h]
 
 
 #
@@ -0,0 +1,229 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import json
+from .import Backend, Free_Text, PG_Backend, Ref_Tables
+
+
+#
+# A backend holding all its data in Python dicts, loaded from one or more fixture files. It needs
+# no database, so the matching engine can be tested, benchmarked and profiled in isolation.
+#
+# A fixture is a JSON object whose members are lists of rows, mirroring the database's tables:
+#
+#   "type"         : [type_id, name]
+#   "lang"         : [lang_id, iso639_1, iso639_2]
+#   "country"      : [country_id, iso3166_2, iso3166_3, name]
+#   "country_name" : [country_id, lang_id, name]
+#   "place"        : [place_id, osm_id, country_id, parent_id, population, admin_level, area, centroid]
+#   "place_name"   : [place_id, lang_id, name]
+#   "postcode"     : [postcode_id, osm_id, country_id, parent_id, main, sup, area, centroid]
+#
+# where 'area' and 'centroid' are GeoJSON strings (or null). Any member may be omitted. When
+# several fixtures are given, their rows are concatenated. Name hashes are computed as the matcher
+# computes them (see Free_Text.name_hash), so fixtures can be written by hand. dump() writes a
+# fixture from the database.
+#
+
+class Memory_Backend(Backend.Backend):
+    uses_db = False
+
+
+    def __init__(self, paths):
+        self._paths = paths
+        self._tables = None
+
+
+    #
+    # (Re)read the fixtures. The new tables are built in full before being swapped in, so queries
+    # running meanwhile see either the old or the new data.
+    #
+
+    def refresh(self, db):
+        fixture = {}
+        for path in self._paths:
+            with open(path, "rt", encoding="UTF-8") as f:
+                for name, rows in json.load(f).items():
+                    fixture.setdefault(name, []).extend(rows)
+
+        self._tables = _Tables(fixture)
+
+
+    def load_ref_tables(self, db):
+        t = self._tables
+
+        return Ref_Tables.Ref_Tables(t.type_rows, t.lang_rows, t.country_rows, t.country_name_rows)
+
+
+    def iter_place_names(self, db):
+        t = self._tables
+        for place_id, names in t.place_names.items():
+            country_id = t.places[place_id][1]
+            for lang_id, name in names:
+                yield place_id, name, country_id
+
+
+    def find_places(self, db, hashes, country_id, show_area):
+        t = self._tables
+        places = {}
+        for h in hashes:
+            done = set()
+            places[h] = hash_places = []
+            for place_id, name in t.hashed_names.get(h, []):
+                osm_id, sub_country_id, parent_id, population, admin_level, area, centroid = t.places[place_id]
+                if (country_id is None or sub_country_id == country_id) and (place_id, name) not in done:
+                    done.add((place_id, name))
+                    hash_places.append((place_id, osm_id, name, sub_country_id, parent_id, population,
+                                        _location(area, centroid, show_area)))
+
+        return places
+
+
+    def place_details(self, db, place_ids, show_area):
+        t = self._tables
+        details = {}
+        for place_id in place_ids:
+            if place_id in t.places:
+                osm_id, country_id, parent_id, population, admin_level, area, centroid = t.places[place_id]
+                details[place_id] = (osm_id, country_id, parent_id, population, _location(area, centroid, show_area))
+
+        return details
+
+
+    def place_parent(self, db, place_id):
+        osm_id, country_id, parent_id, population, admin_level, area, centroid = self._tables.places[place_id]
+
+        return parent_id, country_id, admin_level
+
+
+    def place_name(self, db, place_id, lang_ids):
+        names = self._tables.place_names.get(place_id, [])
+        for lang_id in lang_ids:
+            for name_lang_id, name in names:
+                if name_lang_id == lang_id:
+                    return name
+
+        # We couldn't find anything in the required languages.
+        if len(names) == 0:
+            return None
+        return names[0][1]
+
+
+    def find_postcodes(self, db, main, country_ids, sup, show_area):
+        pcs = []
+        for postcode_id, osm_id, country_id, parent_id, pc_main, pc_sup, area, centroid \
+          in self._tables.postcodes.get(main.lower(), []):
+            if country_ids is not None and country_id not in country_ids:
+                continue
+
+            if sup is None:
+                if pc_sup is not None:
+                    continue
+            elif sup is not Backend.ANY:
+                if pc_sup is None or pc_sup.lower() != sup.lower():
+                    continue
+
+            pcs.append((postcode_id, osm_id, country_id, pc_main, pc_sup, _location(area, centroid, show_area)))
+
+        return pcs
+
+
+    def postcode_parent(self, db, postcode_id):
+        return self._tables.postcode_parents[postcode_id]
+
+
+#
+# Write the database 'db' as a fixture to 'path'. If 'country_ids' is not None, only the places and
+# postcodes in those countries are written (the reference tables are always written in full).
+#
+
+def dump(db, path, country_ids=None):
+    type_rows, lang_rows, country_rows, country_name_rows = PG_Backend.PG_Backend().ref_rows(db)
+    fixture = {
+        "type": [list(row) for row in type_rows],
+        "lang": [list(row) for row in lang_rows],
+        "country": [list(row) for row in country_rows],
+        "country_name": [list(row[:3]) for row in country_name_rows],
+    }
+
+    if country_ids is None:
+        scope = ""
+    else:
+        scope = " AND country_id = ANY(%(country_ids)s)"
+        country_ids = list(country_ids)
+
+    c = db.cursor()
+    c.execute("SELECT place_id, osm_id, country_id, parent_id, population, admin_level, "
+              "ST_AsGeoJSON(location), ST_AsGeoJSON(ST_Centroid(location)) "
+              "FROM place WHERE TRUE" + scope + " ORDER BY place_id", dict(country_ids=country_ids))
+    fixture["place"] = [list(row) for row in c.fetchall()]
+
+    c.execute("SELECT place_id, lang_id, name FROM place_name "
+              "WHERE place_id IN (SELECT place_id FROM place WHERE TRUE" + scope + ") "
+              "ORDER BY place_id", dict(country_ids=country_ids))
+    fixture["place_name"] = [list(row) for row in c.fetchall()]
+
+    c.execute("SELECT postcode_id, osm_id, country_id, parent_id, main, sup, "
+              "ST_AsGeoJSON(location), ST_AsGeoJSON(ST_Centroid(location)) "
+              "FROM postcode WHERE TRUE" + scope + " ORDER BY postcode_id", dict(country_ids=country_ids))
+    fixture["postcode"] = [list(row) for row in c.fetchall()]
+
+    with open(path, "wt", encoding="UTF-8") as f:
+        json.dump(fixture, f)
+
+
+#
+# The indexes built from a fixture.
+#
+
+class _Tables:
+    def __init__(self, fixture):
+        self.type_rows = [tuple(row) for row in fixture.get("type", [])]
+        self.lang_rows = [tuple(row) for row in fixture.get("lang", [])]
+        self.country_rows = [tuple(row) for row in fixture.get("country", [])]
+        self.country_name_rows = [(country_id, lang_id, name, Free_Text.name_hash(name))
+                                  for country_id, lang_id, name in fixture.get("country_name", [])]
+
+        # place_id -> (osm_id, country_id, parent_id, population, admin_level, area, centroid)
+        self.places = {}
+        for row in fixture.get("place", []):
+            self.places[row[0]] = tuple(row[1:])
+
+        # place_id -> [(lang_id, name), ...] and name_hash -> [(place_id, name), ...]
+        self.place_names = {}
+        self.hashed_names = {}
+        for place_id, lang_id, name in fixture.get("place_name", []):
+            self.place_names.setdefault(place_id, []).append((lang_id, name))
+            self.hashed_names.setdefault(Free_Text.name_hash(name), []).append((place_id, name))
+
+        # lower case main part -> [postcode row, ...] and postcode_id -> parent_id
+        self.postcodes = {}
+        self.postcode_parents = {}
+        for row in sorted(fixture.get("postcode", []), key=lambda row: row[0]):
+            self.postcodes.setdefault(row[4].lower(), []).append(tuple(row))
+            self.postcode_parents[row[0]] = row[3]
+
+
+def _location(area, centroid, show_area):
+    if show_area and area is not None:
+        return area
+
+    return centroid
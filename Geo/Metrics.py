@@ -0,0 +1,318 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import bisect, threading, time
+
+
+#
+# Request latency metrics. For every request, fetegeos records how long the request took, how long
+# was spent in each phase of answering it (see PHASES), and how many SQL statements were executed
+# and rows fetched. These are accumulated into histograms, which can be exported in the Prometheus
+# text format (see exposition), and requests slower than a threshold are written to a slow query
+# log.
+#
+# Each request is timed by a Request_Timer, which is the "current" timer of the thread answering
+# the request (see current), so that code deep inside the engine can charge time to a phase without
+# the timer being passed around. Phases nest (e.g. postcodes are matched from within the place
+# matcher); a phase is only charged for the time spent in it, not in the phases within it, so the
+# phase times of a request add up to no more than its total time. Outside a request, current
+# returns NULL_TIMER, which records nothing.
+#
+# A request can also be traced: if a timer's 'trace' is a list rather than None, a dict is appended
+# to it for every SQL statement executed (see Request_Timer.sql), which can be sent back to the
+# client with the results.
+#
+
+# The phases of answering a request:
+#   parse     : Parsing the query's XML.
+#   ref       : Looking up languages and countries in the reference tables.
+#   country   : Matching the country (Free_Text._iter_country).
+#   places    : Matching places (Free_Text._iter_places).
+#   postcodes : Matching postcodes (Free_Text._iter_postcode).
+#   pp        : Naming and pretty printing the results.
+#   rank      : Filtering and ranking the results.
+#   serialize : Encoding the response.
+PHASES = ("parse", "ref", "country", "places", "postcodes", "pp", "rank", "serialize")
+
+QUERY_TYPES = ("geoquery", "batchquery", "countryquery", "statsquery")
+
+# The upper bounds, in seconds, of the histograms' buckets.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # counts[i] is the number of observations in (buckets[i - 1], buckets[i]]; the last count is
+        # for observations above every bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+
+    #
+    # Returns a list of (upper bound, cumulative count) pairs, ending with (None, count) for the
+    # "+Inf" bucket.
+    #
+
+    def cumulative(self):
+        cumulative = []
+        n = 0
+        for le, count in zip(list(self.buckets) + [None], self.counts):
+            n += count
+            cumulative.append((le, n))
+
+        return cumulative
+
+
+class Request_Timer:
+    def __init__(self, q_type):
+        self.q_type = q_type
+        self.started = time.perf_counter()
+        # Maps each phase entered to the seconds spent in it.
+        self.phases = {}
+        self.sql_statements = 0
+        self.sql_rows = 0
+        self.trace = None
+
+        self._stack = []
+        self._resumed = None # When the innermost phase was entered, or last resumed.
+
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        if len(self._stack) > 0:
+            self._charge(self._stack[-1], now)
+        self._stack.append(phase)
+        self._resumed = now
+
+
+    def leave(self):
+        now = time.perf_counter()
+        self._charge(self._stack.pop(), now)
+        self._resumed = now
+
+
+    def _charge(self, phase, now):
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._resumed
+
+
+    #
+    # Returns a context manager which times its body as 'phase'.
+    #
+
+    def phase(self, phase):
+        return _Phase(self, phase)
+
+
+    #
+    # Charge 'seconds' to 'phase', for time measured elsewhere.
+    #
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+    #
+    # Record that the statement 'name' was executed with the parameters 'params', starting at
+    # 'started' (as given by time.perf_counter) and returning 'rows' rows. 'prepared' is True if the
+    # statement had to be prepared first.
+    #
+
+    def sql(self, name, params, started, rows, prepared=False):
+        self.sql_statements += 1
+        self.sql_rows += rows
+        if self.trace is not None:
+            self.trace.append(dict(statement=name, params=dict(params), start_ms=(started - self.started) * 1000,
+                                   ms=(time.perf_counter() - started) * 1000, rows=rows, prepared=prepared))
+
+
+class _Phase:
+    def __init__(self, timer, phase):
+        self._timer = timer
+        self._phase = phase
+
+
+    def __enter__(self):
+        self._timer.enter(self._phase)
+
+
+    def __exit__(self, *exc):
+        self._timer.leave()
+
+
+class _Null_Timer(Request_Timer):
+    def __init__(self):
+        Request_Timer.__init__(self, None)
+
+
+    def enter(self, phase):
+        pass
+
+
+    def leave(self):
+        pass
+
+
+    def add(self, phase, seconds):
+        pass
+
+
+    def sql(self, name, params, started, rows, prepared=False):
+        pass
+
+
+NULL_TIMER = _Null_Timer()
+
+
+#
+# Returns the timer of the request being answered by this thread, or NULL_TIMER.
+#
+
+def current():
+    return getattr(_local, "timer", NULL_TIMER)
+
+
+#
+# Iterate over 'it', timing each step as 'phase' of 'timer'. This is how the phases of the
+# matcher, which are generators whose steps interleave, are timed.
+#
+
+def timed(timer, phase, it):
+    if timer is NULL_TIMER:
+        return it
+
+    return _timed(timer, phase, iter(it))
+
+
+def _timed(timer, phase, it):
+    while True:
+        timer.enter(phase)
+        try:
+            x = next(it)
+        except StopIteration:
+            return
+        finally:
+            timer.leave()
+        yield x
+
+
+#
+# The metrics of a server. If 'slow_threshold' is not None, requests taking at least that many
+# seconds are logged to 'slow_log' (a file-like object).
+#
+
+class Metrics:
+    def __init__(self, slow_threshold=None, slow_log=None, buckets=DEFAULT_BUCKETS):
+        self._slow_threshold = slow_threshold
+        self._slow_log = slow_log
+        self._lock = threading.Lock()
+        self._requests = dict([(q_type, Histogram(buckets)) for q_type in QUERY_TYPES + ("unknown",)])
+        self._phases = dict([(phase, Histogram(buckets)) for phase in PHASES])
+        self._sql_statements = 0
+        self._sql_rows = 0
+
+
+    #
+    # Start timing a request of type 'q_type' in this thread, returning its timer.
+    #
+
+    def start(self, q_type):
+        if q_type not in QUERY_TYPES:
+            # Don't let clients create arbitrary numbers of histograms.
+            q_type = "unknown"
+        timer = _local.timer = Request_Timer(q_type)
+
+        return timer
+
+
+    #
+    # Finish timing the request timed by 'timer' and record it. 'describe' is a function returning
+    # a description of the request (e.g. its query string and options) for the slow query log; it is
+    # only called if the request was slow.
+    #
+
+    def finish(self, timer, describe):
+        total = time.perf_counter() - timer.started
+        _local.timer = NULL_TIMER
+
+        with self._lock:
+            self._requests[timer.q_type].observe(total)
+            for phase, seconds in timer.phases.items():
+                self._phases[phase].observe(seconds)
+            self._sql_statements += timer.sql_statements
+            self._sql_rows += timer.sql_rows
+
+        if self._slow_threshold is not None and total >= self._slow_threshold and self._slow_log is not None:
+            phases = " ".join(["{0}={1:.1f}ms".format(phase, timer.phases[phase] * 1000)
+                               for phase in PHASES if phase in timer.phases])
+            self._slow_log.write("Slow query ({0:.1f}ms): {1} [{2} sql_statements={3} sql_rows={4}]\n".format(
+                                 total * 1000, describe(), phases, timer.sql_statements, timer.sql_rows))
+            self._slow_log.flush()
+
+
+    #
+    # Returns the metrics in the Prometheus text exposition format.
+    #
+
+    def exposition(self):
+        lines = []
+        with self._lock:
+            lines.append("# HELP fetegeo_request_seconds Time taken to answer a request, by query type.")
+            lines.append("# TYPE fetegeo_request_seconds histogram")
+            for q_type, histogram in sorted(self._requests.items()):
+                lines.extend(_histogram_lines("fetegeo_request_seconds", "type", q_type, histogram))
+
+            lines.append("# HELP fetegeo_phase_seconds Time spent in each phase of answering a request.")
+            lines.append("# TYPE fetegeo_phase_seconds histogram")
+            for phase in PHASES:
+                lines.extend(_histogram_lines("fetegeo_phase_seconds", "phase", phase, self._phases[phase]))
+
+            lines.append("# HELP fetegeo_sql_statements_total SQL statements executed while answering requests.")
+            lines.append("# TYPE fetegeo_sql_statements_total counter")
+            lines.append("fetegeo_sql_statements_total {0}".format(self._sql_statements))
+            lines.append("# HELP fetegeo_sql_rows_total Rows fetched while answering requests.")
+            lines.append("# TYPE fetegeo_sql_rows_total counter")
+            lines.append("fetegeo_sql_rows_total {0}".format(self._sql_rows))
+
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name, label, label_value, histogram):
+    lines = []
+    for le, n in histogram.cumulative():
+        if le is None:
+            le_txt = "+Inf"
+        else:
+            le_txt = repr(le)
+        lines.append('{0}_bucket{{{1}="{2}",le="{3}"}} {4}'.format(name, label, label_value, le_txt, n))
+    lines.append('{0}_sum{{{1}="{2}"}} {3!r}'.format(name, label, label_value, histogram.sum))
+    lines.append('{0}_count{{{1}="{2}"}} {3}'.format(name, label, label_value, histogram.count))
+
+    return lines
@@ -0,0 +1,372 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import itertools
+
+from .import Backend, Ref_Tables, Statements
+
+
+#
+# The PostgreSQL (with PostGIS) backend. All the statements run per query are prepared (see
+# Statements).
+#
+
+# The maximum number of values passed to a single statement.
+_CHUNK = 1000
+
+# The number of rows fetched at a time when reading whole tables.
+_FETCH_SIZE = 10000
+
+# Numbers the server-side cursors opened by iter_rows, whose names must be unique per connection.
+_cursor_ids = itertools.count()
+
+# How far up the tree the recursive statements go, in case the parents form a cycle.
+_MAX_DEPTH = 32
+
+# Values of find_postcodes's 'sup', as statement variants.
+_SUP_ANY = 0
+_SUP_NULL = 1
+_SUP_EQ = 2
+
+
+class PG_Backend(Backend.Backend):
+    def __init__(self):
+        self._materialized = False
+
+
+    #
+    # The place_ancestry and place_pp tables are built by import/ancestry.py; if they don't exist,
+    # ancestries are found with a recursive query and place_pps returns None.
+    #
+
+    def refresh(self, db):
+        c = db.cursor()
+        c.execute("SELECT to_regclass('place_ancestry') IS NOT NULL AND to_regclass('place_pp') IS NOT NULL")
+        self._materialized = bool(c.fetchone()[0])
+
+
+    def load_ref_tables(self, db):
+        return Ref_Tables.Ref_Tables(*self.ref_rows(db))
+
+
+    #
+    # Returns the rows needed to build a Ref_Tables (see Ref_Tables).
+    #
+
+    def ref_rows(self, db):
+        c = db.cursor()
+
+        c.execute("SELECT type_id, name FROM type")
+        type_rows = c.fetchall()
+
+        c.execute("SELECT lang_id, iso639_1, iso639_2 FROM lang")
+        lang_rows = c.fetchall()
+
+        c.execute("SELECT country_id, iso3166_2, iso3166_3, name FROM country")
+        country_rows = c.fetchall()
+
+        # Country names in every language, as stored in place_name against each country's place.
+        country_name_rows = []
+        for type_id, name in type_rows:
+            if name == "country":
+                c.execute(("SELECT place.country_id, place_name.lang_id, place_name.name, place_name.name_hash "
+                           "FROM place, place_name "
+                           "WHERE place_name.place_id=place.place_id "
+                           "AND place.type_id=%(type_id)s"
+                          ),
+                          dict(type_id=type_id))
+                country_name_rows = c.fetchall()
+
+        return type_rows, lang_rows, country_rows, country_name_rows
+
+
+    def iter_place_names(self, db):
+        return iter_rows(db, "SELECT place_name.place_id, place_name.name, place.country_id "
+                             "FROM place_name, place "
+                             "WHERE place_name.place_id=place.place_id")
+
+
+    def find_places(self, db, hashes, country_id, show_area):
+        hashes = list(hashes)
+        places = {}
+        for h in hashes:
+            places[h] = []
+        for i in range(0, len(hashes), _CHUNK):
+            c = Statements.execute(db, _sql_places, (show_area, country_id is not None),
+                                   dict(name_hashes=hashes[i:i + _CHUNK], country_id=country_id))
+            for row in c.fetchall():
+                places[row[0]].append(tuple(row[1:]))
+
+        return places
+
+
+    def place_details(self, db, place_ids, show_area):
+        place_ids = list(place_ids)
+        details = {}
+        for i in range(0, len(place_ids), _CHUNK):
+            c = Statements.execute(db, _sql_place_details, (show_area,), dict(place_ids=place_ids[i:i + _CHUNK]))
+            for row in c.fetchall():
+                details[row[0]] = tuple(row[1:])
+
+        return details
+
+
+    def place_parent(self, db, place_id):
+        c = Statements.execute(db, _sql_place_parent, (), dict(id=place_id))
+        assert c.rowcount == 1
+
+        return c.fetchone()
+
+
+    def place_name(self, db, place_id, lang_ids):
+        c = Statements.execute(db, _sql_place_name_in_langs, (), dict(place_id=place_id, lang_ids=list(lang_ids)))
+        if c.rowcount == 0:
+            # We couldn't find anything in the required languages.
+            c = Statements.execute(db, _sql_place_name, (), dict(place_id=place_id))
+
+        return c.fetchone()[0]
+
+
+    def find_postcodes(self, db, main, country_ids, sup, show_area):
+        if sup is Backend.ANY:
+            sup_mode = _SUP_ANY
+        elif sup is None:
+            sup_mode = _SUP_NULL
+        else:
+            sup_mode = _SUP_EQ
+
+        if country_ids is not None:
+            country_ids = list(country_ids)
+
+        c = Statements.execute(db, _sql_postcodes, (show_area, country_ids is not None, sup_mode),
+                               dict(main=main, country_ids=country_ids, sup=sup))
+
+        return c.fetchall()
+
+
+    def postcode_parent(self, db, postcode_id):
+        c = Statements.execute(db, _sql_postcode_parent, (), dict(id=postcode_id))
+
+        return c.fetchone()[0]
+
+
+    def place_ancestries(self, db, place_ids):
+        place_ids = list(place_ids)
+        ancestries = {}
+        for place_id in place_ids:
+            # Places without parents have no rows.
+            ancestries[place_id] = ()
+        for i in range(0, len(place_ids), _CHUNK):
+            c = Statements.execute(db, _sql_place_ancestries, (self._materialized,),
+                                   dict(place_ids=place_ids[i:i + _CHUNK]))
+            for place_id, ancestor_ids in c.fetchall():
+                ancestries[place_id] = tuple(ancestor_ids)
+
+        return ancestries
+
+
+    def place_chains(self, db, place_ids, lang_ids):
+        place_ids = list(place_ids)
+        chains = {}
+        for i in range(0, len(place_ids), _CHUNK):
+            c = Statements.execute(db, _sql_place_chains, (),
+                                   dict(place_ids=place_ids[i:i + _CHUNK], lang_ids=list(lang_ids)))
+            for row in c.fetchall():
+                chains.setdefault(row[0], []).append(tuple(row[1:]))
+
+        return chains
+
+
+    def postcode_parents(self, db, postcode_ids):
+        postcode_ids = list(postcode_ids)
+        parents = {}
+        for i in range(0, len(postcode_ids), _CHUNK):
+            c = Statements.execute(db, _sql_postcode_parents, (), dict(ids=postcode_ids[i:i + _CHUNK]))
+            parents.update(c.fetchall())
+
+        return parents
+
+
+    def place_pps(self, db, place_ids, lang_ids):
+        if not self._materialized:
+            return None
+
+        place_ids = list(place_ids)
+        names = {}
+        ancestries = {}
+        pps = {}
+        for i in range(0, len(place_ids), _CHUNK):
+            c = Statements.execute(db, _sql_place_pps, (),
+                                   dict(place_ids=place_ids[i:i + _CHUNK], lang_ids=list(lang_ids)))
+            for place_id, name, ancestor_ids, lang_id, pp in c.fetchall():
+                names[place_id] = name
+                ancestries[place_id] = tuple(ancestor_ids or ())
+                pps.setdefault(place_id, {})[lang_id] = pp
+
+        resolved = {}
+        for place_id, place_pps in pps.items():
+            for lang_id in list(lang_ids) + [None]:
+                if lang_id in place_pps:
+                    resolved[place_id] = (names[place_id], place_pps[lang_id], ancestries[place_id])
+                    break
+
+        return resolved
+
+
+#
+# Statements (see Statements.execute).
+#
+
+def _sql_places(show_area, scoped):
+    sql = ("SELECT DISTINCT ON (place_name.name_hash, place.place_id, place_name.name) "
+           "place_name.name_hash, place.place_id, place.osm_id, place_name.name, place.country_id, "
+           "place.parent_id, place.population, "
+           + Statements.location_printer("place.location", show_area) + " as location "
+           "FROM place, place_name "
+           "WHERE place_name.name_hash = ANY(%(name_hashes)s) "
+           "AND place.place_id=place_name.place_id"
+          )
+    if scoped:
+        sql += " AND place.country_id = %(country_id)s"
+
+    return sql
+
+
+def _sql_place_details(show_area):
+    return ("SELECT place_id, osm_id, country_id, parent_id, population, "
+            + Statements.location_printer("location", show_area) + " as location "
+            "FROM place "
+            "WHERE place_id = ANY(%(place_ids)s)"
+           )
+
+
+def _sql_place_parent():
+    return "SELECT parent_id, country_id, admin_level FROM place WHERE place_id=%(id)s"
+
+
+def _sql_place_name_in_langs():
+    return "SELECT name FROM place_name WHERE place_id=%(place_id)s AND lang_id = ANY(%(lang_ids)s)"
+
+
+def _sql_place_name():
+    return "SELECT name FROM place_name WHERE place_id=%(place_id)s"
+
+
+def _sql_postcodes(show_area, scoped, sup_mode):
+    sql = ("SELECT postcode_id, osm_id, country_id, main, sup, "
+           + Statements.location_printer("location", show_area) + " as location "
+           "FROM postcode "
+           "WHERE lower(main)=%(main)s"
+          )
+    if scoped:
+        sql += " AND country_id = ANY(%(country_ids)s)"
+    if sup_mode == _SUP_NULL:
+        sql += " AND sup IS NULL"
+    elif sup_mode == _SUP_EQ:
+        sql += " AND lower(sup)=%(sup)s"
+
+    return sql
+
+
+def _sql_postcode_parent():
+    return "SELECT parent_id FROM postcode WHERE postcode_id=%(id)s"
+
+
+def _sql_postcode_parents():
+    return "SELECT postcode_id, parent_id FROM postcode WHERE postcode_id = ANY(%(ids)s)"
+
+
+def _sql_place_ancestries(materialized):
+    if materialized:
+        return "SELECT place_id, ancestor_ids FROM place_ancestry WHERE place_id = ANY(%(place_ids)s)"
+
+    return ("WITH RECURSIVE chain(place_id, ancestor_id, depth) AS ("
+            "SELECT place_id, parent_id, 1 FROM place "
+            "WHERE place_id = ANY(%(place_ids)s) AND parent_id IS NOT NULL "
+            "UNION ALL "
+            "SELECT chain.place_id, place.parent_id, chain.depth + 1 FROM chain, place "
+            "WHERE place.place_id=chain.ancestor_id AND place.parent_id IS NOT NULL "
+            "AND chain.depth < {0}) "
+            "SELECT place_id, array_agg(ancestor_id ORDER BY depth) FROM chain GROUP BY place_id"
+           ).format(_MAX_DEPTH)
+
+
+#
+# Each place and its ancestors, nearest first, with the name of each chosen as by place_name.
+#
+
+def _sql_place_chains():
+    return ("WITH RECURSIVE chain(place_id, ancestor_id, depth) AS ("
+            "SELECT place_id, place_id, 0 FROM place WHERE place_id = ANY(%(place_ids)s) "
+            "UNION ALL "
+            "SELECT chain.place_id, place.parent_id, chain.depth + 1 FROM chain, place "
+            "WHERE place.place_id=chain.ancestor_id AND place.parent_id IS NOT NULL "
+            "AND chain.depth < {0}) "
+            "SELECT chain.place_id, chain.ancestor_id, place.country_id, place.admin_level, "
+            "(SELECT name FROM place_name WHERE place_name.place_id=chain.ancestor_id "
+            "ORDER BY COALESCE(place_name.lang_id = ANY(%(lang_ids)s), FALSE) DESC LIMIT 1) "
+            "FROM chain, place "
+            "WHERE place.place_id=chain.ancestor_id "
+            "ORDER BY chain.place_id, chain.depth"
+           ).format(_MAX_DEPTH)
+
+
+#
+# Each place's name (chosen as by place_name), its ancestors, and its pretty printed names in no
+# particular language and in each of the languages asked for that it has one in.
+#
+
+def _sql_place_pps():
+    return ("SELECT place.place_id, "
+            "(SELECT name FROM place_name WHERE place_name.place_id=place.place_id "
+            "ORDER BY COALESCE(place_name.lang_id = ANY(%(lang_ids)s), FALSE) DESC LIMIT 1), "
+            "place_ancestry.ancestor_ids, place_pp.lang_id, place_pp.pp "
+            "FROM place "
+            "JOIN place_pp ON place_pp.place_id=place.place_id "
+            "AND (place_pp.lang_id IS NULL OR place_pp.lang_id = ANY(%(lang_ids)s)) "
+            "LEFT JOIN place_ancestry ON place_ancestry.place_id=place.place_id "
+            "WHERE place.place_id = ANY(%(place_ids)s)")
+
+
+#
+# Yield the rows returned by 'sql', for reading whole tables. The rows are fetched _FETCH_SIZE at a
+# time through a named (server-side) cursor, since an ordinary psycopg2 cursor holds the whole
+# result in memory as soon as it's executed. Drivers without named cursors (e.g. pgdb) fall back to
+# an ordinary cursor. The cursor must be read to the end (or the generator closed) before 'db' is
+# committed.
+#
+
+def iter_rows(db, sql, params=None):
+    try:
+        c = db.cursor("fetegeo_rows_{0}".format(next(_cursor_ids)))
+    except TypeError:
+        c = db.cursor()
+    try:
+        c.execute(sql, params)
+        while True:
+            rows = c.fetchmany(_FETCH_SIZE)
+            if len(rows) == 0:
+                break
+
+            for row in rows:
+                yield row
+    finally:
+        c.close()
@@ -0,0 +1,108 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import sys
+from .import Free_Text
+
+
+#
+# An in-memory index of every place name, used instead of looking up name hashes in the database.
+# Names are split into words as Free_Text splits queries, and stored in a trie keyed on the words
+# in reverse order, so that walking a query leftwards from any word finds, in one pass, every place
+# whose name is a span of the query ending at that word.
+#
+# Each trie node is a dict mapping a word to the child node; the places whose name ends at a node
+# are stored under the key None, as a dict mapping a country ID to a tuple of place IDs, so that a
+# search can be restricted to a single country without walking a separate trie.
+#
+# The trie is built from an iterable of (place_id, name, country_id) tuples (see
+# Backend.iter_place_names). A Place_Trie is never modified once built; see Queryier.reload.
+#
+
+class Place_Trie:
+    def __init__(self, place_names):
+        self.names = 0 # The number of names indexed.
+        self.nodes = 1 # The number of nodes in the trie, including the root.
+
+        self._root = {}
+        for place_id, name, country_id in place_names:
+            self._add(place_id, name, country_id)
+
+        self._freeze()
+
+
+    def _add(self, place_id, name, country_id):
+        split, split_indices = Free_Text._split(name)
+        node = self._root
+        for wd in reversed(split):
+            child = node.get(wd)
+            if child is None:
+                child = node[sys.intern(wd)] = {}
+                self.nodes += 1
+            node = child
+
+        node.setdefault(None, {}).setdefault(country_id, []).append(place_id)
+        self.names += 1
+
+
+    #
+    # A place with several names (e.g. in different languages) which split into the same words is
+    # only recorded once at a node. The place ID lists are turned into tuples to save memory.
+    #
+
+    def _freeze(self):
+        todo = [self._root]
+        while len(todo) > 0:
+            node = todo.pop()
+            for wd, child in node.items():
+                if wd is None:
+                    for country_id, place_ids in child.items():
+                        child[country_id] = tuple(sorted(set(place_ids)))
+                else:
+                    todo.append(child)
+
+
+    #
+    # Returns a list of (j, place IDs) pairs for every span split[j:i + 1] which is the name of at
+    # least one place in the country 'country_id' (or in any country if 'country_id' is None).
+    #
+
+    def match_end(self, split, i, country_id):
+        matches = []
+        node = self._root
+        for j in range(i, -1, -1):
+            node = node.get(split[j])
+            if node is None:
+                break
+
+            ends = node.get(None)
+            if ends is None:
+                continue
+
+            if country_id is None:
+                place_ids = [place_id for country_place_ids in ends.values() for place_id in country_place_ids]
+            else:
+                place_ids = ends.get(country_id, ())
+
+            if len(place_ids) > 0:
+                matches.append((j, place_ids))
+
+        return matches
@@ -19,7 +19,8 @@
 # IN THE SOFTWARE.
 
 
-from .import Free_Text, Temp_Cache
+import copy, os, pickle, time
+from .import Free_Text, Place_Trie, Temp_Cache
 
 # Here we set a custom set of parents to be added to the pretty print.
 # http://wiki.openstreetmap.org/wiki/Tag:boundary%3Dadministrative might help choosing which levels we need for
@@ -27,160 +28,390 @@ from .import Free_Text, Temp_Cache
 _ADMIN_LEVELS = {"LU": (2, 6, 8), "GB": (2, 4, 6, 8)}
 _DEFAULT_LEVEL = (2, 4, 6, 8)
 
+# The Queryier's caches, as reported by stats.
+_CACHES = ("place_cache", "place_details_cache", "place_name_cache", "place_pp_cache", "parent_cache",
+           "results_cache", "response_cache")
+
+# The caches saved by dump_caches, and the version of the dump format.
+_DUMPED_CACHES = ("place_cache", "place_pp_cache", "place_name_cache", "results_cache")
+_DUMP_VERSION = 1
+
+
+#
+# The reference tables, the optional place trie and the caches, which are replaced together.
+#
+
+class _State:
+    def __init__(self, ref, place_trie, response_cache_bytes, response_cache_ttl):
+        self.ref = ref
+        self.place_trie = place_trie
+        self.place_cache = Temp_Cache.Striped_Cache(Temp_Cache.LARGE_CACHE_BYTES)
+        self.place_details_cache = Temp_Cache.Striped_Cache(Temp_Cache.LARGE_CACHE_BYTES)
+        self.place_name_cache = Temp_Cache.Striped_Cache(Temp_Cache.SMALL_CACHE_BYTES)
+        self.place_pp_cache = Temp_Cache.Striped_Cache(Temp_Cache.SMALL_CACHE_BYTES)
+        # Maps a place ID to a tuple of its ancestors' IDs.
+        self.parent_cache = Temp_Cache.Striped_Cache(Temp_Cache.SMALL_CACHE_BYTES)
+        self.results_cache = Temp_Cache.Striped_Cache(Temp_Cache.LARGE_CACHE_BYTES)
+        # The response cache maps a query, as received, to the encoded body of its response (see
+        # get_response), so that repeated queries can be answered without looking at Result objects
+        # or the database. A budget of 0 disables it.
+        if response_cache_bytes > 0:
+            self.response_cache = Temp_Cache.Striped_Cache(response_cache_bytes, response_cache_ttl)
+        else:
+            self.response_cache = None
+
+
+def _state_attr(name):
+    return property(lambda self: getattr(self._state, name))
+
+
+#
+# The Queryier holds everything shared between queries: the backend through which the data is read
+# (see Backend), the reference tables, the optional place trie and the caches.
+#
+# The reference tables, place trie and caches are held in a _State, which reload and flush_caches
+# replace in one go, so a query never sees the reference tables of one load with the caches of
+# another. A query which may overlap a reload should be run on a pinned Queryier (see pinned), so
+# that it reads, and caches its results in, the same _State throughout.
+#
 
 class Queryier:
-    def __init__(self):
-        self.flush_caches()
+    ref = _state_attr("ref")
+    place_trie = _state_attr("place_trie")
+    place_cache = _state_attr("place_cache")
+    place_details_cache = _state_attr("place_details_cache")
+    place_name_cache = _state_attr("place_name_cache")
+    place_pp_cache = _state_attr("place_pp_cache")
+    parent_cache = _state_attr("parent_cache")
+    results_cache = _state_attr("results_cache")
+    response_cache = _state_attr("response_cache")
+
+
+    def __init__(self, backend, response_cache_bytes=Temp_Cache.SMALL_CACHE_BYTES, use_place_trie=False,
+                 response_cache_ttl=None):
+        self.backend = backend
+        self._response_cache_bytes = response_cache_bytes
+        self._response_cache_ttl = response_cache_ttl
+        self._use_place_trie = use_place_trie
+        self._state = self._mk_state(None, None)
+
+
+    def _mk_state(self, ref, place_trie):
+        return _State(ref, place_trie, self._response_cache_bytes, self._response_cache_ttl)
+
+
+    #
+    # (Re)load the reference tables, and the place trie if it's in use, from the backend ('db' is
+    # a connection if the backend uses one). Since the cached results embed IDs and names from the
+    # reference tables, the caches are replaced too.
+    #
+
+    def reload(self, db):
+        self.backend.refresh(db)
+        ref = self.backend.load_ref_tables(db)
+        if self._use_place_trie:
+            place_trie = Place_Trie.Place_Trie(self.backend.iter_place_names(db))
+        else:
+            place_trie = None
+        self._state = self._mk_state(ref, place_trie)
+
+
+    #
+    # Returns a Queryier which keeps using this one's current reference tables, place trie and
+    # caches even if this one is reloaded or flushed.
+    #
+
+    def pinned(self):
+        return copy.copy(self)
+
+
+    #
+    # Returns a Queryier sharing this one's backend, reference tables and place trie, but with empty
+    # caches of its own, so that queries can be run in isolation (e.g. to count the SQL statements
+    # they need) without reloading anything.
+    #
+
+    def uncached_copy(self):
+        queryier = copy.copy(self)
+        queryier._state = self._mk_state(self.ref, self.place_trie)
+
+        return queryier
 
 
     def flush_caches(self):
-        self.country_id_iso2_cache = {} # These are both too small
-        self.country_iso2_id_cache = {} # to bother with a cached dict.
-        self.country_name_cache = {}
-        self.place_cache = Temp_Cache.Cached_Dict(Temp_Cache.LARGE_CACHE_SIZE)
-        self.place_name_cache = Temp_Cache.Cached_Dict(Temp_Cache.LARGE_CACHE_SIZE)
-        self.place_pp_cache = Temp_Cache.Cached_Dict(Temp_Cache.LARGE_CACHE_SIZE)
-        self.parent_cache = Temp_Cache.Cached_Dict(Temp_Cache.LARGE_CACHE_SIZE)
-        self.results_cache = Temp_Cache.Cached_Dict(Temp_Cache.SMALL_CACHE_SIZE)
+        self._state = self._mk_state(self.ref, self.place_trie)
+
+
+    #
+    # Save the contents of the caches in _DUMPED_CACHES to 'path', so that a restarted server can
+    # start with warm caches (see load_caches). The dump is written to a temporary file which is then
+    # renamed, so a server starting up never sees a partial dump.
+    #
+
+    def dump_caches(self, path):
+        caches = dict([(name, getattr(self, name).items()) for name in _DUMPED_CACHES])
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((_DUMP_VERSION, self._dump_id(), time.time(), caches), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+    #
+    # Fill the caches from the dump at 'path' (see dump_caches), returning the number of entries
+    # loaded, or None if the dump was ignored because it's older than 'max_age' seconds or was made
+    # from different data. Since the dump is unpickled, 'path' must only be writable by trusted users.
+    #
+
+    def load_caches(self, path, max_age=None):
+        with open(path, "rb") as f:
+            version, dump_id, saved, caches = pickle.load(f)
+
+        if version != _DUMP_VERSION or dump_id != self._dump_id() \
+          or (max_age is not None and time.time() - saved > max_age):
+            return None
+
+        n = 0
+        for name in _DUMPED_CACHES:
+            cache = getattr(self, name)
+            # Hottest first, so store them in reverse order (see Temp_Cache.Striped_Cache.items).
+            for k, v in reversed(caches.get(name, [])):
+                cache[k] = v
+                n += 1
+
+        return n
+
+
+    #
+    # Cached results embed IDs and names from the data, which has no version of its own, so a dump is
+    # only trusted if it was made from the same kind of backend with the same reference tables. A
+    # re-imported database with the same reference tables isn't detected (see max_age in
+    # load_caches).
+    #
+
+    def _dump_id(self):
+        ref_stats = self.ref.stats()
+
+        return (type(self.backend).__name__, ref_stats["entries"], ref_stats["bytes"])
 
 
     def name_to_lat_long(self, db, lang_ids, find_all, allow_dangling, show_area, qs, host_country_id):
-        return Free_Text.Free_Text().name_to_lat_long(self, db, lang_ids, find_all, allow_dangling, show_area,
-                                                      qs, host_country_id)
+        return Free_Text.Free_Text().name_to_lat_long(self.pinned(), db, lang_ids, find_all, allow_dangling,
+                                                      show_area, qs, host_country_id)
 
 
     #
-    # Convenience methods
+    # Return the cached (body, number of results) for the query with key 'key', or None if there
+    # isn't one. Keys are built by the server from the query as received, including the response
+    # format.
+    #
+
+    def get_response(self, key):
+        if self.response_cache is None:
+            return None
+
+        return self.response_cache.get(key)
+
+
+    def cache_response(self, key, body, n):
+        if self.response_cache is not None:
+            self.response_cache[key] = (body, n)
+
+
+    #
+    # Returns a dict mapping the name of each cache (see Temp_Cache) to its statistics. The
+    # reference tables, which are held in full rather than cached, are reported as "ref_tables",
+    # with only their entries and bytes. Counts are since the caches were last flushed.
     #
 
-    def mk_cols_map(self, c):
-        map = {}
-        i = 0
-        for col in c.description:
-            assert col[0] not in map
-            map[col[0]] = i
-            i += 1
+    def stats(self):
+        stats = {}
+        for name in _CACHES:
+            cache = getattr(self, name)
+            if cache is not None:
+                stats[name] = cache.stats()
+        if self.ref is not None:
+            stats["ref_tables"] = self.ref.stats()
 
-        return map
+        return stats
 
 
+    #
+    # Look up every query string in 'qss' with the same options, returning a list of results for each
+    # query string. Query strings which are identical once normalised are only looked up once, and
+    # the places that could match any query string are fetched in bulk before matching starts.
+    #
+
+    def batch_name_to_lat_long(self, db, lang_ids, find_all, allow_dangling, show_area, qss, host_country_id):
+        queryier = self.pinned()
+        cleaned = [Free_Text._cleanup(qs) for qs in qss]
+        unique = list(dict.fromkeys(cleaned))
+
+        if queryier.place_trie is None:
+            hashes = set()
+            for qs in unique:
+                hashes.update(Free_Text.span_hashes(qs))
+            Free_Text.prefetch_places(queryier, db, hashes, show_area)
+
+        results = {}
+        for qs in unique:
+            results[qs] = queryier.name_to_lat_long(db, lang_ids, find_all, allow_dangling, show_area, qs,
+                                                    host_country_id)
+
+        return [results[qs] for qs in cleaned]
+
+
+    #
+    # Convenience methods
+    #
+
     def get_country_id_from_iso2(self, ft, iso2):
         if not iso2:
             return None
 
-        if iso2 not in self.country_id_iso2_cache:
-            c = ft.db.cursor()
-            c.execute("SELECT country_id FROM country WHERE iso3166_2=%(iso2)s", dict(iso2=iso2))
-            assert c.rowcount == 1
-            self.country_id_iso2_cache[iso2] = c.fetchone()[0]
-
-        return self.country_id_iso2_cache[iso2]
+        return self.ref.get_country_id(iso2)
 
 
     def get_country_iso2_from_id(self, ft, country_id):
         if not country_id:
             return None
 
-        if country_id not in self.country_iso2_id_cache:
-            c = ft.db.cursor()
-            c.execute("SELECT iso3166_2 FROM country WHERE country_id=%(id)s", dict(id=country_id))
-            assert c.rowcount == 1
-            self.country_iso2_id_cache[country_id] = c.fetchone()[0]
-
-        return self.country_iso2_id_cache[country_id]
+        return self.ref.get_country_iso2(country_id)
 
 
     def country_name_id(self, ft, country_id):
         if not country_id:
             return None
 
-        cache_key = (ft.lang_ids[0], country_id)
-        if cache_key in self.country_name_cache:
-            return self.country_name_cache[cache_key]
+        return self.ref.get_country_name(country_id, ft.lang_ids)
 
-        c = ft.db.cursor()
 
-        c.execute(("SELECT place_name.name "
-                   "FROM place_name, place "
-                   "WHERE place.place_id=place_name.place_id "
-                   "AND place.country_id=%(country_id)s "
-                   "AND place_name.lang_id IN %(lang_id)s "
-                   "AND place.type_id=%(type_id)s"
-                      ),
-                  dict(country_id=country_id, lang_id=tuple(ft.lang_ids), type_id=self.get_type_id(ft.db, "country")))
+    def get_type_id(self, type):
+        return self.ref.get_type_id(type)
 
-        if c.rowcount < 1:
-            c.execute("SELECT name FROM country WHERE country_id=%(country_id)s", dict(country_id=country_id))
 
-        name = c.fetchone()[0]
+    #
+    # Return a dict mapping each of 'postcode_ids' to its parent place ID (or None).
+    #
 
-        self.country_name_cache[cache_key] = name
+    def postcode_parent_ids(self, ft, postcode_ids):
+        if len(postcode_ids) == 0:
+            return {}
 
-        return name
+        return self.backend.postcode_parents(ft.db, postcode_ids)
 
-    def get_type_id(self, db, type):
-        c = db.cursor()
-        c.execute("SELECT type_id FROM type WHERE name=%(type)s", dict(type=type))
-        if c.rowcount == 1:
-            return c.fetchone()[0]
-        return None
 
+    #
+    # Return a tuple of the IDs of the ancestors of 'place_id'.
+    #
 
-    def name_place_id(self, ft, place_id):
-        cache_key = (tuple(ft.lang_ids), ft.host_country_id, place_id)
-        if self.place_name_cache.has_key(cache_key):
-            return self.place_name_cache[cache_key]
+    def place_ancestors(self, ft, place_id):
+        return self.parent_cache.get_or_compute(place_id,
+                                                lambda: self.backend.place_ancestries(ft.db, [place_id])[place_id])
+
+
+    #
+    # Put the ancestors of each of 'place_ids' in the parent cache, looking up those not already
+    # cached in one go.
+    #
+
+    def prefetch_ancestors(self, ft, place_ids):
+        todo = [place_id for place_id in set(place_ids) if not self.parent_cache.has_key(place_id)]
+        if len(todo) == 0:
+            return
+
+        for place_id, ancestors in self.backend.place_ancestries(ft.db, todo).items():
+            self.parent_cache[place_id] = ancestors
+
+
+    #
+    # Put the name and pretty printed name of each of 'place_ids' (see name_place_id and
+    # pp_place_id), and its ancestors, in the caches, looking up those not already cached in one go.
+    # This is used to resolve every result of a query together once matching has finished.
+    #
 
-        c = ft.db.cursor()
+    def resolve_places(self, ft, place_ids):
+        todo = [place_id for place_id in set(place_ids)
+                if not self.place_pp_cache.has_key((tuple(ft.lang_ids), ft.host_country_id, place_id))
+                or not self.place_name_cache.has_key((tuple(ft.lang_ids), ft.host_country_id, place_id))]
+        if len(todo) > 0:
+            self._resolve_places(ft, todo)
 
-        c.execute("SELECT name FROM place_name WHERE place_id=%(place_id)s AND lang_id IN %(lang_id)s",
-                  dict(place_id=place_id, lang_id=tuple(ft.lang_ids)))
 
-        if c.rowcount > 0:
-            name = c.fetchone()[0]
+    #
+    # Look up the (name, pp, ancestors) of each of 'place_ids', caching and returning them as a dict.
+    #
+
+    def _resolve_places(self, ft, place_ids):
+        # If the backend stores pretty printed names (see import/ancestry.py), they're looked up
+        # directly; otherwise (or for places it has none for) they're built from each place's chain
+        # of ancestors.
+        resolved = self.backend.place_pps(ft.db, place_ids, ft.lang_ids) or {}
+        todo = [place_id for place_id in place_ids if place_id not in resolved]
+        if len(todo) > 0:
+            for place_id, chain in self.backend.place_chains(ft.db, todo, ft.lang_ids).items():
+                _, country_id, _, name = chain[0]
+                format = pp_levels(self.get_country_iso2_from_id(ft, country_id))
+                pp = name
+                for parent_id, _, admin_level, parent_name in chain[1:]:
+                    if admin_level in format:
+                        pp = "{0}, {1}".format(pp, parent_name)
+                resolved[place_id] = (name, pp, tuple([parent_id for parent_id, _, _, _ in chain[1:]]))
+
+        for place_id, (name, pp, ancestors) in resolved.items():
+            cache_key = (tuple(ft.lang_ids), ft.host_country_id, place_id)
             self.place_name_cache[cache_key] = name
-            return name
+            self.place_pp_cache[cache_key] = pp
+            self.parent_cache[place_id] = ancestors
 
-        # We couldn't find anything in the required languages.
+        return resolved
 
-        c.execute("SELECT name FROM place_name WHERE place_id=%(place_id)s", dict(place_id=place_id))
 
-        name = c.fetchone()[0]
-        self.place_name_cache[cache_key] = name
+    #
+    # Return a dict mapping each of 'place_ids' to a (osm_id, country_id, parent_id, population,
+    # location) tuple. Places not already cached are looked up in one go.
+    #
 
-        return name
+    def place_details(self, ft, place_ids):
+        details = {}
+        todo = []
+        for place_id in place_ids:
+            place_details = self.place_details_cache.get((place_id, ft.show_area))
+            if place_details is None:
+                todo.append(place_id)
+            else:
+                details[place_id] = place_details
 
+        if len(todo) > 0:
+            for place_id, place_details in self.backend.place_details(ft.db, todo, ft.show_area).items():
+                details[place_id] = place_details
+                self.place_details_cache[(place_id, ft.show_area)] = place_details
 
-    def pp_place_id(self, ft, place_id):
-        cache_key = (tuple(ft.lang_ids), ft.host_country_id, place_id)
-        if self.place_pp_cache.has_key(cache_key):
-            return self.place_pp_cache[cache_key]
+        return details
 
-        c = ft.db.cursor()
 
-        pp = self.name_place_id(ft, place_id)
+    def name_place_id(self, ft, place_id):
+        return self.place_name_cache.get_or_compute((tuple(ft.lang_ids), ft.host_country_id, place_id),
+                                                    lambda: self._resolve_places(ft, [place_id])[place_id][0])
 
-        c.execute("SELECT parent_id, country_id, admin_level from place WHERE place_id=%(id)s", dict(id=place_id))
-        assert c.rowcount == 1
 
-        parent_id, country_id, admin_level = c.fetchone()
+    #
+    # Return the pretty printed name of 'place_id': its name followed by the names of those of its
+    # ancestors whose admin levels are shown for its country (see pp_levels).
+    #
 
-        iso2 = self.get_country_iso2_from_id(ft, country_id)
-        if iso2 in _ADMIN_LEVELS:
-            format = _ADMIN_LEVELS[iso2]
-        else:
-            format = _DEFAULT_LEVEL
+    def pp_place_id(self, ft, place_id):
+        return self.place_pp_cache.get_or_compute((tuple(ft.lang_ids), ft.host_country_id, place_id),
+                                                  lambda: self._resolve_places(ft, [place_id])[place_id][1])
 
-        while parent_id is not None:
-            c.execute("SELECT parent_id, admin_level from place WHERE place_id=%(id)s", dict(id=parent_id))
-            new_parent_id, admin_level = c.fetchone()
-            assert(new_parent_id != parent_id)
 
-            if admin_level in format:
-                pp = "{0}, {1}".format(pp, self.name_place_id(ft, parent_id))
+#
+# Return the admin levels of the ancestors shown in the pretty printed names of places in the
+# country 'iso2'.
+#
 
-            parent_id = new_parent_id
+def pp_levels(iso2):
+    if iso2 in _ADMIN_LEVELS:
+        return _ADMIN_LEVELS[iso2]
 
-        self.place_pp_cache[cache_key] = pp
+    return _DEFAULT_LEVEL
 
-        return pp
\ No newline at end of file
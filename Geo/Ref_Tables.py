@@ -0,0 +1,140 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import types
+
+from .import Temp_Cache
+
+
+#
+# The reference tables (country, lang, type and the names of countries) are small and rarely
+# change, but are consulted several times by every query. Ref_Tables is built from the tables' rows,
+# loaded in one go by a backend (see Backend.load_ref_tables), and answers lookups from memory. A
+# Ref_Tables is never modified once built: to pick up changes, a new one is loaded and swapped in
+# (see Queryier.reload).
+#
+# The rows are given as (type_id, name), (lang_id, iso639_1, iso639_2), (country_id, iso3166_2,
+# iso3166_3, name) and, for the names of countries in every language, (country_id, lang_id, name,
+# name_hash) tuples.
+#
+# All ISO codes are looked up in upper case.
+#
+
+class Ref_Tables:
+    def __init__(self, type_rows, lang_rows, country_rows, country_name_rows):
+        type_ids = {}
+        for type_id, name in type_rows:
+            type_ids[name] = type_id
+        self._type_ids = types.MappingProxyType(type_ids)
+
+        lang_ids = {}
+        for lang_id, iso639_1, iso639_2 in lang_rows:
+            # Some languages have more than one ID, and a code may be both an ISO 639-1 and an
+            # ISO 639-2 code; each ID appears only once for a given code.
+            for iso639 in set([iso639_1, iso639_2]):
+                if iso639:
+                    ids = lang_ids.setdefault(iso639.upper(), [])
+                    if lang_id not in ids:
+                        ids.append(lang_id)
+        self._lang_ids = types.MappingProxyType(dict([(k, tuple(v)) for k, v in lang_ids.items()]))
+
+        country_ids = {}
+        country_iso2s = {}
+        default_names = {}
+        for country_id, iso2, iso3, name in country_rows:
+            if iso2:
+                country_ids[iso2.upper()] = country_id
+            if iso3:
+                country_ids.setdefault(iso3.upper(), country_id)
+            country_iso2s[country_id] = iso2
+            default_names[country_id] = name
+        self._country_ids = types.MappingProxyType(country_ids)
+        self._country_iso2s = types.MappingProxyType(country_iso2s)
+        self._default_names = types.MappingProxyType(default_names)
+
+        country_names_by_lang = {}
+        names_by_hash = {}
+        for country_id, lang_id, name, name_hash in country_name_rows:
+            country_names_by_lang.setdefault((country_id, lang_id), name)
+            names_by_hash.setdefault(name_hash, []).append((country_id, name))
+        self._country_names = types.MappingProxyType(country_names_by_lang)
+        self._names_by_hash = types.MappingProxyType(dict([(k, tuple(v)) for k, v in names_by_hash.items()]))
+
+
+    def get_type_id(self, type):
+        return self._type_ids.get(type)
+
+
+    #
+    # Returns a tuple of the lang IDs for the ISO 639-1 or 639-2 code 'iso639', which is empty if
+    # the code is unknown.
+    #
+
+    def get_lang_ids(self, iso639):
+        return self._lang_ids.get(iso639.upper(), ())
+
+
+    #
+    # Returns the country ID for the ISO 3166-1 alpha 2 or alpha 3 code 'iso', or None.
+    #
+
+    def get_country_id(self, iso):
+        return self._country_ids.get(iso.upper())
+
+
+    def get_country_iso2(self, country_id):
+        return self._country_iso2s.get(country_id)
+
+
+    #
+    # Returns the name of 'country_id' in the first of 'lang_ids' which it has a name in, falling
+    # back on the country table's name.
+    #
+
+    def get_country_name(self, country_id, lang_ids):
+        for lang_id in lang_ids:
+            name = self._country_names.get((country_id, lang_id))
+            if name is not None:
+                return name
+
+        return self._default_names.get(country_id)
+
+
+    #
+    # Returns a sequence of (country_id, name) pairs for the country names (in any language) whose
+    # place_name.name_hash is 'name_hash'.
+    #
+
+    def get_country_names_by_hash(self, name_hash):
+        return self._names_by_hash.get(name_hash, ())
+
+
+    #
+    # Returns a dict of the number of entries in all the tables and an estimate of the bytes they
+    # take up.
+    #
+
+    def stats(self):
+        tables = (self._type_ids, self._lang_ids, self._country_ids, self._country_iso2s, self._default_names,
+                  self._country_names, self._names_by_hash)
+
+        return dict(entries=sum([len(t) for t in tables]),
+                    bytes=sum([Temp_Cache.sizeof(dict(t)) for t in tables]))
@@ -19,10 +19,58 @@
 # IN THE SOFTWARE.
 
 
+import json, struct, xml.sax.saxutils as saxutils
+
+
+#
+# Results can be encoded in several formats, chosen per query:
+#
+#   xml  : The original XML format.
+#   json : Compact JSON, with one response per line.
+#   bin  : A binary format, where each response is a length-prefixed frame (see encode_results).
+#
+# Since results are cached and reused across queries, each Result caches its encoded form in each
+# format the first time it is needed.
+#
+
+FORMATS = ("xml", "json", "bin")
+DEFAULT_FORMAT = "xml"
+
+# The names of results' fields as printed for people (e.g. by fetegeoc).
+TAG_LONG_NAMES = {"dangling": "Dangling text", "place": "Place", "id": "ID", "name": "Name",
+                  "location": "Location", "country_id": "Country ID", "parent_id": "Parent ID",
+                  "population": "Population", "pp": "PP", "osm_id": "OSM ID"}
+
+# Binary frames start with a (kind, payload length) header.
+BIN_HEADER = struct.Struct("!BI")
+BIN_RESULTS = 0
+BIN_BATCH_RESULTS = 1
+BIN_ERROR = 2
+BIN_COUNTRY = 3
+BIN_STATS = 4
+BIN_TRACED_RESULTS = 5
+
+# The sections of a stats response, each mapped to the tag of its entries in XML.
+STATS_SECTIONS = {"caches": "cache", "statements": "statement"}
+
+_BIN_COUNT = struct.Struct("!I")
+_BIN_STR_LEN = struct.Struct("!I")
+_BIN_INTS = struct.Struct("!Bqqqqq")
+_BIN_PLACE = b"P"
+_BIN_POSTCODE = b"C"
+_PLACE_INTS = ("id", "osm_id", "country_id", "parent_id", "population")
+_PLACE_STRS = ("name", "location", "pp")
+_PLACE_FIELDS = ("id", "osm_id", "name", "location", "country_id", "parent_id", "population", "pp")
+_POSTCODE_INTS = ("id", "osm_id", "country_id")
+_POSTCODE_STRS = ("location", "pp")
+_POSTCODE_FIELDS = ("id", "osm_id", "country_id", "location", "pp")
+
+
 class Result:
     def __init__(self, ri, dangling):
         self.ri = ri
         self.dangling = dangling
+        self._encoded = {}
 
 
     def to_xml(self):
@@ -33,6 +81,37 @@ class Result:
             ).format(self.ri.to_xml(), self.dangling)
 
 
+    def to_json(self):
+        return {self.ri.TAG: self.ri.to_json(), "dangling": self.dangling}
+
+
+    def to_bin(self):
+        return self.ri.to_bin() + _bin_str(self.dangling)
+
+
+    #
+    # Return this result encoded in the format 'fmt' as bytes.
+    #
+
+    def encode(self, fmt):
+        try:
+            return self._encoded[fmt]
+        except KeyError:
+            pass
+
+        if fmt == "xml":
+            e = bytes(self.to_xml(), 'UTF-8')
+        elif fmt == "json":
+            e = bytes(json.dumps(self.to_json(), separators=(",", ":")), 'UTF-8')
+        else:
+            assert fmt == "bin"
+            e = self.to_bin()
+            e = _BIN_COUNT.pack(len(e)) + e
+        self._encoded[fmt] = e
+
+        return e
+
+
 class RCountry:
     def __init__(self, id, name, pp):
         self.id = id
@@ -50,6 +129,8 @@ class RCountry:
 
 
 class RPlace:
+    TAG = "place"
+
     def __init__(self, id, osm_id, name, location, country_id, parent_id, population, pp):
         self.id = id
         self.osm_id = osm_id
@@ -85,7 +166,19 @@ class RPlace:
                      parent_id=parent_id_txt, population=population_txt, pp=self.pp)
 
 
+    def to_json(self):
+        return dict(id=self.id, osm_id=self.osm_id, name=self.name, location=self.location, country_id=self.country_id,
+                    parent_id=self.parent_id, population=self.population, pp=self.pp)
+
+
+    def to_bin(self):
+        return _BIN_PLACE + _bin_ints(self.id, self.osm_id, self.country_id, self.parent_id, self.population) \
+               + _bin_str(self.name) + _bin_str(self.location) + _bin_str(self.pp)
+
+
 class RPost_Code:
+    TAG = "postcode"
+
     def __init__(self, id, osm_id, country_id, location, pp):
         self.id = id
         self.osm_id = osm_id
@@ -103,4 +196,293 @@ class RPost_Code:
                 "<location>{location}</location>"
                 "<pp>{pp}</pp>"
                 "</postcode>"
-            ).format(id=self.id, country_id=self.country_id, location=self.location, pp=self.pp, osm_id=self.osm_id)
\ No newline at end of file
+            ).format(id=self.id, country_id=self.country_id, location=self.location, pp=self.pp, osm_id=self.osm_id)
+
+
+    def to_json(self):
+        return dict(id=self.id, osm_id=self.osm_id, country_id=self.country_id, location=self.location, pp=self.pp)
+
+
+    def to_bin(self):
+        return _BIN_POSTCODE + _bin_ints(self.id, self.osm_id, self.country_id, None, None) \
+               + _bin_str(self.location) + _bin_str(self.pp)
+
+
+#
+# Encode a complete response to a query, in the format 'fmt'. 'q_id' is the id of the query, or
+# None.
+#
+
+def encode_results(results, fmt, q_id):
+    return encode_response(encode_results_body(results, fmt), len(results), fmt, q_id)
+
+
+#
+# Encode the body of a results response, which does not depend on the query's id; this is what
+# the response cache stores. encode_response wraps a body in the envelope for a given id.
+#
+
+def encode_results_body(results, fmt):
+    if fmt == "json":
+        sep = b","
+    else:
+        sep = b""
+
+    return sep.join([r.encode(fmt) for r in results])
+
+
+def encode_batch_results(all_results, fmt, q_id):
+    if fmt == "xml":
+        body = b"".join([b"<results>" + b"".join([r.encode(fmt) for r in results]) + b"</results>"
+                         for results in all_results])
+        return _xml_doc("batchresults", q_id, body)
+    elif fmt == "json":
+        body = b",".join([b"[" + b",".join([r.encode(fmt) for r in results]) + b"]" for results in all_results])
+        return _json_doc("batchresults", q_id, body)
+    else:
+        body = b"".join([_BIN_COUNT.pack(len(results)) + b"".join([r.encode(fmt) for r in results])
+                         for results in all_results])
+        return _bin_frame(BIN_BATCH_RESULTS, q_id, len(all_results), body)
+
+
+#
+# Encode the response to a country query; 'name' is None if no country matched.
+#
+
+def encode_country(name, fmt, q_id):
+    if fmt == "xml":
+        if name is None:
+            return _xml_doc("result", q_id, b"")
+        return _xml_doc("result", q_id, bytes("<country><name>{0}</name></country>".format(saxutils.escape(name)),
+                                              'UTF-8'))
+    elif fmt == "json":
+        if name is None:
+            return _json_line(dict(id=q_id, country=None))
+        return _json_line(dict(id=q_id, country=dict(name=name)))
+    else:
+        if name is None:
+            return _bin_frame(BIN_COUNTRY, q_id, 0, b"")
+        return _bin_frame(BIN_COUNTRY, q_id, 1, _bin_str(name))
+
+
+#
+# Encode the response to a stats query. 'stats' maps each of STATS_SECTIONS to a dict mapping names
+# (e.g. of caches) to dicts of integer counters. In the bin format, the stats are sent as a single
+# JSON string, since they are small and rarely asked for.
+#
+
+def encode_stats(stats, fmt, q_id):
+    if fmt == "xml":
+        body = []
+        for section, tag in sorted(STATS_SECTIONS.items()):
+            body.append("<{0}>".format(section))
+            for name, counters in sorted(stats.get(section, {}).items()):
+                body.append("<{0} name={1}>".format(tag, saxutils.quoteattr(name)))
+                body.extend(["<{0}>{1}</{0}>".format(k, v) for k, v in sorted(counters.items())])
+                body.append("</{0}>".format(tag))
+            body.append("</{0}>".format(section))
+        return _xml_doc("stats", q_id, bytes("".join(body), 'UTF-8'))
+    elif fmt == "json":
+        return _json_line(dict(id=q_id, stats=stats))
+    else:
+        return _bin_frame(BIN_STATS, q_id, 1, _bin_str(json.dumps(stats, separators=(",", ":"))))
+
+
+#
+# Wrap the results body 'body' (holding 'n' results) in the envelope of a response. If 'trace' is
+# not None, it is a list of the SQL statements executed for the query (see Metrics.Request_Timer),
+# which is sent after the results: as a <trace> element in XML, a "trace" key in JSON, and a JSON
+# string in the bin format (in a BIN_TRACED_RESULTS frame).
+#
+
+def encode_response(body, n, fmt, q_id, trace=None):
+    if fmt == "xml":
+        if trace is not None:
+            body += _xml_trace(trace)
+        return _xml_doc("results", q_id, body)
+    elif fmt == "json":
+        if trace is None:
+            return _json_doc("results", q_id, body)
+        return _json_doc("results", q_id, body, dict(trace=trace))
+    else:
+        if trace is None:
+            return _bin_frame(BIN_RESULTS, q_id, n, body)
+        return _bin_frame(BIN_TRACED_RESULTS, q_id, n, body + _bin_str(_trace_json(trace)))
+
+
+#
+# Returns an error response carrying 'msg', which is plain text (and may echo the client's input).
+#
+
+def encode_error(msg, fmt, q_id):
+    if fmt == "xml":
+        return _xml_doc("error", q_id, bytes(saxutils.escape(msg), 'UTF-8'))
+    elif fmt == "json":
+        return _json_line(dict(id=q_id, error=msg))
+    else:
+        return _bin_frame(BIN_ERROR, q_id, 0, _bin_str(msg))
+
+
+def _xml_doc(tag, q_id, body):
+    if q_id:
+        return bytes("<{0} id={1}>".format(tag, saxutils.quoteattr(q_id)), 'UTF-8') + body + bytes("</{0}>".format(tag), 'UTF-8')
+    else:
+        return bytes("<{0}>".format(tag), 'UTF-8') + body + bytes("</{0}>".format(tag), 'UTF-8')
+
+
+def _json_doc(key, q_id, body, extra=None):
+    if extra is None:
+        extra_txt = b""
+    else:
+        extra_txt = b"".join([bytes(',"{0}":{1}'.format(k, _trace_json(v)), 'UTF-8') for k, v in extra.items()])
+
+    return bytes('{{"id":{0},"{1}":['.format(json.dumps(q_id), key), 'UTF-8') + body + b"]" + extra_txt + b"}\n"
+
+
+def _xml_trace(trace):
+    sqls = []
+    for t in trace:
+        sqls.append("<sql statement={0} start_ms='{1:.3f}' ms='{2:.3f}' rows='{3}' prepared='{4}'>{5}</sql>".format(
+                    saxutils.quoteattr(t["statement"]), t["start_ms"], t["ms"], t["rows"], str(t["prepared"]).lower(),
+                    saxutils.escape(_trace_json(t["params"]))))
+
+    return bytes("<trace>{0}</trace>".format("".join(sqls)), 'UTF-8')
+
+
+def _trace_json(o):
+    # Parameters may be of any type the database module accepts.
+    return json.dumps(o, separators=(",", ":"), default=str)
+
+
+def _json_line(o):
+    return bytes(json.dumps(o, separators=(",", ":")), 'UTF-8') + b"\n"
+
+
+def _bin_frame(kind, q_id, n, body):
+    payload = _bin_str(q_id or "") + _BIN_COUNT.pack(n) + body
+    return BIN_HEADER.pack(kind, len(payload)) + payload
+
+
+def _bin_ints(*ints):
+    flags = 0
+    for i, x in enumerate(ints):
+        if x is None:
+            flags |= 1 << i
+
+    return _BIN_INTS.pack(flags, *[x or 0 for x in ints])
+
+
+def _bin_str(s):
+    if s is None:
+        s = ""
+    b = bytes(str(s), 'UTF-8')
+
+    return _BIN_STR_LEN.pack(len(b)) + b
+
+
+#
+# Decoding, for clients. Results in any format are decoded to dicts of the same shape as the JSON
+# encoding.
+#
+
+def decode_xml_result(e):
+    ri = e.find(RPlace.TAG)
+    if ri is not None:
+        fields = _PLACE_FIELDS
+    else:
+        ri = e.find(RPost_Code.TAG)
+        fields = _POSTCODE_FIELDS
+
+    d = {}
+    for name in fields:
+        v = ri.findtext(name)
+        if v == "None":
+            # to_xml writes out missing values (e.g. an unknown OSM ID) as "None".
+            v = None
+        elif v is not None and name in _PLACE_INTS:
+            v = int(v)
+        d[name] = v
+
+    return {ri.tag: d, "dangling": e.findtext("dangling") or ""}
+
+
+
+def decode_xml_trace(e):
+    return [dict(statement=sql.get("statement"), params=json.loads(sql.text), start_ms=float(sql.get("start_ms")),
+                 ms=float(sql.get("ms")), rows=int(sql.get("rows")), prepared=sql.get("prepared") == "true")
+            for sql in e]
+
+
+def decode_xml_stats(e):
+    stats = {}
+    for section, tag in STATS_SECTIONS.items():
+        stats[section] = dict([(entry.get("name"), dict([(c.tag, int(c.text)) for c in entry]))
+                               for entry in e.findall("{0}/{1}".format(section, tag))])
+
+    return stats
+
+
+def decode_bin(kind, payload):
+    q_id, i = _unbin_str(payload, 0)
+    n, = _BIN_COUNT.unpack_from(payload, i)
+    i += _BIN_COUNT.size
+
+    if kind == BIN_ERROR:
+        msg, i = _unbin_str(payload, i)
+        return q_id, msg
+    elif kind == BIN_COUNTRY:
+        if n == 0:
+            return q_id, None
+        name, i = _unbin_str(payload, i)
+        return q_id, name
+    elif kind == BIN_STATS:
+        stats, i = _unbin_str(payload, i)
+        return q_id, json.loads(stats)
+    elif kind == BIN_RESULTS:
+        results, i = _unbin_results(payload, i, n)
+        return q_id, results
+    elif kind == BIN_TRACED_RESULTS:
+        results, i = _unbin_results(payload, i, n)
+        trace, i = _unbin_str(payload, i)
+        return q_id, (results, json.loads(trace))
+    else:
+        assert kind == BIN_BATCH_RESULTS
+        all_results = []
+        for _ in range(n):
+            m, = _BIN_COUNT.unpack_from(payload, i)
+            results, i = _unbin_results(payload, i + _BIN_COUNT.size, m)
+            all_results.append(results)
+        return q_id, all_results
+
+
+def _unbin_results(payload, i, n):
+    results = []
+    for _ in range(n):
+        i += _BIN_COUNT.size # Skip the per-result length.
+        tag = payload[i:i + 1]
+        i += 1
+        ints = _BIN_INTS.unpack_from(payload, i)
+        i += _BIN_INTS.size
+        if tag == _BIN_PLACE:
+            tag, int_names, str_names, fields = RPlace.TAG, _PLACE_INTS, _PLACE_STRS, _PLACE_FIELDS
+        else:
+            tag, int_names, str_names, fields = RPost_Code.TAG, _POSTCODE_INTS, _POSTCODE_STRS, _POSTCODE_FIELDS
+        vals = {}
+        for j, name in enumerate(int_names):
+            if ints[0] & (1 << j):
+                vals[name] = None
+            else:
+                vals[name] = ints[j + 1]
+        for name in str_names:
+            vals[name], i = _unbin_str(payload, i)
+        dangling, i = _unbin_str(payload, i)
+        results.append({tag: dict([(name, vals[name]) for name in fields]), "dangling": dangling})
+
+    return results, i
+
+
+def _unbin_str(payload, i):
+    n, = _BIN_STR_LEN.unpack_from(payload, i)
+    i += _BIN_STR_LEN.size
+
+    return str(payload[i:i + n], 'UTF-8'), i + n
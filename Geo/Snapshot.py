@@ -0,0 +1,409 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import array, bisect, json, math, mmap, os, struct, sys
+from .import Backend, PG_Backend, Ref_Tables
+
+
+#
+# A snapshot is a single read-only file holding everything needed to answer queries, compiled from
+# the database by export() and read through mmap by the Snapshot backend. Worker processes which
+# map the same file share one copy of it through the page cache, and no database is needed.
+#
+# The file consists of:
+#
+#   MAGIC
+#   The length of the header, as an unsigned 64 bit little-endian integer.
+#   The header: a JSON object recording the format version, the byte order, the reference tables'
+#     rows (which are small) and, for each section, its offset (from the end of the header, rounded
+#     up to a multiple of 8), array type code and length.
+#   The sections, each aligned to 8 bytes. Each is a flat array of one column:
+#
+#     place_*   : One entry per place, ordered by place ID: ID, OSM ID, country ID, parent ID,
+#                 population, admin level, and the latitude and longitude of its centroid.
+#     name_*    : One entry per place name, ordered by place ID: place ID, lang ID, and the name (an
+#                 index into the string table).
+#     hash_*    : One entry per place name, ordered by name hash (split into two 64 bit halves),
+#                 giving the index of the name in name_*.
+#     pc_*      : One entry per postcode, ordered by main part (lower case) then ID: ID, OSM ID,
+#                 country ID, parent ID, main and supplementary parts and the lower case main part
+#                 (as indexes into the string table), and the latitude and longitude of its centroid.
+#     pcid_*    : Postcode IDs in order, with the parent ID of each.
+#     str_*     : The string table: the offset of each string in str_heap (plus a final offset
+#                 marking the end of the last), and the UTF-8 encoded strings.
+#
+# Missing integers are stored as NULL and missing coordinates as NaN. Only centroids are stored, so
+# locations are always points, even when areas are asked for.
+#
+
+MAGIC = b"FETEGEO\x01"
+VERSION = 1
+
+NULL = -2 ** 63
+
+_HEADER_LEN = struct.Struct("<Q")
+
+_SECTIONS = (("place_id", "q"), ("place_osm_id", "q"), ("place_country_id", "q"), ("place_parent_id", "q"),
+             ("place_population", "q"), ("place_admin_level", "q"), ("place_lat", "d"), ("place_long", "d"),
+             ("name_place_id", "q"), ("name_lang_id", "q"), ("name_str", "q"),
+             ("hash_hi", "Q"), ("hash_lo", "Q"), ("hash_name", "q"),
+             ("pc_id", "q"), ("pc_osm_id", "q"), ("pc_country_id", "q"), ("pc_parent_id", "q"), ("pc_main", "q"),
+             ("pc_sup", "q"), ("pc_key", "q"), ("pc_lat", "d"), ("pc_long", "d"),
+             ("pcid_id", "q"), ("pcid_parent_id", "q"),
+             ("str_offsets", "q"), ("str_heap", "B"))
+
+
+class Snapshot_Error(Exception):
+    pass
+
+
+#
+# Compile the database 'db' into a snapshot at 'path'. The snapshot is written to a temporary file
+# which is then renamed, so a server reloading 'path' never sees a partial snapshot.
+#
+
+def export(db, path):
+    cols = dict([(name, array.array(typecode)) for name, typecode in _SECTIONS])
+    strs = _String_Table(cols["str_offsets"], cols["str_heap"])
+
+    for row in PG_Backend.iter_rows(db, "SELECT place_id, osm_id, country_id, parent_id, population, admin_level, "
+                                        "ST_Y(ST_Centroid(location)), ST_X(ST_Centroid(location)) "
+                                        "FROM place ORDER BY place_id"):
+        _append_ints(cols, ("place_id", "place_osm_id", "place_country_id", "place_parent_id",
+                            "place_population", "place_admin_level"), row[:6])
+        _append_coords(cols, "place_lat", "place_long", row[6], row[7])
+
+    hashes = []
+    for place_id, lang_id, name, name_hash in PG_Backend.iter_rows(
+            db, "SELECT place_id, lang_id, name, name_hash FROM place_name ORDER BY place_id"):
+        _append_ints(cols, ("name_place_id", "name_lang_id"), (place_id, lang_id))
+        cols["name_str"].append(strs.add(name))
+        hashes.append((int(name_hash[:16], 16), int(name_hash[16:32], 16), len(hashes)))
+    hashes.sort()
+    for hi, lo, name_i in hashes:
+        cols["hash_hi"].append(hi)
+        cols["hash_lo"].append(lo)
+        cols["hash_name"].append(name_i)
+    del hashes
+
+    pcids = []
+    for postcode_id, osm_id, country_id, parent_id, main, sup, lat, long in PG_Backend.iter_rows(
+            db, "SELECT postcode_id, osm_id, country_id, parent_id, main, sup, "
+                "ST_Y(ST_Centroid(location)), ST_X(ST_Centroid(location)) "
+                "FROM postcode ORDER BY lower(main), postcode_id"):
+        _append_ints(cols, ("pc_id", "pc_osm_id", "pc_country_id", "pc_parent_id"),
+                     (postcode_id, osm_id, country_id, parent_id))
+        cols["pc_main"].append(strs.add(main))
+        if sup is None:
+            cols["pc_sup"].append(NULL)
+        else:
+            cols["pc_sup"].append(strs.add(sup))
+        cols["pc_key"].append(strs.add(main.lower()))
+        _append_coords(cols, "pc_lat", "pc_long", lat, long)
+        pcids.append((postcode_id, parent_id))
+    pcids.sort()
+    for postcode_id, parent_id in pcids:
+        _append_ints(cols, ("pcid_id", "pcid_parent_id"), (postcode_id, parent_id))
+    del pcids
+
+    # ORDER BY lower(main) uses the database's collation, which needn't agree with Python's string
+    # ordering; the postcodes are searched with the latter.
+    _sort_postcodes(cols, strs)
+
+    ref = [[list(row) for row in rows] for rows in PG_Backend.PG_Backend().ref_rows(db)]
+
+    # Section offsets are relative to the (aligned) end of the header.
+    sections = {}
+    off = 0
+    for name, typecode in _SECTIONS:
+        sections[name] = (off, typecode, len(cols[name]))
+        off = _align(off + len(cols[name]) * cols[name].itemsize)
+    header = bytes(json.dumps(dict(version=VERSION, byteorder=sys.byteorder, ref=ref, sections=sections)),
+                   "UTF-8")
+
+    tmp_path = "{0}.tmp".format(path)
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(_HEADER_LEN.pack(len(header)))
+        f.write(header)
+        base = _align(f.tell())
+        for name, typecode in _SECTIONS:
+            f.write(b"\0" * (base + sections[name][0] - f.tell()))
+            cols[name].tofile(f)
+    os.rename(tmp_path, path)
+
+
+def _append_ints(cols, names, values):
+    for name, v in zip(names, values):
+        if v is None:
+            cols[name].append(NULL)
+        else:
+            cols[name].append(v)
+
+
+def _append_coords(cols, lat_name, long_name, lat, long):
+    if lat is None or long is None:
+        lat = long = float("nan")
+    cols[lat_name].append(lat)
+    cols[long_name].append(long)
+
+
+def _sort_postcodes(cols, strs):
+    names = [name for name, typecode in _SECTIONS if name.startswith("pc_")]
+    order = sorted(range(len(cols["pc_id"])), key=lambda i: (strs.get(cols["pc_key"][i]), cols["pc_id"][i]))
+    for name in names:
+        col = cols[name]
+        cols[name] = array.array(col.typecode, [col[i] for i in order])
+
+
+def _align(off):
+    return (off + 7) & ~7
+
+
+class _String_Table:
+    def __init__(self, offsets, heap):
+        self._offsets = offsets
+        self._heap = heap
+        self._offsets.append(0)
+        self._index = {}
+
+
+    def add(self, s):
+        i = self._index.get(s)
+        if i is None:
+            i = self._index[s] = len(self._offsets) - 1
+            self._heap.frombytes(bytes(s, "UTF-8"))
+            self._offsets.append(len(self._heap))
+
+        return i
+
+
+    def get(self, i):
+        return self._heap[self._offsets[i]:self._offsets[i + 1]].tobytes().decode("UTF-8")
+
+
+#
+# The snapshot backend. The snapshot is (re)mapped by refresh, so a new snapshot can be picked up
+# by exporting over the old one and reloading the server.
+#
+
+class Snapshot(Backend.Backend):
+    uses_db = False
+
+
+    def __init__(self, path):
+        self._path = path
+        self._data = None
+
+
+    def refresh(self, db):
+        self._data = _Data(self._path)
+
+
+    def load_ref_tables(self, db):
+        return Ref_Tables.Ref_Tables(*[[tuple(row) for row in rows] for rows in self._data.ref])
+
+
+    def iter_place_names(self, db):
+        d = self._data
+        place_i = 0
+        for name_i in range(len(d.name_place_id)):
+            place_id = d.name_place_id[name_i]
+            # Names and places are both ordered by place ID.
+            while d.place_id[place_i] < place_id:
+                place_i += 1
+            yield place_id, d.get_str(d.name_str[name_i]), _null(d.place_country_id[place_i])
+
+
+    def find_places(self, db, hashes, country_id, show_area):
+        d = self._data
+        places = {}
+        for h in hashes:
+            hi = int(h[:16], 16)
+            lo = int(h[16:32], 16)
+            done = set()
+            places[h] = hash_places = []
+            i = bisect.bisect_left(d.hash_hi, hi)
+            while i < len(d.hash_hi) and d.hash_hi[i] == hi:
+                if d.hash_lo[i] == lo:
+                    name_i = d.hash_name[i]
+                    place_id = d.name_place_id[name_i]
+                    name = d.get_str(d.name_str[name_i])
+                    place_i = d.place_index(place_id)
+                    sub_country_id = _null(d.place_country_id[place_i])
+                    if (country_id is None or sub_country_id == country_id) and (place_id, name) not in done:
+                        done.add((place_id, name))
+                        hash_places.append((place_id, _null(d.place_osm_id[place_i]), name, sub_country_id,
+                                            _null(d.place_parent_id[place_i]),
+                                            _null(d.place_population[place_i]),
+                                            _location(d.place_lat[place_i], d.place_long[place_i])))
+                i += 1
+
+        return places
+
+
+    def place_details(self, db, place_ids, show_area):
+        d = self._data
+        details = {}
+        for place_id in place_ids:
+            place_i = d.place_index(place_id)
+            if place_i is not None:
+                details[place_id] = (_null(d.place_osm_id[place_i]), _null(d.place_country_id[place_i]),
+                                     _null(d.place_parent_id[place_i]), _null(d.place_population[place_i]),
+                                     _location(d.place_lat[place_i], d.place_long[place_i]))
+
+        return details
+
+
+    def place_parent(self, db, place_id):
+        d = self._data
+        place_i = d.place_index(place_id)
+        assert place_i is not None
+
+        return (_null(d.place_parent_id[place_i]), _null(d.place_country_id[place_i]),
+                _null(d.place_admin_level[place_i]))
+
+
+    def place_name(self, db, place_id, lang_ids):
+        d = self._data
+        start = bisect.bisect_left(d.name_place_id, place_id)
+        end = bisect.bisect_right(d.name_place_id, place_id)
+        for lang_id in lang_ids:
+            for name_i in range(start, end):
+                if d.name_lang_id[name_i] == lang_id:
+                    return d.get_str(d.name_str[name_i])
+
+        # We couldn't find anything in the required languages.
+        if start == end:
+            return None
+        return d.get_str(d.name_str[start])
+
+
+    def find_postcodes(self, db, main, country_ids, sup, show_area):
+        d = self._data
+        main = main.lower()
+        keys = _Str_Column(d, d.pc_key)
+        pcs = []
+        for pc_i in range(bisect.bisect_left(keys, main), bisect.bisect_right(keys, main)):
+            country_id = _null(d.pc_country_id[pc_i])
+            if country_ids is not None and country_id not in country_ids:
+                continue
+
+            if d.pc_sup[pc_i] == NULL:
+                pc_sup = None
+            else:
+                pc_sup = d.get_str(d.pc_sup[pc_i])
+            if sup is None:
+                if pc_sup is not None:
+                    continue
+            elif sup is not Backend.ANY:
+                if pc_sup is None or pc_sup.lower() != sup.lower():
+                    continue
+
+            pcs.append((d.pc_id[pc_i], _null(d.pc_osm_id[pc_i]), country_id, d.get_str(d.pc_main[pc_i]), pc_sup,
+                        _location(d.pc_lat[pc_i], d.pc_long[pc_i])))
+
+        return pcs
+
+
+    def postcode_parent(self, db, postcode_id):
+        d = self._data
+        i = bisect.bisect_left(d.pcid_id, postcode_id)
+        assert i < len(d.pcid_id) and d.pcid_id[i] == postcode_id
+
+        return _null(d.pcid_parent_id[i])
+
+
+class _Data:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buf = memoryview(self._mmap)
+        if buf[:len(MAGIC)] != MAGIC:
+            raise Snapshot_Error("'{0}' is not a snapshot.".format(path))
+        header_len = _HEADER_LEN.unpack_from(buf, len(MAGIC))[0]
+        header_off = len(MAGIC) + _HEADER_LEN.size
+        header = json.loads(bytes(buf[header_off:header_off + header_len]).decode("UTF-8"))
+        if header["version"] != VERSION or header["byteorder"] != sys.byteorder:
+            raise Snapshot_Error("'{0}' is an incompatible snapshot.".format(path))
+
+        self.ref = header["ref"]
+        base = _align(header_off + header_len)
+        for name, (off, typecode, n) in header["sections"].items():
+            off += base
+            setattr(self, name, buf[off:off + n * struct.calcsize(typecode)].cast(typecode))
+
+
+    def place_index(self, place_id):
+        i = bisect.bisect_left(self.place_id, place_id)
+        if i < len(self.place_id) and self.place_id[i] == place_id:
+            return i
+
+        return None
+
+
+    def get_str(self, i):
+        return bytes(self.str_heap[self.str_offsets[i]:self.str_offsets[i + 1]]).decode("UTF-8")
+
+
+#
+# A sequence view of a column of string table indexes, so that it can be searched with bisect.
+#
+
+class _Str_Column:
+    def __init__(self, d, col):
+        self._d = d
+        self._col = col
+
+
+    def __len__(self):
+        return len(self._col)
+
+
+    def __getitem__(self, i):
+        return self._d.get_str(self._col[i])
+
+
+def _null(v):
+    if v == NULL:
+        return None
+
+    return v
+
+
+#
+# Format a centroid as ST_AsGeoJSON does.
+#
+
+def _location(lat, long):
+    if math.isnan(lat):
+        return None
+
+    return '{{"type":"Point","coordinates":[{0},{1}]}}'.format(_fmt_coord(long), _fmt_coord(lat))
+
+
+def _fmt_coord(x):
+    s = "{0:.9f}".format(x).rstrip("0").rstrip(".")
+    if s == "-0":
+        return "0"
+
+    return s
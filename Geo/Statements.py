@@ -0,0 +1,200 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import re, threading, time, weakref
+
+from .import Metrics
+
+
+#
+# A registry of the SQL statements run on every query. Each statement is prepared on the server
+# (with PREPARE) the first time it is used on a given connection, and thereafter run by name (with
+# EXECUTE), so that PostgreSQL parses and plans it once per connection rather than once per use.
+#
+# A statement is defined by a function which, given a 'variant' tuple (e.g. whether areas are
+# being shown), returns the statement's SQL with %(name)s style parameters. The function is only
+# called the first time a variant is used; each variant is a separate prepared statement. Sequences
+# of values must be passed as lists and matched with "= ANY(%(name)s)" rather than "IN", so that a
+# single prepared statement can cope with any number of values.
+#
+# Which statements have been prepared is recorded in the 'prepared' dictionary of the connection
+# (see DB_Pool.Pooled_Connection). Connections without one (e.g. plain DB API connections) simply
+# execute the SQL directly.
+#
+# Every statement executed, and the rows it returns, are counted (and, if the request is being
+# traced, recorded) against the current request (see Metrics.current). The totals reported by
+# stats are kept per thread, so that executing a statement never waits on a lock.
+#
+
+_RE_PARAM = re.compile("%\\(([a-z_0-9]+)\\)s")
+
+# Re-entrant, since a finished thread's counts may be folded (see _fold) by whichever thread frees
+# them.
+_lock = threading.RLock()
+_statements = {}
+
+# Each live thread's _Thread_Counts is in its thread local and in _live, for stats. When a thread
+# finishes, its counts are folded into _finished, so that threads which come and go (e.g. to reload)
+# don't accumulate.
+_local = threading.local()
+_live = weakref.WeakSet()
+_finished = {}
+
+
+#
+# A thread's counts: 'by_name' maps a statement's name to a [prepares, executes] list, which only
+# that thread changes.
+#
+
+class _Thread_Counts:
+    def __init__(self):
+        self.by_name = {}
+
+
+class Statement:
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+
+        params = []
+        def sub(m):
+            if m.group(1) not in params:
+                params.append(m.group(1))
+            return "${0}".format(params.index(m.group(1)) + 1)
+
+        self.prepare_sql = "PREPARE {0} AS {1}".format(name, _RE_PARAM.sub(sub, sql))
+        self.execute_sql = "EXECUTE {0}({1})".format(name, ", ".join(["%({0})s".format(p) for p in params]))
+
+
+#
+# Execute the statement defined by 'mk_sql' and 'variant' on 'db' with parameters 'params',
+# returning the cursor.
+#
+
+def execute(db, mk_sql, variant, params):
+    key = (mk_sql, variant)
+    try:
+        stmt = _statements[key]
+    except KeyError:
+        with _lock:
+            stmt = _statements.get(key)
+            if stmt is None:
+                stmt = Statement(_mk_name(mk_sql, variant), mk_sql(*variant))
+                _statements[key] = stmt
+
+    started = time.perf_counter()
+    c = db.cursor()
+    prepared = getattr(db, "prepared", None)
+    if prepared is None:
+        c.execute(stmt.sql, params)
+        Metrics.current().sql(stmt.name, params, started, max(c.rowcount, 0))
+        return c
+
+    needs_prepare = stmt.name not in prepared
+    if needs_prepare:
+        c.execute(stmt.prepare_sql)
+        prepared[stmt.name] = stmt
+
+    c.execute(stmt.execute_sql, params)
+    _count(stmt.name, needs_prepare)
+    Metrics.current().sql(stmt.name, params, started, max(c.rowcount, 0), needs_prepare)
+
+    return c
+
+
+def _count(name, prepared):
+    try:
+        counts = _local.counts
+    except AttributeError:
+        counts = _local.counts = _Thread_Counts()
+        weakref.finalize(counts, _fold, counts.by_name)
+        with _lock:
+            _live.add(counts)
+
+    stmt_counts = counts.by_name.get(name)
+    if stmt_counts is None:
+        stmt_counts = counts.by_name[name] = [0, 0]
+    if prepared:
+        stmt_counts[0] += 1
+    stmt_counts[1] += 1
+
+
+def _fold(by_name):
+    with _lock:
+        for name, (prepares, executes) in by_name.items():
+            totals = _finished.setdefault(name, [0, 0])
+            totals[0] += prepares
+            totals[1] += executes
+
+
+#
+# Return the SQL for 'location' as GeoJSON: the whole area if 'show_area' is True, otherwise just
+# its centroid.
+#
+
+def location_printer(location, show_area):
+    if show_area:
+        return "ST_AsGeoJSON({0})".format(location)
+    else:
+        return "ST_AsGeoJSON(ST_Centroid({0}))".format(location)
+
+
+def _mk_name(mk_sql, variant):
+    name = "{0}_{1}".format(mk_sql.__module__.split(".")[-1], mk_sql.__name__.strip("_")).lower()
+    for v in variant:
+        name = "{0}_{1}".format(name, int(v))
+
+    return name
+
+
+#
+# Return a list of (name, prepares, executes) for every statement used so far. The ratio of
+# executes to prepares is the number of times each plan has been reused.
+#
+
+def stats():
+    with _lock:
+        totals = dict([(stmt.name, [0, 0]) for stmt in _statements.values()])
+        for name, (prepares, executes) in _finished.items():
+            totals[name][0] += prepares
+            totals[name][1] += executes
+        # Holding the live threads' counts stops them being folded into _finished meanwhile.
+        live = list(_live)
+
+    for counts in live:
+        for name, (prepares, executes) in list(counts.by_name.items()):
+            totals[name][0] += prepares
+            totals[name][1] += executes
+
+    return sorted([(name, prepares, executes) for name, (prepares, executes) in totals.items()])
+
+
+#
+# Return a list of (name, generic plans, custom plans) for the statements prepared on 'db', as
+# reported by PostgreSQL (version 14 or later). Prepared statements belong to a session, so these
+# are only the plans made on 'db'.
+#
+
+def plan_stats(db):
+    c = db.cursor()
+    c.execute("SELECT name, generic_plans, custom_plans FROM pg_prepared_statements ORDER BY name")
+
+    return c.fetchall()
@@ -0,0 +1,158 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import xml.etree.ElementTree as ET
+
+
+#
+# An incremental parser for the fetegeos protocol, which (in both directions) is a sequence of XML
+# documents sent back-to-back down a socket. Bytes are fed in as they are received, and each
+# document is handed back as an ElementTree element as soon as its closing tag has been parsed.
+# Nothing is ever re-scanned and completed documents are dropped from the parser, so the cost of
+# parsing is linear in the size of the input and memory use is bounded by the largest single
+# document.
+#
+# The parser sees the stream as the contents of a single virtual root element, so that documents
+# following one another are simply siblings. Since an XML declaration can't appear inside an
+# element, a declaration preceding a document (as some XML libraries write) is stripped out before
+# it reaches the parser.
+#
+# If 'max_size' is not None, a document larger than 'max_size' bytes raises a Stream_Error rather
+# than being buffered. A Stream_Error's 'docs' are those completed (by the same call to feed) before
+# the error, which the caller may still want to process. While the 'stream_items' attribute is True, the children of each document
+# (e.g. each <result> in a <results> document) are also handed back as soon as they are complete,
+# and are then removed from their parent so that arbitrarily large responses can be processed in
+# bounded memory.
+#
+
+DOC = 0
+ITEM = 1
+
+DEFAULT_MAX_SIZE = 1024 * 1024
+
+_DECL = b"<?xml"
+_DECL_END = b"?>"
+_WHITESPACE = b" \t\r\n"
+
+
+class Stream_Error(Exception):
+    def __init__(self, msg, docs=None):
+        Exception.__init__(self, msg)
+        if docs is None:
+            docs = []
+        self.docs = docs
+
+
+class Stream_Reader:
+    def __init__(self, max_size=None, stream_items=False):
+        self._max_size = max_size
+        self.stream_items = stream_items
+
+        self._parser = ET.XMLPullParser(("start", "end"))
+        self._parser.feed(b"<stream>")
+        self._stack = []
+        self._size = 0 # The number of bytes fed since the last complete document.
+        self._held = b"" # Bytes which may be the start of an XML declaration.
+        self._in_decl = False
+
+
+    #
+    # Feed 'data' to the parser, returning a list of (DOC | ITEM, element) pairs for the documents
+    # (and, optionally, items) which have been completed.
+    #
+
+    def feed(self, data):
+        self._size += len(data)
+        if self._max_size is not None and self._size > self._max_size:
+            raise Stream_Error("Message too large.")
+
+        data = self._held + data
+        self._held = b""
+        out = []
+        while len(data) > 0:
+            if self._in_decl:
+                end = data.find(_DECL_END)
+                if end == -1:
+                    if data.endswith(_DECL_END[:1]):
+                        self._held = data[-1:]
+                    break
+                self._in_decl = False
+                data = data[end + len(_DECL_END):]
+                continue
+
+            i = data.find(_DECL)
+            if i == -1:
+                # The end of 'data' may be the start of a declaration split across reads.
+                held = 0
+                for j in range(min(len(_DECL) - 1, len(data)), 0, -1):
+                    if data.endswith(_DECL[:j]):
+                        held = j
+                        break
+                self._feed(data[:len(data) - held], out)
+                self._held = data[len(data) - held:]
+                break
+            elif i + len(_DECL) == len(data):
+                # Not yet known whether this is a declaration or e.g. "<?xml-stylesheet".
+                self._feed(data[:i], out)
+                self._held = data[i:]
+                break
+
+            self._feed(data[:i], out)
+            if not self.in_document() and data[i + len(_DECL):i + len(_DECL) + 1] in _WHITESPACE:
+                self._in_decl = True
+            else:
+                self._feed(data[i:i + len(_DECL)], out)
+            data = data[i + len(_DECL):]
+
+        return out
+
+
+    def _feed(self, data, out):
+        if len(data) == 0:
+            return
+
+        try:
+            self._parser.feed(data)
+            events = self._parser.read_events()
+            for event, elem in events:
+                if event == "start":
+                    self._stack.append(elem)
+                    continue
+
+                self._stack.pop()
+                if len(self._stack) == 1:
+                    # A complete document.
+                    self._stack[0].remove(elem)
+                    out.append((DOC, elem))
+                    self._size = 0
+                elif len(self._stack) == 2 and self.stream_items:
+                    out.append((ITEM, elem))
+                    self._stack[1].remove(elem)
+        except ET.ParseError as e:
+            raise Stream_Error("Malformed message: {0}.".format(e), out)
+
+
+    #
+    # Returns True if part of a document has been received but not yet completed.
+    #
+
+    def in_document(self):
+        return len(self._stack) > 1
@@ -19,70 +19,345 @@
 # IN THE SOFTWARE.
 
 
-import threading
+import collections, sys, threading, time
 
 
 #
-# This class implements a simple "don't fill up beyond a certain point" dictionary cache. Effectively
-# it maintains a current dictionary and an old dictionary; when the current dictionary overfills the
-# old dictionary is overwritten with the current dictionary and a blank current dictionary is then
-# used. Lookups and so on first try the current cache and, if that fails, look at the old cache. This
-# means that frequently used items will continuously stay in the cache (as they make their way from
-# the old to the current cache), while not taking up too much memory.
+# A thread safe cache whose memory use is bounded by a budget in bytes. Entries are weighed with
+# sizeof (an estimate, following containers and objects' attributes), so that a large GeoJSON area
+# counts for more than a small ID.
 #
+# Eviction uses a segmented LRU. New entries go into a "probation" segment; an entry which is hit
+# again moves to a "protected" segment, which may fill at most 'protected_ratio' of the budget, and
+# whose least recently used entries fall back into probation. When the cache is over budget, the
+# least recently used entries in probation are evicted first. Entries used once (e.g. one-off
+# queries) therefore can't push out those used repeatedly, and the hit rate doesn't collapse when
+# the cache fills, as it did with the old generational cache.
+#
+# If 'ttl' is not None, entries expire 'ttl' seconds after being stored.
+#
+# Reads don't take the cache's lock: entries are looked up in a plain dict (whose reads are atomic,
+# with or without the GIL) and the keys read are appended to a buffer. The buffer is replayed into
+# the LRU order under the lock by whichever thread next writes, or by a reader which finds the
+# buffer full and the lock free; if the buffer overflows, the oldest reads are forgotten. The LRU
+# order is therefore approximate, as are the hit and miss counts, which aren't locked either.
+# Writes take the lock once. get_or_compute looks a key up and, on a miss, calls 'compute'
+# (outside the lock, so that slow computations don't block other users of the cache) and stores
+# the result. Concurrent misses on the same key are coalesced: one thread computes the value while
+# the others wait for it (if the computation fails, each waiter then tries it itself).
+#
+# An entry larger than 'max_entry_bytes' (by default, the whole budget) isn't cached at all, since
+# it would evict everything else; such rejections are counted.
+#
+# Striped_Cache spreads keys over several SLRU_Caches, each with its own lock, so that concurrent
+# writers rarely contend. Each stripe evicts to keep within its share of the budget, but entries
+# are only rejected if they're larger than the whole budget: an entry larger than its stripe's
+# share is kept, alone in its stripe, so that large responses are still cached when there are
+# many stripes, at the cost of the cache sometimes exceeding its budget.
+#
+
+SMALL_CACHE_BYTES = 4 * 1024 * 1024
+LARGE_CACHE_BYTES = 16 * 1024 * 1024
+
+DEFAULT_PROTECTED_RATIO = 0.8
+DEFAULT_STRIPES = 16
+
+# An estimate of the bytes used by the cache's own bookkeeping for each entry.
+_ENTRY_OVERHEAD = 200
+
+# How deep sizeof follows nested containers and objects.
+_MAX_SIZEOF_DEPTH = 8
+
+# The number of reads buffered before a reader tries to replay them, and the most kept.
+_READ_BUFFER_DRAIN = 64
+_READ_BUFFER_SIZE = 1024
 
+_MISSING = object()
 
-SMALL_CACHE_SIZE = 1000
-LARGE_CACHE_SIZE = 5000
 
-class Cached_Dict:
-    def __init__(self, max_size):
-        self._max_size = max_size
+#
+# A computation of a key's value by get_or_compute, which other threads missing the same key wait
+# on.
+#
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.value = None
+
+
+class SLRU_Cache:
+    def __init__(self, max_bytes, ttl=None, protected_ratio=DEFAULT_PROTECTED_RATIO, max_entry_bytes=None):
+        self._max_bytes = max_bytes
+        if max_entry_bytes is None:
+            self._max_entry_bytes = max_bytes
+        else:
+            self._max_entry_bytes = max_entry_bytes
+        self._max_protected_bytes = int(max_bytes * protected_ratio)
+        self._ttl = ttl
 
         self._lock = threading.Lock()
 
-        self._current = {}
-        self._old = {}
+        # Every entry, as a (value, size, expiry time or None) tuple. This is the only structure
+        # readers look at; it and the rest are only changed with the lock held.
+        self._index = {}
+        # The keys in each segment, least recently used first, mapped to their entries.
+        self._probation = collections.OrderedDict()
+        self._protected = collections.OrderedDict()
+        self._bytes = 0
+        self._protected_bytes = 0
+        self._reads = collections.deque(maxlen=_READ_BUFFER_SIZE)
+        # The _Flights of the keys being computed by get_or_compute.
+        self._flights = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.evictions = 0
+        self.rejects = 0
 
 
     def has_key(self, k):
-        self._lock.acquire()
+        return self._live(self._index.get(k))
+
+
+    def __getitem__(self, k):
+        v = self.get(k, _MISSING)
+        if v is _MISSING:
+            raise KeyError(k)
+
+        return v
+
+
+    def get(self, k, default=None):
+        e = self._index.get(k)
+        if not self._live(e):
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._reads.append(k)
+        if len(self._reads) >= _READ_BUFFER_DRAIN and self._lock.acquire(False):
+            try:
+                self._drain()
+            finally:
+                self._lock.release()
+
+        return e[0]
+
+
+    def __setitem__(self, k, v):
+        size = _ENTRY_OVERHEAD + sizeof(k) + sizeof(v)
+        if self._ttl is None:
+            expiry = None
+        else:
+            expiry = time.time() + self._ttl
+
+        with self._lock:
+            self._drain()
+            self._remove(k)
+            if size > self._max_entry_bytes:
+                # Caching this would evict everything else.
+                self.rejects += 1
+                return
+
+            e = (v, size, expiry)
+            self._index[k] = e
+            self._probation[k] = e
+            self._bytes += size
+            self.inserts += 1
+            # The new entry, last in probation, is never evicted, even if it alone exceeds the budget.
+            while self._bytes > self._max_bytes and len(self._index) > 1:
+                if len(self._probation) > 1:
+                    evicted_k, evicted = self._probation.popitem(last=False)
+                else:
+                    evicted_k, evicted = self._protected.popitem(last=False)
+                    self._protected_bytes -= evicted[1]
+                del self._index[evicted_k]
+                self._bytes -= evicted[1]
+                self.evictions += 1
+
+
+    def get_or_compute(self, k, compute):
+        v = self.get(k, _MISSING)
+        if v is not _MISSING:
+            return v
+
+        while True:
+            with self._lock:
+                e = self._index.get(k)
+                if self._live(e):
+                    return e[0]
+                flight = self._flights.get(k)
+                if flight is None:
+                    flight = self._flights[k] = _Flight()
+                    break
+            flight.done.wait()
+            if flight.ok:
+                # Not looked up again, since the value may have been too large to store.
+                return flight.value
+
         try:
-            if k in self._current or k in self._old:
-                return True
+            v = compute()
+            self[k] = v
+            flight.value = v
+            flight.ok = True
         finally:
-            self._lock.release()
+            with self._lock:
+                del self._flights[k]
+            flight.done.set()
 
-        return False
+        return v
 
 
-    def __getitem__(self, k):
-        self._lock.acquire()
-        try:
-            try:
-                return self._current[k]
-            except KeyError:
-                pass
+    def __len__(self):
+        return len(self._index)
+
+
+    #
+    # Returns a dict of the cache's statistics: the number of entries, the (estimated) bytes they
+    # take up, the budget, and counts of hits, misses, inserts, evictions and rejected (too large)
+    # entries since the cache was created.
+    #
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._index), bytes=self._bytes, max_bytes=self._max_bytes,
+                        hits=self.hits, misses=self.misses, inserts=self.inserts, evictions=self.evictions,
+                        rejects=self.rejects)
+
 
+    #
+    # Returns a list of the cache's live (key, value) pairs, hottest first: those in the protected
+    # segment, most recently used first, then those in probation likewise. Storing them in reverse
+    # order into an empty cache thus keeps the hottest entries if the budget is smaller.
+    #
+
+    def items(self):
+        with self._lock:
+            self._drain()
+            return [(k, e[0]) for segment in (self._protected, self._probation)
+                    for k, e in reversed(segment.items()) if self._live(e)]
+
+
+    def _live(self, e):
+        return e is not None and (e[2] is None or e[2] >= time.time())
+
+
+    #
+    # Replay the buffered reads into the LRU order. Must be called with the lock held.
+    #
+
+    def _drain(self):
+        while True:
             try:
-                o = self._old[k]
-                self._current[k] = o
-                return o
-            except KeyError:
-                pass
-        finally:
-            self._lock.release()
+                k = self._reads.popleft()
+            except IndexError:
+                break
 
-        raise KeyError(k)
+            if k in self._protected:
+                self._protected.move_to_end(k)
+            elif k in self._probation:
+                e = self._probation.pop(k)
+                if not self._live(e):
+                    del self._index[k]
+                    self._bytes -= e[1]
+                    continue
+                self._protected[k] = e
+                self._protected_bytes += e[1]
+                while self._protected_bytes > self._max_protected_bytes:
+                    demoted_k, demoted = self._protected.popitem(last=False)
+                    self._protected_bytes -= demoted[1]
+                    self._probation[demoted_k] = demoted
 
 
-    def __setitem__(self, k, i):
-        self._lock.acquire()
-        try:
-            if len(self._current) > self._max_size:
-                self._old = self._current
-                self._current = {}
+    def _remove(self, k):
+        e = self._index.pop(k, None)
+        if e is None:
+            return
 
-            self._current[k] = i
-        finally:
-            self._lock.release()
\ No newline at end of file
+        if k in self._protected:
+            del self._protected[k]
+            self._protected_bytes -= e[1]
+        else:
+            del self._probation[k]
+        self._bytes -= e[1]
+
+
+class Striped_Cache:
+    def __init__(self, max_bytes, ttl=None, stripes=DEFAULT_STRIPES):
+        self._stripes = tuple([SLRU_Cache(max_bytes // stripes, ttl, max_entry_bytes=max_bytes)
+                               for _ in range(stripes)])
+
+
+    def has_key(self, k):
+        return self._stripes[hash(k) % len(self._stripes)].has_key(k)
+
+
+    def __getitem__(self, k):
+        return self._stripes[hash(k) % len(self._stripes)][k]
+
+
+    def get(self, k, default=None):
+        return self._stripes[hash(k) % len(self._stripes)].get(k, default)
+
+
+    def __setitem__(self, k, v):
+        self._stripes[hash(k) % len(self._stripes)][k] = v
+
+
+    def get_or_compute(self, k, compute):
+        return self._stripes[hash(k) % len(self._stripes)].get_or_compute(k, compute)
+
+
+    def __len__(self):
+        return sum([len(stripe) for stripe in self._stripes])
+
+
+    def stats(self):
+        stats = {}
+        for stripe in self._stripes:
+            for name, v in stripe.stats().items():
+                stats[name] = stats.get(name, 0) + v
+
+        return stats
+
+
+    #
+    # Returns a list of the cache's live (key, value) pairs, hottest first (see SLRU_Cache.items).
+    # Stripes don't know how hot each other's entries are, so their items are merged by their
+    # relative position in their stripe. Simply concatenating them wouldn't do: keys are assigned
+    # to stripes by hash(k), which for strings varies between processes, so a cache filled from the
+    # list in another process spreads each stripe's items over all of its stripes.
+    #
+
+    def items(self):
+        ranked = []
+        for stripe in self._stripes:
+            items = stripe.items()
+            ranked.extend([(i / len(items), item) for i, item in enumerate(items)])
+        ranked.sort(key=lambda x: x[0])
+
+        return [item for rank, item in ranked]
+
+
+#
+# Return an estimate of the bytes used by 'o', including (up to a point) the objects it refers to.
+#
+
+def sizeof(o, depth=0):
+    size = sys.getsizeof(o)
+    if depth >= _MAX_SIZEOF_DEPTH or isinstance(o, (str, bytes, int, float, bool, type(None))):
+        return size
+
+    if isinstance(o, dict):
+        for k, v in o.items():
+            size += sizeof(k, depth + 1) + sizeof(v, depth + 1)
+    elif isinstance(o, (tuple, list, set, frozenset)):
+        for x in o:
+            size += sizeof(x, depth + 1)
+    elif hasattr(o, "__dict__"):
+        size += sizeof(o.__dict__, depth + 1)
+
+    return size
@@ -20,7 +20,7 @@
 
 
 import re
-from .import Results
+from .import Backend
 
 
 _RE_UK_PARTIAL_POSTCODE = re.compile(
@@ -44,35 +44,18 @@ def postcode_match(ft, i):
         # We got something that looks as if it might plausibly be the solitary first half of a
         # postcode (e.g. AA9A), so try matching it on its own.
 
-        c = ft.db.cursor()
-        c.execute(("SELECT postcode_id, osm_id, country_id, main, "
-                   + ft.location_printer("location") + " as location "
-                                                       "FROM postcode "
-                                                       "WHERE country_id IN %(ids)s "
-                                                       "AND lower(main)=%(main)s "
-                                                       "AND sup IS NULL"
-                      ),
-                  dict(ids=tuple(ids), main=ft.split[i]))
-
-        if c.rowcount == 0:
+        pcs = ft.queryier.backend.find_postcodes(ft.db, ft.split[i], ids, None, ft.show_area)
+
+        if len(pcs) == 0:
             # Since we couldn't find AA9A on its own, see if there are any postcodes with an
             # arbitrary supplementary (e.g. AA9A 2AA). This is likely to return multiple matches
             # if AA9A is a valid postcode.
-            c.execute("SELECT postcode_id, osm_id, country_id, main, "
-                      + ft.location_printer("location") + " as location "
-                                                          "FROM postcode "
-                                                          "WHERE country_id IN %(ids)s "
-                                                          "AND lower(main)=%(main)s",
-                      dict(ids=tuple(ids), main=ft.split[i]))
-
-        if c.rowcount > 0:
+            pcs = ft.queryier.backend.find_postcodes(ft.db, ft.split[i], ids, Backend.ANY, ft.show_area)
+
+        if len(pcs) > 0:
             # We might have got multiple matches, in which case we arbitrarily pick the first one.
-            cols_map = ft.queryier.mk_cols_map(c)
-            fst = c.fetchone()
-            pp = pp_place_id(ft, fst[cols_map["main"]], fst[cols_map["postcode_id"]])
-            match = Results.RPost_Code(fst[cols_map["postcode_id"]], fst[cols_map["osm_id"]],
-                                       fst[cols_map["country_id"]], fst[cols_map["location"]],
-                                       pp)
+            postcode_id, osm_id, country_id, fst_main, fst_sup, location = pcs[0]
+            match = ft.postcode_result(postcode_id, osm_id, country_id, location, fst_main)
             yield match, i - 1
 
     if i == 0:
@@ -95,82 +78,39 @@ def postcode_match(ft, i):
     # UK postcode data, we first of all try matching exactly what is given, gradually backing off if
     # that isn't possible. Since all of these matches are against the same string, as soon as we find
     # a match, we don't try searching any further.
-    c = ft.db.cursor()
-    c.execute(("SELECT postcode_id, osm_id, country_id, main, sup, "
-               + ft.location_printer("location") + " as location "
-                                                   "FROM postcode "
-                                                   "WHERE country_id IN %(ids)s "
-                                                   "AND lower(main)=%(main)s "
-                                                   "AND lower(sup)=%(sup)s"
-                  ),
-              dict(ids=tuple(ids), main=ft.split[i - 1], sup=ft.split[i]))
-
-    assert c.rowcount < 2
-
-    if c.rowcount == 1:
-        cols_map = ft.queryier.mk_cols_map(c)
-        fst = c.fetchone()
-        pp = pp_place_id(ft, "{0} {1}".format(fst[cols_map["main"]], fst[cols_map["sup"]]),
-                         fst[cols_map["postcode_id"]])
-        match = Results.RPost_Code(fst[cols_map["postcode_id"]], fst[cols_map["osm_id"]], fst[cols_map["country_id"]],
-                                   fst[cols_map["location"]], pp)
+    pcs = ft.queryier.backend.find_postcodes(ft.db, ft.split[i - 1], ids, ft.split[i], ft.show_area)
+
+    assert len(pcs) < 2
+
+    if len(pcs) == 1:
+        postcode_id, osm_id, country_id, fst_main, fst_sup, location = pcs[0]
+        pp = "{0} {1}".format(fst_main, fst_sup)
+        match = ft.postcode_result(postcode_id, osm_id, country_id, location, pp)
         yield match, i - 2
         return
 
     # Try matching the main part of the postcode and the first character of the supplementary
     # part. e.g. for AA9A 9AA try matching AA9A 9.
 
-    c = ft.db.cursor()
-    c.execute(("SELECT postcode_id, osm_id, country_id, main, sup, "
-               + ft.location_printer("location") + " as location "
-                                                   "FROM postcode "
-                                                   "WHERE country_id IN %(ids)s "
-                                                   "AND lower(main)=%(main)s "
-                                                   "AND lower(sup)=%(sup0)s"
-                  ),
-              dict(ids=tuple(ids), main=ft.split[i - 1], sup0=ft.split[i][0]))
-
-    assert c.rowcount < 2
-
-    if c.rowcount == 1:
-        cols_map = ft.queryier.mk_cols_map(c)
-        fst = c.fetchone()
-        pp = pp_place_id(ft, "{0} {1}".format(fst[cols_map["main"]], fst[cols_map["sup"]][0]),
-                         fst[cols_map["postcode_id"]])
-        match = Results.RPost_Code(fst[cols_map["postcode_id"]], fst[cols_map["osm_id"]], fst[cols_map["country_id"]],
-                                   fst[cols_map["location"]], pp)
+    pcs = ft.queryier.backend.find_postcodes(ft.db, ft.split[i - 1], ids, ft.split[i][0], ft.show_area)
+
+    assert len(pcs) < 2
+
+    if len(pcs) == 1:
+        postcode_id, osm_id, country_id, fst_main, fst_sup, location = pcs[0]
+        pp = "{0} {1}".format(fst_main, fst_sup[0])
+        match = ft.postcode_result(postcode_id, osm_id, country_id, location, pp)
         yield match, i - 2
         return
 
     # Now we're struggling - try matching the main part of the postcode and ignore the supplementary
     # part. This will probably return multiple matches.
 
-    c = ft.db.cursor()
-    c.execute("SELECT postcode_id, osm_id, country_id, main, "
-              + ft.location_printer("location") + " as location "
-                                                  "FROM postcode "
-                                                  "WHERE country_id IN %(ids)s "
-                                                  "AND lower(main)=%(main)s",
-              dict(ids=tuple(ids), main=ft.split[i - 1]))
-
-    if c.rowcount != 0:
-        cols_map = ft.queryier.mk_cols_map(c)
-        fst = c.fetchone() # Arbitrarily pick the first result.
-        postcode_id = fst[cols_map["postcode_id"]]
-        country_id = fst[cols_map["country_id"]]
-        pp = pp_place_id(ft, fst[cols_map["main"]], postcode_id)
-        match = Results.RPost_Code(postcode_id, fst[cols_map["osm_id"]], country_id,
-                                   fst[cols_map["location"]], pp)
-        yield match, i - 2
-
-
-def pp_place_id(ft, pp, postcode_id):
-    c = ft.db.cursor()
+    pcs = ft.queryier.backend.find_postcodes(ft.db, ft.split[i - 1], ids, Backend.ANY, ft.show_area)
 
-    c.execute("SELECT parent_id FROM postcode WHERE postcode_id=%(id)s", dict(id=postcode_id))
-    parent_id = c.fetchone()[0]
-
-    if parent_id is not None:
-        pp = "{0}, {1}".format(pp, ft.queryier.pp_place_id(ft, parent_id))
+    if len(pcs) != 0:
+        # Arbitrarily pick the first result.
+        postcode_id, osm_id, country_id, fst_main, fst_sup, location = pcs[0]
+        match = ft.postcode_result(postcode_id, osm_id, country_id, location, fst_main)
+        yield match, i - 2
 
-    return pp
\ No newline at end of file
@@ -20,7 +20,7 @@
 
 
 import re
-from .import Results
+from .import Backend
 
 _RE_US_ZIP = re.compile("^[0-9]{5}$")
 _RE_US_ZIP_PLUS4 = re.compile("^[0-9]{5}-[0-9]{4}$")
@@ -36,45 +36,17 @@ def _sub_pc_match(ft, i):
     if _RE_US_ZIP_PLUS4.match(ft.split[i]):
         main, sup = ft.split[i].split('-')
     elif _RE_US_ZIP.match(ft.split[i]):
-        main, sup = ft.split[i], None
+        main, sup = ft.split[i], Backend.ANY
     else:
         return
 
-    if sup is not None:
-        sup_txt = " AND lower(sup)=%(sup)s "
-    else:
-        sup_txt = ""
-
-    c = ft.db.cursor()
-
-    c.execute("SELECT postcode_id, osm_id, country_id, main, "
-              + ft.location_printer("location") + " as location "
-                                                  "FROM postcode "
-                                                  "WHERE lower(main)=%(main)s "
-                                                  "AND country_id=%(us_id)s"
-              + sup_txt,
-              dict(main=main, sup=sup, us_id=us_id, ))
-
-    cols_map = ft.queryier.mk_cols_map(c)
-    for cnd in c.fetchall():
-        postcode_id = cnd[cols_map["postcode_id"]]
-        country_id = cnd[cols_map["country_id"]]
-        pp = pp_place_id(ft, cnd[cols_map["main"]], postcode_id)
-
+    pcs = ft.queryier.backend.find_postcodes(ft.db, main, [us_id], sup, ft.show_area)
+    for postcode_id, osm_id, country_id, pc_main, pc_sup, location in pcs:
         if us_id != ft.host_country_id:
-            pp = "{0}, {1}".format(pp, ft.queryier.country_name_id(ft, country_id))
+            suffix = ft.queryier.country_name_id(ft, country_id)
+        else:
+            suffix = None
 
-        match = Results.RPost_Code(postcode_id, cnd[cols_map["osm_id"]], country_id, cnd[cols_map["location"]], pp)
+        match = ft.postcode_result(postcode_id, osm_id, country_id, location, pc_main, suffix)
         yield match, i - 1
 
-
-def pp_place_id(ft, pp, postcode_id):
-    c = ft.db.cursor()
-
-    c.execute("SELECT parent_id FROM postcode WHERE postcode_id=%(id)s", dict(id=postcode_id))
-    parent_id = c.fetchone()[0]
-
-    if parent_id is not None:
-        pp = "{0}, {1}".format(pp, ft.queryier.pp_place_id(ft, parent_id))
-
-    return pp
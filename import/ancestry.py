@@ -0,0 +1,179 @@
+#! /usr/bin/env python3
+
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+# Materialize each place's ancestry and pretty printed names into the place_ancestry and place_pp
+# tables, so that the server can check parents and pretty print with a single lookup each rather
+# than walking up the tree one query at a time (see Queryier.pp_place_id). This runs against the
+# database the server uses, once the places have been imported, and must be re-run whenever places
+# change. The server picks the tables up the next time it (re)loads.
+#
+# place_pp holds, for each place, its pretty printed name in no particular language (lang_id NULL)
+# and, for each language in which it or one of its shown ancestors has a name, its pretty printed
+# name in that language if that differs.
+
+import itertools, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Geo.Queryier
+
+try:
+    import pgdb as dbmod
+except ImportError:
+    import psycopg2 as dbmod
+
+
+EXEC_MANY = 1024
+FETCH_SIZE = 10000
+
+ANCESTRY_SQL = "INSERT INTO place_ancestry (place_id, ancestor_ids) VALUES (%(place_id)s, %(ancestor_ids)s)"
+PP_SQL = "INSERT INTO place_pp (place_id, lang_id, pp) VALUES (%(place_id)s, %(lang_id)s, %(pp)s)"
+
+
+def iter_rows(c):
+    while True:
+        rows = c.fetchmany(FETCH_SIZE)
+        if len(rows) == 0:
+            break
+        for row in rows:
+            yield row
+
+
+# Return the name of a place in 'lang_id' if it has one, or else any of its names, mirroring
+# Backend.place_name. 'names' is a list of (lang_id, name) pairs.
+
+def place_name(names, lang_id):
+    for name_lang_id, name in names:
+        if name_lang_id == lang_id:
+            return name
+
+    return names[0][1]
+
+
+def pp(names, shown_names, lang_id):
+    return ", ".join([place_name(names, lang_id)] + [place_name(x, lang_id) for x in shown_names])
+
+
+print("===> Connecting to database")
+
+db = dbmod.connect(user="root", database="fetegeo")
+if hasattr(db, "set_client_encoding"):
+    db.set_client_encoding("utf-8")
+c = db.cursor()
+wc = db.cursor()
+
+print("===> Creating tables")
+
+c.execute("""DROP TABLE IF EXISTS place_ancestry;
+  DROP TABLE IF EXISTS place_pp;
+  CREATE TABLE place_ancestry (
+    place_id bigint,
+    ancestor_ids bigint[] -- Nearest first.
+  );
+  CREATE TABLE place_pp (
+    place_id bigint,
+    lang_id bigint, -- NULL for the pretty printed name in no particular language.
+    pp text
+  );""")
+
+print("===> Reading places")
+
+c.execute("SELECT country_id, iso3166_2 FROM country")
+iso2s = dict(c.fetchall())
+
+# place_id -> (parent_id, country_id, admin_level)
+places = {}
+c.execute("SELECT place_id, parent_id, country_id, admin_level FROM place")
+for place_id, parent_id, country_id, admin_level in iter_rows(c):
+    places[place_id] = (parent_id, country_id, admin_level)
+
+print("===> Computing ancestry")
+
+ancestors = {}
+buf = []
+for place_id in places.keys():
+    place_ancestors = []
+    parent_id = places[place_id][0]
+    while parent_id is not None and parent_id in places and parent_id not in place_ancestors \
+      and parent_id != place_id:
+        place_ancestors.append(parent_id)
+        parent_id = places[parent_id][0]
+    if len(place_ancestors) == 0:
+        continue
+    ancestors[place_id] = place_ancestors
+
+    buf.append(dict(place_id=place_id, ancestor_ids=place_ancestors))
+    if len(buf) >= EXEC_MANY:
+        wc.executemany(ANCESTRY_SQL, buf)
+        buf = []
+wc.executemany(ANCESTRY_SQL, buf)
+db.commit()
+
+print("===> Reading the names of parent places")
+
+# Only places which are some other place's parent can appear after the first name in a pretty
+# printed name, so only their names are held in memory.
+parent_ids = set([parent_id for parent_id, country_id, admin_level in places.values()])
+parent_names = {}
+c.execute("SELECT place_id, lang_id, name FROM place_name ORDER BY place_id")
+for place_id, lang_id, name in iter_rows(c):
+    if place_id in parent_ids:
+        parent_names.setdefault(place_id, []).append((lang_id, name))
+
+print("===> Computing pretty printed names")
+
+buf = []
+c.execute("SELECT place_id, lang_id, name FROM place_name ORDER BY place_id")
+for place_id, rows in itertools.groupby(iter_rows(c), lambda row: row[0]):
+    if place_id not in places:
+        continue
+    names = [(lang_id, name) for _, lang_id, name in rows]
+
+    parent_id, country_id, admin_level = places[place_id]
+    levels = Geo.Queryier.pp_levels(iso2s.get(country_id))
+    shown_names = [parent_names[x] for x in ancestors.get(place_id, [])
+                   if places[x][2] in levels and x in parent_names]
+
+    default_pp = pp(names, shown_names, None)
+    buf.append(dict(place_id=place_id, lang_id=None, pp=default_pp))
+    lang_ids = set([lang_id for lang_id, name in names])
+    for x in shown_names:
+        lang_ids.update([lang_id for lang_id, name in x])
+    lang_ids.discard(None)
+    for lang_id in sorted(lang_ids):
+        lang_pp = pp(names, shown_names, lang_id)
+        if lang_pp != default_pp:
+            buf.append(dict(place_id=place_id, lang_id=lang_id, pp=lang_pp))
+
+    if len(buf) >= EXEC_MANY:
+        wc.executemany(PP_SQL, buf)
+        buf = []
+wc.executemany(PP_SQL, buf)
+db.commit()
+
+print("===> Creating indexes")
+
+c.execute("""CREATE INDEX place_ancestry_place_id_idx ON place_ancestry (place_id);
+  CREATE INDEX place_pp_place_id_idx ON place_pp (place_id);
+  ANALYZE place_ancestry;
+  ANALYZE place_pp;""")
+db.commit()
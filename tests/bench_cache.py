@@ -0,0 +1,127 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+#
+# Hammer the engine's caches (see Geo/Temp_Cache.py) from many threads at once, and report the
+# throughput of a single SLRU_Cache (one lock) and of a Striped_Cache as the number of threads grows.
+# Keys are drawn from a skewed distribution, so that some are far hotter than others, as with real
+# queries. On a free-threaded build of Python, throughput should grow with the number of threads;
+# with the GIL, it should at least not fall.
+#
+
+import getopt, os, random, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Geo.Temp_Cache
+
+
+_DEFAULT_OPS = 200000
+_DEFAULT_KEYS = 100000
+_DEFAULT_THREADS = "1,2,4,8,16"
+_DEFAULT_WRITE_RATIO = 0.1
+
+_USAGE_MSG = """Usage: bench_cache.py [-k <keys>] [-n <ops per thread>] [-t <threads>,...] [-w <write ratio>]
+
+  -k  Number of distinct keys (default {0}).
+  -n  Operations per thread (default {1}).
+  -t  Thread counts to try (default {2}).
+  -w  Fraction of operations which are writes (default {3}).
+""".format(_DEFAULT_KEYS, _DEFAULT_OPS, _DEFAULT_THREADS, _DEFAULT_WRITE_RATIO)
+
+
+def _usage(error_msg="", code=0):
+    if error_msg != "":
+        sys.stderr.write("Error: {0}\n".format(error_msg))
+
+    sys.stderr.write(_USAGE_MSG)
+    sys.exit(code)
+
+
+def hammer(cache, keys, ops, write_ratio, seed, barrier):
+    rnd = random.Random(seed)
+    # Pre-draw the keys so that the random number generator isn't what's being measured.
+    draws = [keys[min(int(rnd.paretovariate(1.2)) - 1, len(keys) - 1)] for _ in range(ops)]
+    writes = [rnd.random() < write_ratio for _ in range(ops)]
+    value = ("place name", 123456, None, "{\"type\":\"Point\",\"coordinates\":[-0.1,51.5]}")
+    barrier.wait()
+    for k, write in zip(draws, writes):
+        if write:
+            cache[k] = value
+        else:
+            cache.get_or_compute(k, lambda: value)
+
+
+def run(mk_cache, threads, keys, ops, write_ratio):
+    cache = mk_cache()
+    barrier = threading.Barrier(threads + 1)
+    workers = [threading.Thread(target=hammer, args=(cache, keys, ops, write_ratio, i, barrier))
+               for i in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    return threads * ops / elapsed, cache.stats()
+
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'hk:n:t:w:')
+except getopt.error as e:
+    _usage(str(e), code=1)
+if len(args) > 0:
+    _usage("Too many arguments.", code=1)
+
+n_keys = _DEFAULT_KEYS
+ops = _DEFAULT_OPS
+thread_counts = _DEFAULT_THREADS
+write_ratio = _DEFAULT_WRITE_RATIO
+for opt, arg in opts:
+    if opt == "-h":
+        _usage()
+    elif opt == "-k":
+        n_keys = int(arg)
+    elif opt == "-n":
+        ops = int(arg)
+    elif opt == "-t":
+        thread_counts = arg
+    elif opt == "-w":
+        write_ratio = float(arg)
+
+keys = [("hash", i, False) for i in range(n_keys)]
+caches = [("SLRU_Cache", lambda: Geo.Temp_Cache.SLRU_Cache(Geo.Temp_Cache.LARGE_CACHE_BYTES)),
+          ("Striped_Cache", lambda: Geo.Temp_Cache.Striped_Cache(Geo.Temp_Cache.LARGE_CACHE_BYTES))]
+
+if hasattr(sys, "_is_gil_enabled") and not sys._is_gil_enabled():
+    print("Free-threaded Python {0}".format(sys.version.split()[0]))
+else:
+    print("Python {0} (with the GIL)".format(sys.version.split()[0]))
+
+print("{0:>8} {1:>16} {2:>16} {3:>8}".format("threads", caches[0][0], caches[1][0], "hit rate"))
+for threads in [int(x) for x in thread_counts.split(",")]:
+    rates = []
+    for name, mk_cache in caches:
+        rate, stats = run(mk_cache, threads, keys, ops, write_ratio)
+        rates.append(rate)
+    hit_rate = stats["hits"] / max(1, stats["hits"] + stats["misses"])
+    print("{0:>8} {1:>12.0f} op/s {2:>12.0f} op/s {3:>8.2f}".format(threads, rates[0], rates[1], hit_rate))
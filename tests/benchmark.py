@@ -0,0 +1,353 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+#
+# Benchmark the matching engine in-process, with no server, over two workloads: the geo queries of
+# the test cases in this directory (see testall.py), and synthetic query strings built from the
+# backend's place names. Each workload is run cold (the caches are flushed before every query, so
+# each query does its full work) and warm (after a pass to fill the caches). For each run, the
+# throughput, latency percentiles, time per phase (see Geo/Metrics.py), SQL statements and rows per
+# query, and cache hit rates are reported as JSON, so that builds can be compared.
+#
+# Synthetic queries are a place name, possibly preceded by up to -w words of dangling text (e.g. a
+# house number and street) and, unless the query is to be ambiguous (with probability -a), followed
+# by the place's country; a fraction -P of them are UK or US style postcodes instead, with or
+# without a place. The same seed (-r) always gives the same queries for the same data.
+#
+# The data is read from fixtures (see Geo/Memory_Backend.py), a snapshot (-x) or PostgreSQL (-d).
+# For example:
+#
+#   python3 benchmark.py -d fetegeo -u fetegeo -o new.json
+#   python3 benchmark.py -n 1000 gb.json
+#
+
+import getopt, glob, json, math, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Geo.DB_Pool, Geo.Memory_Backend, Geo.Metrics, Geo.PG_Backend, Geo.Queryier, Geo.Snapshot
+
+
+_DEFAULT_LANG = "en"
+_DEFAULT_SYNTHETIC = 200
+_DEFAULT_PASSES = 3
+_DEFAULT_SEED = 0
+_DEFAULT_AMBIGUITY = 0.5
+_DEFAULT_POSTCODE_RATIO = 0.2
+_DEFAULT_MAX_WORDS = 3
+
+# The number of place names sampled for synthetic queries.
+_NAME_SAMPLE = 5000
+
+_CASES_DIR = os.path.dirname(os.path.abspath(__file__))
+_SHELL_PREFIX = "$ "
+_FETEGEOC_OPTS = ('ab:c:df:hl:s:p:t', ["show-area", "sa"])
+
+_STREETS = ("High Street", "Station Road", "Main Street", "Church Lane", "Park Avenue", "Mill Road", "Elm Street")
+_UK_LETTERS = "ABCDEFGHJKLMNOPRSTUWYZ"
+
+_USAGE_MSG = """Usage: benchmark.py [-a <ambiguity>] [-d <database> [-u <user>]] [-n <synthetic queries>]
+  [-o <output>] [-p <passes>] [-P <postcode ratio>] [-r <seed>] [-t] [-w <max words>] [-x <snapshot>]
+  [<fixture> ...]
+
+  -a  Fraction of synthetic queries without a country (default {0}).
+  -d  Read the data from this PostgreSQL database.
+  -n  Number of synthetic queries (default {1}); 0 only runs the test cases.
+  -o  Write the JSON report to <output> rather than stdout.
+  -p  Number of warm passes over each workload (default {2}).
+  -P  Fraction of synthetic queries which are postcodes (default {3}).
+  -r  Seed for the synthetic queries (default {4}).
+  -t  Use the place trie.
+  -u  The PostgreSQL user.
+  -w  Most words of dangling text before synthetic queries (default {5}).
+  -x  Read the data from this snapshot.
+""".format(_DEFAULT_AMBIGUITY, _DEFAULT_SYNTHETIC, _DEFAULT_PASSES, _DEFAULT_POSTCODE_RATIO, _DEFAULT_SEED,
+           _DEFAULT_MAX_WORDS)
+
+
+def _usage(error_msg="", code=0):
+    if error_msg != "":
+        sys.stderr.write("Error: {0}\n".format(error_msg))
+
+    sys.stderr.write(_USAGE_MSG)
+    sys.exit(code)
+
+
+#
+# A query: the query string and the options it is looked up with.
+#
+
+class Query:
+    def __init__(self, qs, country=None, find_all=False, allow_dangling=False, show_area=False):
+        self.qs = qs
+        self.country = country
+        self.find_all = find_all
+        self.allow_dangling = allow_dangling
+        self.show_area = show_area
+
+
+#
+# Returns a list of Querys for the geo queries of the test cases in 'dir'.
+#
+
+def corpus(dir):
+    queries = []
+    for path in sorted(glob.glob(os.path.join(dir, "*"))):
+        if path.endswith(".py") or not os.path.isfile(path):
+            continue
+        with open(path, "r") as f:
+            cmd = f.readline().strip()
+        if not cmd.startswith(_SHELL_PREFIX):
+            continue
+
+        opts, args = getopt.getopt(cmd[len(_SHELL_PREFIX):].split()[1:], *_FETEGEOC_OPTS)
+        if len(args) < 2 or args[0] != "geo":
+            continue
+
+        q = Query(" ".join(args[1:]))
+        for opt, arg in opts:
+            if opt == "-a":
+                q.find_all = True
+            elif opt == "-c":
+                q.country = arg
+            elif opt == "-d":
+                q.allow_dangling = True
+            elif opt in ("--sa", "--show-area"):
+                q.show_area = True
+        queries.append(q)
+
+    return queries
+
+
+#
+# Returns a list of 'n' synthetic Querys (see the top of this file).
+#
+
+def synthetic(queryier, db, lang_ids, n, seed, ambiguity, postcode_ratio, max_words):
+    rnd = random.Random(seed)
+
+    # Sample the names by reservoir sampling, since there may be millions.
+    names = []
+    for i, (place_id, name, country_id) in enumerate(queryier.backend.iter_place_names(db)):
+        if len(names) < _NAME_SAMPLE:
+            names.append((name, country_id))
+        else:
+            j = rnd.randint(0, i)
+            if j < _NAME_SAMPLE:
+                names[j] = (name, country_id)
+    if len(names) == 0:
+        return []
+    names.sort()
+
+    queries = []
+    for _ in range(n):
+        name, country_id = rnd.choice(names)
+        parts = []
+        if max_words > 0:
+            words = rnd.randint(0, max_words)
+            if words > 0:
+                parts.append(" ".join([str(rnd.randint(1, 200))] + rnd.choice(_STREETS).split()[:words - 1]))
+
+        if rnd.random() < postcode_ratio:
+            if rnd.random() < 0.5:
+                postcode = "{0}{1}{2} {3}{4}{5}".format(rnd.choice(_UK_LETTERS), rnd.choice(_UK_LETTERS),
+                                                       rnd.randint(1, 99), rnd.randint(0, 9), rnd.choice(_UK_LETTERS),
+                                                       rnd.choice(_UK_LETTERS))
+            else:
+                postcode = "{0:05d}".format(rnd.randint(501, 99950))
+            if rnd.random() < 0.5:
+                parts.append(name)
+            parts.append(postcode)
+        else:
+            parts.append(name)
+            if country_id is not None and rnd.random() >= ambiguity:
+                country_name = queryier.ref.get_country_name(country_id, lang_ids)
+                if country_name is not None:
+                    parts.append(country_name)
+
+        queries.append(Query(", ".join(parts), allow_dangling=True))
+
+    return queries
+
+
+#
+# Run 'queries' and return a dict of the measurements. If 'cold' is True the caches are flushed
+# before each query; otherwise the queries are run once to warm the caches, and then 'passes'
+# times.
+#
+
+def run(queryier, db, lang_ids, queries, cold, passes):
+    metrics = Geo.Metrics.Metrics()
+    country_ids = dict([(q.country, queryier.ref.get_country_id(q.country)) for q in queries if q.country])
+
+    def lookup(q):
+        return queryier.name_to_lat_long(db, lang_ids, q.find_all, q.allow_dangling, q.show_area, q.qs,
+                                         country_ids.get(q.country))
+
+    # Maps the name of each cache to its (hits, misses) over the measured queries.
+    cache_counts = {}
+    def count_caches(sign=1):
+        for name, stats in queryier.stats().items():
+            if "hits" in stats:
+                hits, misses = cache_counts.get(name, (0, 0))
+                cache_counts[name] = (hits + sign * stats["hits"], misses + sign * stats["misses"])
+
+    queryier.flush_caches()
+    if cold:
+        passes = 1
+    else:
+        for q in queries:
+            lookup(q)
+        count_caches(-1)
+
+    latencies = []
+    phases = {}
+    sql_statements = sql_rows = results = 0
+    start = time.perf_counter()
+    for _ in range(passes):
+        for q in queries:
+            if cold:
+                count_caches()
+                queryier.flush_caches()
+            timer = metrics.start("geoquery")
+            results += len(lookup(q))
+            latencies.append(time.perf_counter() - timer.started)
+            metrics.finish(timer, None)
+            for phase, seconds in timer.phases.items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+            sql_statements += timer.sql_statements
+            sql_rows += timer.sql_rows
+    elapsed = time.perf_counter() - start
+    count_caches()
+
+    n = max(1, len(latencies))
+    latencies.sort()
+    return dict(queries=len(latencies), seconds=elapsed, queries_per_second=len(latencies) / max(elapsed, 1e-9),
+                latency_ms=dict(mean=sum(latencies) * 1000 / n, p50=_percentile(latencies, 50) * 1000,
+                                p95=_percentile(latencies, 95) * 1000, p99=_percentile(latencies, 99) * 1000,
+                                max=_percentile(latencies, 100) * 1000),
+                phase_ms=dict([(phase, phases[phase] * 1000 / n) for phase in Geo.Metrics.PHASES if phase in phases]),
+                sql_statements_per_query=sql_statements / n, sql_rows_per_query=sql_rows / n,
+                results_per_query=results / n,
+                cache_hit_rates=dict([(name, hits / (hits + misses)) for name, (hits, misses) in cache_counts.items()
+                                      if hits + misses > 0]))
+
+
+#
+# Returns the 'p'th percentile of the sorted list 'l', by the nearest rank method.
+#
+
+def _percentile(l, p):
+    if len(l) == 0:
+        return 0.0
+
+    return l[max(0, int(math.ceil(p / 100.0 * len(l))) - 1)]
+
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'a:d:hn:o:p:P:r:tu:w:x:')
+except getopt.error as e:
+    _usage(str(e), code=1)
+
+ambiguity = _DEFAULT_AMBIGUITY
+database = None
+n_synthetic = _DEFAULT_SYNTHETIC
+output = None
+passes = _DEFAULT_PASSES
+postcode_ratio = _DEFAULT_POSTCODE_RATIO
+seed = _DEFAULT_SEED
+use_place_trie = False
+user = None
+max_words = _DEFAULT_MAX_WORDS
+snapshot = None
+for opt, arg in opts:
+    if opt == "-a":
+        ambiguity = float(arg)
+    elif opt == "-d":
+        database = arg
+    elif opt == "-h":
+        _usage()
+    elif opt == "-n":
+        n_synthetic = int(arg)
+    elif opt == "-o":
+        output = arg
+    elif opt == "-p":
+        passes = int(arg)
+    elif opt == "-P":
+        postcode_ratio = float(arg)
+    elif opt == "-r":
+        seed = int(arg)
+    elif opt == "-t":
+        use_place_trie = True
+    elif opt == "-u":
+        user = arg
+    elif opt == "-w":
+        max_words = int(arg)
+    elif opt == "-x":
+        snapshot = arg
+
+if [database is not None, snapshot is not None, len(args) > 0].count(True) != 1:
+    _usage("Exactly one of -d, -x or fixtures must be given.", code=1)
+
+db = None
+if database is not None:
+    try:
+        import psycopg2
+    except ImportError:
+        _usage("-d needs psycopg2.", code=1)
+    # Prepare statements as the server does.
+    db = Geo.DB_Pool.Pooled_Connection(psycopg2.connect(user=user, database=database))
+    backend = Geo.PG_Backend.PG_Backend()
+elif snapshot is not None:
+    backend = Geo.Snapshot.Snapshot(snapshot)
+else:
+    backend = Geo.Memory_Backend.Memory_Backend(args)
+
+# The response cache is only used by the server.
+queryier = Geo.Queryier.Queryier(backend, 0, use_place_trie)
+queryier.reload(db)
+lang_ids = queryier.ref.get_lang_ids(_DEFAULT_LANG)
+
+workloads = [("corpus", corpus(_CASES_DIR))]
+if n_synthetic > 0:
+    workloads.append(("synthetic", synthetic(queryier, db, lang_ids, n_synthetic, seed, ambiguity, postcode_ratio,
+                                             max_words)))
+
+report = dict(python=sys.version.split()[0], backend=type(backend).__name__, place_trie=use_place_trie,
+              seed=seed, workloads={})
+for name, queries in workloads:
+    report["workloads"][name] = {}
+    for mode in ("cold", "warm"):
+        r = report["workloads"][name][mode] = run(queryier, db, lang_ids, queries, mode == "cold", passes)
+        sys.stderr.write("{0:<10} {1:<5} {2:>6} queries {3:>9.1f} q/s  p50 {4:>8.3f}ms  p95 {5:>8.3f}ms  "
+                         "p99 {6:>8.3f}ms  {7:>5.1f} SQL/query\n".format(name, mode, r["queries"],
+                         r["queries_per_second"], r["latency_ms"]["p50"], r["latency_ms"]["p95"],
+                         r["latency_ms"]["p99"], r["sql_statements_per_query"]))
+
+if db is not None:
+    db.close()
+
+if output is None:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+else:
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,391 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+#
+# Drive a running fetegeos with geo queries and report the throughput achieved, latency
+# percentiles, errors, and how the server's cache and statement counters (see "fetegeoc stats")
+# changed over the run.
+#
+# In closed loop mode (the default), -c connections each send a query, wait for its response and
+# immediately send the next, so the load adapts to how fast the server is. In open loop mode (-r),
+# queries arrive at a fixed rate whatever the server does, and are sent by whichever of the -c
+# connections is free; latencies are measured from when each query was due to be sent, so time
+# spent queueing because the server has fallen behind is counted rather than hidden.
+#
+# Query strings are read, one per line, from a file (-q), or else are a synthetic mix: the geo
+# queries of the test cases in this directory, some preceded by a house number and street, and
+# random UK and US style postcodes. Synthetic queries are sent with allow_dangling.
+#
+# One Python process can only send so many queries a second; to load a large server, run several
+# loadgen.py processes at once.
+#
+# For example:
+#
+#   python3 loadgen.py -c 32 -t 60
+#   python3 loadgen.py -r 500 -c 64 -q queries.txt -o run.json
+#
+
+import getopt, glob, json, math, os, queue, random, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Geo.Client, Geo.Results
+
+
+_DEFAULT_CONNECTIONS = 8
+_DEFAULT_DURATION = 10.0
+_DEFAULT_LANG = "en"
+_DEFAULT_SEED = 0
+_DEFAULT_SYNTHETIC = 1000
+
+_PERCENTILES = (50, 90, 95, 99, 99.9)
+
+_CASES_DIR = os.path.dirname(os.path.abspath(__file__))
+_SHELL_PREFIX = "$ "
+
+_STREETS = ("High Street", "Station Road", "Main Street", "Church Lane", "Park Avenue", "Mill Road", "Elm Street")
+_UK_LETTERS = "ABCDEFGHJKLMNOPRSTUWYZ"
+
+_USAGE_MSG = """Usage: loadgen.py [-c <connections>] [-f <format>] [-l <lang>] [-n] [-o <output>] [-p <port>]
+  [-q <query file>] [-r <rate>] [-R <seed>] [-s <host>] [-t <seconds>] [-w <seconds>]
+
+  -c  Number of connections (default {0}).
+  -f  Response format: xml (the default), json or bin.
+  -l  Language of the results (default {1}).
+  -n  Open a new connection for every query rather than keeping connections alive.
+  -o  Also write the report as JSON to <output>.
+  -p  Port of the server (default {2}).
+  -q  Read query strings from this file rather than using the synthetic mix.
+  -r  Send this many queries a second (open loop) rather than a closed loop.
+  -R  Seed for choosing queries (default {3}).
+  -s  Host of the server (default {4}).
+  -t  How long to measure for, in seconds (default {5}).
+  -w  How long to run before measuring, in seconds (default 0).
+""".format(_DEFAULT_CONNECTIONS, _DEFAULT_LANG, Geo.Client.DEFAULT_PORT, _DEFAULT_SEED, Geo.Client.DEFAULT_HOST,
+           _DEFAULT_DURATION)
+
+
+def _usage(error_msg="", code=0):
+    if error_msg != "":
+        sys.stderr.write("Error: {0}\n".format(error_msg))
+
+    sys.stderr.write(_USAGE_MSG)
+    sys.exit(code)
+
+
+#
+# Returns a list of synthetic query strings (see the top of this file).
+#
+
+def synthetic(rnd, n):
+    base = []
+    for path in sorted(glob.glob(os.path.join(_CASES_DIR, "*"))):
+        if path.endswith(".py") or not os.path.isfile(path):
+            continue
+        with open(path, "r") as f:
+            for l in f:
+                if l.startswith(_SHELL_PREFIX):
+                    args = l[len(_SHELL_PREFIX):].split()
+                    if "geo" in args:
+                        base.append(" ".join(args[args.index("geo") + 1:]))
+                    break
+
+    qss = []
+    for _ in range(n):
+        r = rnd.random()
+        if r < 0.15 or len(base) == 0:
+            qss.append("{0}{1}{2} {3}{4}{5}".format(rnd.choice(_UK_LETTERS), rnd.choice(_UK_LETTERS), rnd.randint(1, 99),
+                                                    rnd.randint(0, 9), rnd.choice(_UK_LETTERS), rnd.choice(_UK_LETTERS)))
+        elif r < 0.25:
+            qss.append("{0:05d}".format(rnd.randint(501, 99950)))
+        elif r < 0.5:
+            qss.append("{0} {1}, {2}".format(rnd.randint(1, 200), rnd.choice(_STREETS), rnd.choice(base)))
+        else:
+            qss.append(rnd.choice(base))
+
+    return qss
+
+
+#
+# What one connection saw: the (start time, latency) of every query answered while measuring, and
+# counts of errors by kind.
+#
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+#
+# A connection to the server, reconnecting after connection errors.
+#
+
+class Connection:
+    def __init__(self, rec):
+        self._rec = rec
+        self._client = None
+
+
+    #
+    # Send the query 'qs', returning True if it was answered.
+    #
+
+    def query(self, qs):
+        try:
+            if self._client is None:
+                self._client = Geo.Client.Client(host, port, keep_alive=keep_alive, format=fmt)
+            self._client.geo(qs, [lang], **kw)
+            ok = True
+        except Geo.Client.Query_Error:
+            self._rec.error("query")
+            ok = False
+        except (OSError, EOFError):
+            self._rec.error("connection")
+            self.close()
+            return False
+
+        if not keep_alive:
+            self.close()
+
+        return ok
+
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+def closed_loop(rec, seed, measure_from, deadline):
+    rnd = random.Random(seed)
+    conn = Connection(rec)
+    while True:
+        start = time.perf_counter()
+        if start >= deadline:
+            break
+        if conn.query(rnd.choice(qss)) and start >= measure_from:
+            rec.latencies.append((start, time.perf_counter() - start))
+    conn.close()
+
+
+def open_loop_worker(rec, due):
+    conn = Connection(rec)
+    while True:
+        item = due.get()
+        if item is None:
+            break
+        t, qs, measured = item
+        if conn.query(qs) and measured:
+            rec.latencies.append((t, time.perf_counter() - t))
+    conn.close()
+
+
+#
+# Put a query on 'due' at each of its arrival times, returning the largest number of queries
+# which were waiting for a free connection at once.
+#
+
+def open_loop_dispatch(due, rnd, start, measure_from, deadline):
+    n = 0
+    backlog = 0
+    while True:
+        t = start + n / rate
+        if t >= deadline:
+            break
+        delay = t - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        due.put((t, rnd.choice(qss), t >= measure_from))
+        backlog = max(backlog, due.qsize())
+        n += 1
+
+    return backlog
+
+
+def server_stats():
+    try:
+        client = Geo.Client.Client(host, port)
+        try:
+            return client.stats()
+        finally:
+            client.close()
+    except (OSError, EOFError, Geo.Client.Query_Error) as e:
+        sys.stderr.write("Warning: Can't read the server's stats: {0}.\n".format(e))
+        return None
+
+
+#
+# Returns how the server's counters changed between the stats 'before' and 'after'.
+#
+
+def stats_delta(before, after):
+    caches = {}
+    for name, counters in after["caches"].items():
+        prev = before["caches"].get(name, {})
+        delta = dict([(k, v - prev.get(k, 0)) for k, v in counters.items()
+                      if k in ("hits", "misses", "inserts", "evictions", "rejects")])
+        delta["entries"] = counters.get("entries")
+        delta["bytes"] = counters.get("bytes")
+        if delta.get("hits", 0) + delta.get("misses", 0) > 0:
+            delta["hit_rate"] = delta["hits"] / (delta["hits"] + delta["misses"])
+        caches[name] = delta
+
+    executes_before = sum([s["executes"] for s in before["statements"].values()])
+    executes_after = sum([s["executes"] for s in after["statements"].values()])
+
+    return dict(caches=caches, statement_executes=executes_after - executes_before)
+
+
+def _percentile(l, p):
+    if len(l) == 0:
+        return 0.0
+
+    return l[max(0, int(math.ceil(p / 100.0 * len(l))) - 1)]
+
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'c:f:hl:no:p:q:r:R:s:t:w:')
+except getopt.error as e:
+    _usage(str(e), code=1)
+if len(args) > 0:
+    _usage("Too many arguments.", code=1)
+
+connections = _DEFAULT_CONNECTIONS
+fmt = Geo.Results.DEFAULT_FORMAT
+lang = _DEFAULT_LANG
+keep_alive = True
+output = None
+port = Geo.Client.DEFAULT_PORT
+query_file = None
+rate = None
+seed = _DEFAULT_SEED
+host = Geo.Client.DEFAULT_HOST
+duration = _DEFAULT_DURATION
+warmup = 0.0
+for opt, arg in opts:
+    if opt == "-c":
+        connections = int(arg)
+    elif opt == "-f":
+        if arg not in Geo.Results.FORMATS:
+            _usage("Unknown format '{0}'.".format(arg), code=1)
+        fmt = arg
+    elif opt == "-h":
+        _usage()
+    elif opt == "-l":
+        lang = arg
+    elif opt == "-n":
+        keep_alive = False
+    elif opt == "-o":
+        output = arg
+    elif opt == "-p":
+        port = int(arg)
+    elif opt == "-q":
+        query_file = arg
+    elif opt == "-r":
+        rate = float(arg)
+    elif opt == "-R":
+        seed = int(arg)
+    elif opt == "-s":
+        host = arg
+    elif opt == "-t":
+        duration = float(arg)
+    elif opt == "-w":
+        warmup = float(arg)
+
+rnd = random.Random(seed)
+if query_file is not None:
+    with open(query_file, "r") as f:
+        qss = [l.strip() for l in f if l.strip() != ""]
+    kw = {}
+else:
+    qss = synthetic(rnd, _DEFAULT_SYNTHETIC)
+    kw = dict(allow_dangling=True)
+if len(qss) == 0:
+    _usage("No queries.", code=1)
+
+before = server_stats()
+
+recs = [Recorder() for _ in range(connections)]
+start = time.perf_counter()
+measure_from = start + warmup
+deadline = measure_from + duration
+backlog = None
+if rate is None:
+    workers = [threading.Thread(target=closed_loop, args=(rec, seed + i, measure_from, deadline))
+               for i, rec in enumerate(recs)]
+    for w in workers:
+        w.start()
+else:
+    due = queue.Queue()
+    workers = [threading.Thread(target=open_loop_worker, args=(rec, due)) for rec in recs]
+    for w in workers:
+        w.start()
+    backlog = open_loop_dispatch(due, rnd, start, measure_from, deadline)
+    for _ in workers:
+        due.put(None)
+for w in workers:
+    w.join()
+# Queries still being answered at the deadline are measured, so the run may overrun it.
+elapsed = max(time.perf_counter(), deadline) - measure_from
+
+after = server_stats()
+
+latencies = sorted([latency for rec in recs for t, latency in rec.latencies])
+errors = {}
+for rec in recs:
+    for kind, n in rec.errors.items():
+        errors[kind] = errors.get(kind, 0) + n
+
+report = dict(mode="open" if rate is not None else "closed", connections=connections, keep_alive=keep_alive,
+              format=fmt, offered_rate=rate, seconds=elapsed, queries=len(latencies),
+              queries_per_second=len(latencies) / elapsed, errors=errors,
+              latency_ms=dict([("p{0}".format(p), _percentile(latencies, p) * 1000) for p in _PERCENTILES]))
+report["latency_ms"]["mean"] = sum(latencies) * 1000 / max(1, len(latencies))
+report["latency_ms"]["max"] = _percentile(latencies, 100) * 1000
+if backlog is not None:
+    report["max_backlog"] = backlog
+if before is not None and after is not None:
+    report["server"] = stats_delta(before, after)
+
+print("{0} loop, {1} connections{2}: {3} queries in {4:.1f}s, {5:.1f} queries/s".format(report["mode"],
+      connections, "" if rate is None else ", offered {0:.1f} queries/s".format(rate), len(latencies), elapsed,
+      report["queries_per_second"]))
+print("Latency (ms): " + "  ".join(["{0} {1:.2f}".format(k, report["latency_ms"][k])
+                                    for k in ["p{0}".format(p) for p in _PERCENTILES] + ["mean", "max"]]))
+if len(errors) > 0:
+    print("Errors: " + "  ".join(["{0} {1}".format(kind, n) for kind, n in sorted(errors.items())]))
+if backlog is not None:
+    print("Most queries waiting for a connection: {0}".format(backlog))
+if "server" in report:
+    print("Server: {0} statements executed".format(report["server"]["statement_executes"]))
+    for name, delta in sorted(report["server"]["caches"].items()):
+        if "hit_rate" in delta:
+            print("  {0:<20} hit rate {1:>6.1%}  inserts {2:>8}  evictions {3:>8}".format(name, delta["hit_rate"],
+                  delta["inserts"], delta["evictions"]))
+
+if output is not None:
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
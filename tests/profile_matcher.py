@@ -0,0 +1,121 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+#
+# Profile the matching engine in isolation, with no server or database, against in-memory fixtures
+# (see Geo/Memory_Backend.py). Query strings are read, one per line, from stdin. Each pass matches
+# every query string once with the caches flushed beforehand, so that the matcher does its full
+# work every time.
+#
+# For example:
+#
+#   ../fetegeos -f gb.json -c gb
+#   echo "new york" | python3 profile_matcher.py -c gb gb.json
+#
+
+import cProfile, getopt, os, pstats, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Geo.Memory_Backend, Geo.Queryier
+
+
+_DEFAULT_LANG = "en"
+_DEFAULT_PASSES = 10
+_DEFAULT_SORT = "cumulative"
+_DEFAULT_LIMIT = 30
+
+_USAGE_MSG = """Usage: profile_matcher.py [-c <host country>] [-l <lang>] [-n <passes>] [-s <sort>] [-t]
+  <fixture> [<fixture> ...] < <queries>
+
+  -c  Country the queries are assumed to come from.
+  -l  Language of the results (default {0}).
+  -n  Number of passes over the queries (default {1}).
+  -s  Sort order of the profile, as for pstats (default {2}).
+  -t  Use the place trie.
+""".format(_DEFAULT_LANG, _DEFAULT_PASSES, _DEFAULT_SORT)
+
+
+def _usage(error_msg="", code=0):
+    if error_msg != "":
+        sys.stderr.write("Error: {0}\n".format(error_msg))
+
+    sys.stderr.write(_USAGE_MSG)
+    sys.exit(code)
+
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'c:hl:n:s:t')
+except getopt.error as e:
+    _usage(str(e), code=1)
+
+host_country = None
+lang = _DEFAULT_LANG
+passes = _DEFAULT_PASSES
+sort = _DEFAULT_SORT
+use_place_trie = False
+for opt, arg in opts:
+    if opt == "-c":
+        host_country = arg
+    elif opt == "-h":
+        _usage()
+    elif opt == "-l":
+        lang = arg
+    elif opt == "-n":
+        passes = int(arg)
+    elif opt == "-s":
+        sort = arg
+    elif opt == "-t":
+        use_place_trie = True
+
+if len(args) == 0:
+    _usage("No fixtures given.", code=1)
+
+queryier = Geo.Queryier.Queryier(Geo.Memory_Backend.Memory_Backend(args), use_place_trie=use_place_trie)
+queryier.reload(None)
+
+lang_ids = queryier.ref.get_lang_ids(lang)
+if len(lang_ids) == 0:
+    _usage("Unknown language '{0}'.".format(lang), code=1)
+
+host_country_id = None
+if host_country is not None:
+    host_country_id = queryier.ref.get_country_id(host_country)
+    if host_country_id is None:
+        _usage("Unknown country '{0}'.".format(host_country), code=1)
+
+qss = [l.strip() for l in sys.stdin if l.strip() != ""]
+
+
+def run():
+    for _ in range(passes):
+        queryier.flush_caches()
+        for qs in qss:
+            queryier.name_to_lat_long(None, lang_ids, False, False, False, qs, host_country_id)
+
+
+profile = cProfile.Profile()
+start = time.time()
+profile.runcall(run)
+elapsed = time.time() - start
+
+print("{0} queries in {1:.3f}s ({2:.3f}ms per query, including profiling overhead)".format(
+      len(qss) * passes, elapsed, elapsed * 1000 / max(1, len(qss) * passes)))
+pstats.Stats(profile).sort_stats(sort).print_stats(_DEFAULT_LIMIT)
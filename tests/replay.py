@@ -0,0 +1,270 @@
+# Copyright (C) 2008 Laurence Tratt http://tratt.net/laurie/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+#
+# Replay capture logs written by fetegeos (see capture_path in fetegeos.conf.sample and
+# Geo/Capture.py) against a running server, and report how it coped.
+#
+# Each captured connection is replayed on a connection of its own (kept alive if it carried more
+# than one query), with its queries sent in order at their captured arrival times, so that the
+# replayed traffic has the same shape and concurrency as the original. -x speeds the replay up (or
+# slows it down); -x 0 sends every query as soon as its connection is free, which is useful to warm
+# a new server's caches from real traffic. If the server falls behind, queries are sent late; how
+# late is reported as the lag.
+#
+# Several logs (e.g. rotated logs, or those of prefork workers) can be given at once and are merged
+# by arrival time. The report compares the replayed latencies with the captured ones, and gives the
+# hit rate of each of the server's caches over the replay (see "fetegeoc stats"), so that different
+# cache configurations can be compared on the same traffic.
+#
+# For example:
+#
+#   python3 replay.py -x 2 /var/log/fetegeo/queries.cap.1 /var/log/fetegeo/queries.cap
+#
+
+import getopt, json, math, os, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Geo.Capture, Geo.Client
+
+
+_DEFAULT_MAX_CONNECTIONS = 256
+_DEFAULT_SPEED = 1.0
+
+_PERCENTILES = (50, 90, 99, 99.9)
+
+_USAGE_MSG = """Usage: replay.py [-c <connections>] [-o <output>] [-p <port>] [-s <host>] [-x <speed>]
+  <capture log> ...
+
+  -c  Most connections open at once (default {0}).
+  -o  Also write the report as JSON to <output>.
+  -p  Port of the server (default {1}).
+  -s  Host of the server (default {2}).
+  -x  Replay at this multiple of the captured speed (default {3:g}); 0 replays as fast as possible.
+""".format(_DEFAULT_MAX_CONNECTIONS, Geo.Client.DEFAULT_PORT, Geo.Client.DEFAULT_HOST, _DEFAULT_SPEED)
+
+
+def _usage(error_msg="", code=0):
+    if error_msg != "":
+        sys.stderr.write("Error: {0}\n".format(error_msg))
+
+    sys.stderr.write(_USAGE_MSG)
+    sys.exit(code)
+
+
+#
+# Returns the captured connections, in the order they were opened, as lists of records (see
+# Geo.Capture.read) in arrival order. Connection IDs are only unique within a log.
+#
+
+def load(paths):
+    recs = []
+    for i, path in enumerate(paths):
+        for rec in Geo.Capture.read(path):
+            recs.append((rec[0], i, rec))
+    recs.sort(key=lambda x: x[0])
+
+    conns = {}
+    for _, i, rec in recs:
+        conns.setdefault((i, rec[2]), []).append(rec)
+
+    return list(conns.values())
+
+
+#
+# Replay the queries of one captured connection, 'first' being the arrival time of the first query
+# captured in any log and 'start' when the replay started.
+#
+
+def replay_conn(queries, first, start):
+    client = None
+    try:
+        for arrival, captured_latency, _, qs, langs, country, flags in queries:
+            due = start + _offset(arrival, first)
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            fmt = Geo.Capture.flags_format(flags)
+            sent = time.perf_counter()
+            try:
+                if client is None:
+                    client = Geo.Client.Client(host, port, keep_alive=len(queries) > 1, format=fmt)
+                client.format = fmt
+                client.geo(qs, langs, country=country,
+                           find_all=bool(flags & Geo.Capture.FIND_ALL),
+                           allow_dangling=bool(flags & Geo.Capture.ALLOW_DANGLING),
+                           show_area=bool(flags & Geo.Capture.SHOW_AREA))
+            except Geo.Client.Query_Error:
+                _error("query")
+                continue
+            except (OSError, EOFError):
+                _error("connection")
+                if client is not None:
+                    client.close()
+                    client = None
+                continue
+
+            latencies.append(time.perf_counter() - sent)
+            captured.append(captured_latency)
+            lags.append(max(0.0, sent - due))
+    finally:
+        if client is not None:
+            client.close()
+        slots.release()
+
+
+def _offset(arrival, first):
+    if speed == 0:
+        return 0.0
+
+    return (arrival - first) / speed
+
+
+def _error(kind):
+    with errors_lock:
+        errors[kind] = errors.get(kind, 0) + 1
+
+
+def server_stats():
+    try:
+        client = Geo.Client.Client(host, port)
+        try:
+            return client.stats()
+        finally:
+            client.close()
+    except (OSError, EOFError, Geo.Client.Query_Error) as e:
+        sys.stderr.write("Warning: Can't read the server's stats: {0}.\n".format(e))
+        return None
+
+
+#
+# Returns the hit rate of each cache between the stats 'before' and 'after', for those caches which
+# were used.
+#
+
+def hit_rates(before, after):
+    rates = {}
+    for name, counters in after["caches"].items():
+        prev = before["caches"].get(name, {})
+        hits = counters.get("hits", 0) - prev.get("hits", 0)
+        misses = counters.get("misses", 0) - prev.get("misses", 0)
+        if hits + misses > 0:
+            rates[name] = hits / (hits + misses)
+
+    return rates
+
+
+def _percentile(l, p):
+    if len(l) == 0:
+        return 0.0
+
+    return l[max(0, int(math.ceil(p / 100.0 * len(l))) - 1)]
+
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'c:ho:p:s:x:')
+except getopt.error as e:
+    _usage(str(e), code=1)
+if len(args) == 0:
+    _usage("No capture logs given.", code=1)
+
+max_connections = _DEFAULT_MAX_CONNECTIONS
+output = None
+port = Geo.Client.DEFAULT_PORT
+host = Geo.Client.DEFAULT_HOST
+speed = _DEFAULT_SPEED
+for opt, arg in opts:
+    if opt == "-c":
+        max_connections = int(arg)
+    elif opt == "-h":
+        _usage()
+    elif opt == "-o":
+        output = arg
+    elif opt == "-p":
+        port = int(arg)
+    elif opt == "-s":
+        host = arg
+    elif opt == "-x":
+        speed = float(arg)
+        if speed < 0:
+            _usage("The speed can't be negative.", code=1)
+
+try:
+    conns = load(args)
+except (OSError, Geo.Capture.Capture_Error) as e:
+    _usage(str(e), code=1)
+if len(conns) == 0:
+    _usage("The capture logs are empty.", code=1)
+
+latencies = []
+captured = []
+lags = []
+errors = {}
+errors_lock = threading.Lock()
+slots = threading.BoundedSemaphore(max_connections)
+
+before = server_stats()
+
+first = conns[0][0][0]
+start = time.perf_counter()
+threads = []
+for queries in conns:
+    delay = start + _offset(queries[0][0], first) - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+    slots.acquire()
+    t = threading.Thread(target=replay_conn, args=(queries, first, start))
+    t.start()
+    threads.append(t)
+for t in threads:
+    t.join()
+elapsed = time.perf_counter() - start
+
+after = server_stats()
+
+latencies.sort()
+captured.sort()
+lags.sort()
+n = sum([len(queries) for queries in conns])
+report = dict(queries=n, connections=len(conns), answered=len(latencies), errors=errors, speed=speed,
+              seconds=elapsed, captured_seconds=max([queries[-1][0] for queries in conns]) - first,
+              queries_per_second=len(latencies) / elapsed,
+              latency_ms=dict([("p{0}".format(p), _percentile(latencies, p) * 1000) for p in _PERCENTILES]),
+              captured_latency_ms=dict([("p{0}".format(p), _percentile(captured, p) * 1000) for p in _PERCENTILES]),
+              lag_ms=dict([("p{0}".format(p), _percentile(lags, p) * 1000) for p in _PERCENTILES]))
+if before is not None and after is not None:
+    report["hit_rates"] = hit_rates(before, after)
+
+print("Replayed {0} queries on {1} connections in {2:.1f}s ({3:.1f}s captured), {4:.1f} queries/s".format(n,
+      len(conns), elapsed, report["captured_seconds"], report["queries_per_second"]))
+for name, title in (("latency_ms", "Latency (ms)"), ("captured_latency_ms", "Captured (ms)"), ("lag_ms", "Lag (ms)")):
+    print("{0:<14}".format(title) + "  ".join(["p{0} {1:.2f}".format(p, report[name]["p{0}".format(p)])
+                                            for p in _PERCENTILES]))
+if len(errors) > 0:
+    print("Errors: " + "  ".join(["{0} {1}".format(kind, n) for kind, n in sorted(errors.items())]))
+if "hit_rates" in report:
+    for name, rate in sorted(report["hit_rates"].items()):
+        print("  {0:<20} hit rate {1:>6.1%}".format(name, rate))
+
+if output is not None:
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -21,7 +21,32 @@
 # IN THE SOFTWARE.
 
 
-import glob, subprocess, sys
+#
+# Run the test cases in this directory (or those given as arguments). Each case file starts with
+# the fetegeoc command line being tested, followed by lines which must all appear in fetegeoc's
+# output for it (or by "No match found." if nothing should match). Lines starting with "#" are
+# comments, except for budgets, which fail the case if the query costs more than they allow:
+#
+#   # max_sql: <n>   The query may execute at most <n> SQL statements.
+#   # max_ms: <n>    The query may take at most <n> milliseconds.
+#
+# Rather than running fetegeoc against a server, the queries are answered in-process, several at
+# once, each with empty caches (see Queryier.uncached_copy) so that the statements a query needs
+# don't depend on which cases happened to run before it. The answers are still encoded as the
+# server would (in the format given by the command line's -f, if any), decoded as fetegeoc would,
+# and printed with fetegeoc's formatting (see Geo.Client.match_lines). Since cases running alongside
+# slow each other down, use -j 1 when setting max_ms budgets.
+#
+# For example:
+#
+#   python3 testall.py -d fetegeo -u fetegeo
+#   python3 testall.py -x ../fetegeo.snapshot pc1 pc2
+#
+
+import concurrent.futures, contextlib, getopt, glob, os, re, sys, time, traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Geo.Client, Geo.DB_Pool, Geo.Memory_Backend, Geo.Metrics, Geo.PG_Backend, Geo.Queryier, Geo.Results, Geo.Snapshot
 
 
 PY_EXT = ".py"
@@ -30,38 +55,208 @@ COMMENT_PREFIX = "#"
 SHELL_PREFIX = "$ "
 NO_MATCH = "No match found."
 
-if len(sys.argv) == 1:
-    paths = glob.glob("*")
-    paths.sort()
-else:
-    paths = sys.argv[1:]
+_RE_BUDGET = re.compile("#\\s*(max_sql|max_ms)\\s*:\\s*([0-9.]+)\\s*$")
 
-for path in paths:
-    if path.endswith(PY_EXT):
-        continue
+_DEFAULT_LANG = "en"
+
+# fetegeoc's options.
+_FETEGEOC_OPTS = ('ab:c:df:hl:s:p:t', ["show-area", "sa"])
+
+_USAGE_MSG = """Usage: testall.py [-d <database> [-u <user>] | -x <snapshot> | -f <fixture> ...] [-j <jobs>] [-t]
+  [<case> ...]
+
+  -d  Read the data from this PostgreSQL database.
+  -f  Read the data from this fixture (may be given more than once).
+  -j  Run this many cases at once (default: the number of CPUs).
+  -t  Use the place trie.
+  -u  The PostgreSQL user.
+  -x  Read the data from this snapshot.
+"""
+
+
+def _usage(error_msg="", code=0):
+    if error_msg != "":
+        sys.stderr.write("Error: {0}\n".format(error_msg))
+
+    sys.stderr.write(_USAGE_MSG)
+    sys.exit(code)
+
+
+#
+# Run the case in 'path', returning a (failure message or None, SQL statements, milliseconds)
+# triple.
+#
 
-    print(path)
+def run_case(path):
+    with open(path, "r") as f:
+        lines = f.readlines()
+    f_lines = [x.strip() for x in lines if not x.startswith(COMMENT_PREFIX)]
+    budgets = {}
+    for l in lines:
+        m = _RE_BUDGET.match(l.strip())
+        if m is not None:
+            budgets[m.group(1)] = float(m.group(2))
 
-    f = open(path, "r")
-    f_lines = [x.strip() for x in f if not x.startswith(COMMENT_PREFIX)]
     if not f_lines[0].startswith(SHELL_PREFIX):
-        None
+        return "Doesn't start with a command.", 0, 0.0
+    try:
+        opts, args = getopt.getopt(f_lines[0][len(SHELL_PREFIX):].split()[1:], *_FETEGEOC_OPTS)
+    except getopt.error as e:
+        return str(e), 0, 0.0
 
-    rest = f.read()
+    country = None
+    find_all = allow_dangling = show_area = False
+    fmt = Geo.Results.DEFAULT_FORMAT
+    langs = []
+    for opt, arg in opts:
+        if opt == "-a":
+            find_all = True
+        elif opt == "-c":
+            country = arg
+        elif opt == "-d":
+            allow_dangling = True
+        elif opt == "-f":
+            if arg not in Geo.Results.FORMATS:
+                return "Unknown format '{0}'.".format(arg), 0, 0.0
+            fmt = arg
+        elif opt == "-l":
+            langs.append(arg)
+        elif opt in ("--sa", "--show-area"):
+            show_area = True
+    if len(langs) == 0:
+        langs.append(_DEFAULT_LANG)
 
-    sp = subprocess.Popen(f_lines[0][len(SHELL_PREFIX):].split(" "), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    sp.wait()
-    stdout_lines = [x.strip() for x in sp.stdout]
-    stderr_lines = [x.strip() for x in sp.stderr]
+    queryier = base_queryier.uncached_copy()
+    lang_ids = []
+    for lang in langs:
+        lang_ids.extend(queryier.ref.get_lang_ids(lang))
+    qs = " ".join(args[1:])
 
-    if f_lines[1] == NO_MATCH and sp.returncode == 1:
-        continue
+    with connection() as db:
+        timer = metrics.start(args[0] + "query")
+        if args[0] == "geo":
+            country_id = None
+            if country is not None:
+                country_id = queryier.ref.get_country_id(country)
+            results = queryier.name_to_lat_long(db, lang_ids, find_all, allow_dangling, show_area, qs, country_id)
+            msg = Geo.Results.encode_results(results, fmt, None)
+        elif args[0] == "country":
+            country_id = queryier.ref.get_country_id(qs)
+            name = None
+            if country_id is not None:
+                name = queryier.ref.get_country_name(country_id, lang_ids)
+            msg = Geo.Results.encode_country(name, fmt, None)
+        else:
+            return "Unknown query type '{0}'.".format(args[0]), 0, 0.0
+        ms = (time.perf_counter() - timer.started) * 1000
+        metrics.finish(timer, None)
+    sql = timer.sql_statements
+
+    # As printed by fetegeoc, without the indentation.
+    kind, _, v = Geo.Client.decode(msg, fmt)
+    if kind == "results":
+        out_lines = [l.strip() for i, result in enumerate(v) for l in Geo.Client.match_lines(i, result)]
+        matched = len(v) > 0
+    else:
+        out_lines = []
+        if v is not None:
+            out_lines.append(Geo.Client.field_line("name", v))
+        matched = v is not None
+
+    if "max_sql" in budgets and sql > budgets["max_sql"]:
+        return "{0} SQL statements, over the budget of {1}.".format(sql, int(budgets["max_sql"])), sql, ms
+    if "max_ms" in budgets and ms > budgets["max_ms"]:
+        return "{0:.1f}ms, over the budget of {1}ms.".format(ms, budgets["max_ms"]), sql, ms
+
+    if f_lines[1] == NO_MATCH and not matched:
+        return None, sql, ms
 
     for l in f_lines[1:]:
-        if not l in stdout_lines:
+        if not l in out_lines:
             if l.startswith("id:"):
                 continue
 
-            print("Not found:\n  %s\nin:  " % l)
-            print("\n  ".join(stdout_lines))
-            sys.exit(1)
+            return "Not found:\n  {0}\nin:\n  {1}".format(l, "\n  ".join(out_lines)), sql, ms
+
+    return None, sql, ms
+
+
+def _run_case(path):
+    try:
+        return run_case(path)
+    except Exception:
+        return traceback.format_exc(), 0, 0.0
+
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'd:f:hj:tu:x:')
+except getopt.error as e:
+    _usage(str(e), code=1)
+
+database = None
+fixtures = []
+jobs = os.cpu_count() or 1
+use_place_trie = False
+user = None
+snapshot = None
+for opt, arg in opts:
+    if opt == "-d":
+        database = arg
+    elif opt == "-f":
+        fixtures.append(arg)
+    elif opt == "-h":
+        _usage()
+    elif opt == "-j":
+        jobs = int(arg)
+    elif opt == "-t":
+        use_place_trie = True
+    elif opt == "-u":
+        user = arg
+    elif opt == "-x":
+        snapshot = arg
+
+if [database is not None, snapshot is not None, len(fixtures) > 0].count(True) != 1:
+    _usage("Exactly one of -d, -x or -f must be given.", code=1)
+
+if database is not None:
+    try:
+        import psycopg2
+    except ImportError:
+        _usage("-d needs psycopg2.", code=1)
+    pool = Geo.DB_Pool.DB_Pool(lambda: psycopg2.connect(user=user, database=database), 1, jobs)
+    connection = pool.connection
+    backend = Geo.PG_Backend.PG_Backend()
+else:
+    pool = None
+    connection = contextlib.nullcontext
+    if snapshot is not None:
+        backend = Geo.Snapshot.Snapshot(snapshot)
+    else:
+        backend = Geo.Memory_Backend.Memory_Backend(fixtures)
+
+base_queryier = Geo.Queryier.Queryier(backend, 0, use_place_trie)
+with connection() as db:
+    base_queryier.reload(db)
+metrics = Geo.Metrics.Metrics()
+
+if len(args) == 0:
+    paths = glob.glob("*")
+    paths.sort()
+else:
+    paths = args
+paths = [path for path in paths if not path.endswith(PY_EXT) and os.path.isfile(path)]
+
+failed = 0
+with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    for path, (failure, sql, ms) in zip(paths, executor.map(_run_case, paths)):
+        print("{0:<20} {1:>4} SQL {2:>9.1f}ms".format(path, sql, ms))
+        if failure is not None:
+            print(failure)
+            failed += 1
+
+if pool is not None:
+    pool.close()
+
+if failed > 0:
+    print("{0} of {1} cases failed.".format(failed, len(paths)))
+    sys.exit(1)